@@ -0,0 +1,147 @@
+"""
+Batch conversion of many CareLink exports.
+
+Usage:
+    python batch.py <folder with CSV files | manifest.csv> [--workers N]
+
+A folder is converted file by file, the name of each CSV (without extension) is used as patient id.
+A manifest is a CSV file with the columns 'csv_file' and 'patient_id' (relative paths are resolved
+from the folder of the manifest) and an optional 'env_file' column: a .env file whose values override
+the configuration for that file only. The bundles of every patient are saved in their own folder under
+FOLDER_BUNDLE_DESTINATION.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from main import process_patient_data
+from settings import load_settings, load_settings_file
+
+BatchJob = namedtuple("BatchJob", ["csv_file", "patient_id", "env_file"], defaults=[None])
+BatchResult = namedtuple("BatchResult", ["csv_file", "patient_id", "success", "seconds", "error"])
+
+
+def load_batch_jobs(source):
+    """
+    Lists the files to convert.
+
+    Args:
+        source (str): A folder with CareLink CSV exports or a manifest CSV file.
+
+    Returns:
+        list: BatchJob for every file, in a stable order.
+    """
+    if os.path.isdir(source):
+        return [
+            BatchJob(os.path.join(source, name), os.path.splitext(name)[0])
+            for name in sorted(os.listdir(source))
+            if name.lower().endswith(".csv")
+        ]
+
+    jobs = []
+    base_folder = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as f:
+        reader = csv.DictReader(f)
+        missing = {"csv_file", "patient_id"} - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"Manifest '{source}' is missing the column(s): {', '.join(sorted(missing))}")
+        for row in reader:
+            csv_file = row["csv_file"].strip()
+            if not os.path.isabs(csv_file):
+                csv_file = os.path.join(base_folder, csv_file)
+            env_file = (row.get("env_file") or "").strip() or None
+            if env_file and not os.path.isabs(env_file):
+                env_file = os.path.join(base_folder, env_file)
+            jobs.append(BatchJob(csv_file, row["patient_id"].strip(), env_file))
+    return jobs
+
+
+def convert_patient_file(job, destination, settings=None):
+    """
+    Converts one file into its patient folder. Errors are returned, not raised,
+    so that one bad file does not stop the batch.
+
+    Args:
+        job (BatchJob): The file, the patient id and the optional .env file of the job.
+        destination (str): Folder that holds the patient folders.
+        settings (Settings): Configuration of the batch, read from the environment when not given.
+
+    Returns:
+        BatchResult: Outcome of the conversion.
+    """
+    start = time.perf_counter()
+    try:
+        output_folder = os.path.join(destination, job.patient_id)
+        os.makedirs(output_folder, exist_ok=True)
+        if job.env_file:
+            settings = load_settings_file(job.env_file)
+        process_patient_data(job.csv_file, job.patient_id, output_folder, settings)
+    except Exception as e:
+        traceback.print_exc()
+        return BatchResult(job.csv_file, job.patient_id, False, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+    return BatchResult(job.csv_file, job.patient_id, True, time.perf_counter() - start, None)
+
+
+def run_batch(jobs, destination, workers=None, settings=None):
+    """
+    Converts the files over a pool of worker processes.
+
+    Args:
+        jobs (list): BatchJob to convert.
+        destination (str): Folder that holds the patient folders.
+        workers (int): Number of worker processes (number of CPUs when not given).
+        settings (Settings): Configuration of the jobs without their own env_file.
+
+    Returns:
+        list: BatchResult of every job, in the order of the jobs.
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_patient_file, job, destination, settings): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job] = future.result()
+            except Exception as e:
+                # The worker itself died (e.g. out of memory)
+                results[job] = BatchResult(job.csv_file, job.patient_id, False, 0.0, f"{type(e).__name__}: {e}")
+    return [results[job] for job in jobs]
+
+
+def print_batch_summary(results):
+    """
+    Prints one line per file and the totals.
+    """
+    for result in results:
+        status = "OK    " if result.success else "FAILED"
+        line = f"{status} {result.csv_file} (patient {result.patient_id}) {result.seconds:.1f}s"
+        if result.error:
+            line += f" - {result.error}"
+        print(line)
+    failed = sum(1 for result in results if not result.success)
+    print(f"{len(results) - failed} file(s) converted, {failed} failed.")
+
+
+def main(argv=None):
+    settings = load_settings()
+    parser = argparse.ArgumentParser(description="Convert many CareLink CSV exports to FHIR bundles.")
+    parser.add_argument("source", help="Folder with CSV files or manifest CSV (columns csv_file, patient_id)")
+    parser.add_argument("--workers", type=int, default=settings.batch_workers or None,
+                        help="Number of worker processes (default: BATCH_WORKERS or the number of CPUs)")
+    parser.add_argument("--destination", default=settings.folder_bundle_destination,
+                        help="Folder for the patient folders (default: FOLDER_BUNDLE_DESTINATION)")
+    args = parser.parse_args(argv)
+
+    jobs = load_batch_jobs(args.source)
+    results = run_batch(jobs, args.destination, args.workers, settings)
+    print_batch_summary(results)
+    return 0 if all(result.success for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""
+Benchmarks of the conversion.
+
+Usage:
+    python benchmark.py serialization [CSV file] [--rows N] [--repeat N]
+    python benchmark.py pipeline [CSV file] [--rows N] [--repeat N]
+
+    Instead of a CSV file, --synthetic-days N converts a synthetic export of N days (see synthetic.py).
+    --save FILE keeps the results in a JSON file, --compare FILE compares them with the results saved by another
+    version (the exit code is 1 when a measure is slower than --threshold percent).
+
+serialization: time of every BUNDLE_SERIALIZER on the bundles of each resource stream, for both emitters,
+with the speedup over "pydantic". The JSON of every serializer is checked against the one of "pydantic".
+
+pipeline: time of every stage of process_patient_data with the current configuration (.env): parse, then for
+every resource stream its generator, create_bundles and serialization over the partitions, and the writing of
+the bundle files, with the rows and resources converted per second.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from bundle_output import BundleWriter
+from carelink import read_medtronic_csv
+from conversion import create_bundles
+from main import load_data_from_environment, resource_streams
+from partitioning import partition_positions
+from serialization import SERIALIZERS, SERIALIZER_AUTO, SERIALIZER_ORJSON, SERIALIZER_PYDANTIC, bundle_serializer, \
+    orjson
+from settings import load_settings
+from synthetic import write_carelink_export
+from utils import bundle_file_path
+
+# Measures slower than this (percent) than the compared results are regressions
+REGRESSION_THRESHOLD = 10.0
+
+
+def best_time(function, repeat):
+    """
+    Returns:
+        tuple: (best time of the runs in seconds, result of the last run).
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_serialization(df, patient_id, settings, repeat=3):
+    """
+    Args:
+        df (pandas.DataFrame): Patient data.
+        patient_id (str): FHIR id of the patient.
+        settings (Settings): Configuration of the conversion.
+        repeat (int): Runs per serializer, the best one is kept.
+
+    Returns:
+        list: One dictionary per (emitter, resource stream, serializer).
+    """
+    serializers = [s for s in SERIALIZERS if s != SERIALIZER_AUTO and (s != SERIALIZER_ORJSON or orjson is not None)]
+    results = []
+    for emitter in ("model", "fast"):
+        emitter_settings = settings.replace(fhir_emitter=emitter)
+        for resource_name, (generator, resource_type) in resource_streams(emitter_settings).items():
+            resources = generator(df, patient_id, emitter_settings)
+            bundles = create_bundles(resources, resource_type, emitter_settings)
+            reference = None
+            for serializer in serializers:
+                serialize = bundle_serializer(serializer)
+                seconds, documents = best_time(lambda: [serialize(bundle) for bundle in bundles], repeat)
+                parsed = [json.loads(document) for document in documents]
+                if serializer == SERIALIZER_PYDANTIC:
+                    reference = (seconds, parsed)
+                elif parsed != reference[1]:
+                    raise AssertionError(f"{serializer} JSON differs from pydantic for {resource_name} ({emitter})")
+                results.append({
+                    "name": f"{emitter}/{resource_name}/{serializer}",
+                    "emitter": emitter,
+                    "stream": resource_name,
+                    "resource_type": resource_type,
+                    "resources": len(resources),
+                    "serializer": serializer,
+                    "seconds": seconds,
+                    "speedup": reference[0] / seconds if seconds else float("inf"),
+                })
+    return results
+
+
+def print_results(results):
+    print(f"{'emitter':8} {'stream':10} {'resource type':26} {'resources':>9} {'serializer':10} "
+          f"{'seconds':>8} {'res/s':>9} {'speedup':>7}")
+    for r in results:
+        rate = r["resources"] / r["seconds"] if r["seconds"] else float("inf")
+        print(f"{r['emitter']:8} {r['stream']:10} {r['resource_type']:26} {r['resources']:9} {r['serializer']:10} "
+              f"{r['seconds']:8.3f} {rate:9.0f} {r['speedup']:6.1f}x")
+
+
+def _stage(name, seconds, rows, resources):
+    return {
+        "name": name,
+        "seconds": seconds,
+        "rows": rows,
+        "resources": resources,
+        "rows_per_second": rows / seconds if seconds else float("inf"),
+        "resources_per_second": resources / seconds if seconds else float("inf"),
+    }
+
+
+def benchmark_pipeline(csv_file, patient_id, settings, repeat=3, rows=0):
+    """
+    Times the stages of the conversion of a file, run like process_patient_data runs them (by partition).
+
+    Args:
+        csv_file (str): CareLink CSV export.
+        patient_id (str): FHIR id of the patient.
+        settings (Settings): Configuration of the conversion.
+        repeat (int): Runs per stage, the best one is kept.
+        rows (int): Only convert the first N rows (0 = all), the parse stage always reads the whole file.
+
+    Returns:
+        list: One dictionary per stage (parse, generate/bundle/serialize of every stream, write, total) with
+            its time, the rows and resources and their rates per second.
+    """
+    seconds, df = best_time(lambda: read_medtronic_csv(csv_file), repeat)
+    results = [_stage("parse", seconds, len(df), 0)]
+    if rows:
+        df = df.iloc[:rows]
+
+    frames = [(partition, df.iloc[positions])
+              for partition, positions in partition_positions(df, settings.partition_granularity,
+                                                              settings.partition_max_rows)]
+    serialize = bundle_serializer(settings.bundle_serializer)
+    documents = []
+    total_resources = 0
+    for resource_name, (generator, resource_type) in resource_streams(settings).items():
+        seconds, resources = best_time(
+            lambda: [generator(frame, patient_id, settings) for _, frame in frames], repeat)
+        count = sum(len(partition_resources) for partition_resources in resources)
+        total_resources += count
+        results.append(_stage(f"generate/{resource_name}", seconds, len(df), count))
+
+        seconds, bundles = best_time(
+            lambda: [create_bundles(partition_resources, resource_type, settings) for partition_resources in resources],
+            repeat)
+        results.append(_stage(f"bundle/{resource_name}", seconds, len(df), count))
+
+        seconds, stream_documents = best_time(
+            lambda: [[serialize(bundle) for bundle in partition_bundles] for partition_bundles in bundles], repeat)
+        results.append(_stage(f"serialize/{resource_name}", seconds, len(df), count))
+        documents += [(resource_name, partition.label, partition_documents)
+                      for (partition, _), partition_documents in zip(frames, stream_documents)]
+
+    def write():
+        # The files go to a temporary folder, without the message of every file
+        with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+            writer = BundleWriter(folder, settings.output_compression, settings.output_archive)
+            for resource_name, label, partition_documents in documents:
+                for part, document in enumerate(partition_documents, start=1):
+                    writer.write(bundle_file_path(folder, resource_name, label, part), document)
+            writer.close()
+
+    seconds, _ = best_time(write, repeat)
+    results.append(_stage("write", seconds, len(df), total_resources))
+    results.append(_stage("total", sum(r["seconds"] for r in results), len(df), total_resources))
+    return results
+
+
+def print_pipeline_results(results):
+    print(f"{'stage':28} {'seconds':>8} {'rows':>9} {'resources':>9} {'rows/s':>10} {'res/s':>10}")
+    for r in results:
+        print(f"{r['name']:28} {r['seconds']:8.3f} {r['rows']:9} {r['resources']:9} "
+              f"{r['rows_per_second']:10.0f} {r['resources_per_second']:10.0f}")
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def save_results(path, suite, results, csv_file, settings):
+    """
+    Saves the results of a suite in a JSON file, with what is needed to compare them with another version.
+    """
+    report = {
+        "suite": suite,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "csv_file": csv_file,
+        "settings": {name: getattr(settings, name) for name in (
+            "fhir_emitter", "bundle_serializer", "output_compression", "partition_granularity", "max_bundle_size")},
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"File '{path}' successfully created.")
+
+
+def compare_results(path, results, threshold=REGRESSION_THRESHOLD):
+    """
+    Prints the change of every measure against the results saved in a file (see save_results).
+
+    Returns:
+        list: Names of the measures slower by more than threshold percent.
+    """
+    with open(path) as f:
+        previous = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    print(f"{'measure':40} {'before':>8} {'now':>8} {'change':>8}")
+    for r in results:
+        before = previous.get(r["name"])
+        if before is None or not before["seconds"]:
+            continue
+        change = (r["seconds"] - before["seconds"]) / before["seconds"] * 100
+        regression = change > threshold
+        if regression:
+            regressions.append(r["name"])
+        print(f"{r['name']:40} {before['seconds']:8.3f} {r['seconds']:8.3f} {change:+7.1f}%"
+              f"{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+def main(argv=None):
+    settings = load_settings()
+    parser = argparse.ArgumentParser(description="Benchmarks of the Medtronic CSV to FHIR conversion.")
+    parser.add_argument("suite", choices=["serialization", "pipeline"])
+    parser.add_argument("csv_file", nargs="?", default=None, help="CareLink CSV export (default: CSV_FILE)")
+    parser.add_argument("--rows", type=int, default=0, help="Only convert the first N rows (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measure, the best one is kept")
+    parser.add_argument("--synthetic-days", type=int, default=0,
+                        help="Convert a synthetic export of N days instead of a CSV file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic export (default: 0)")
+    parser.add_argument("--save", help="Save the results in this JSON file")
+    parser.add_argument("--compare", help="Compare the results with the ones saved in this JSON file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"Percent slower that is a regression (default: {REGRESSION_THRESHOLD:g})")
+    args = parser.parse_args(argv)
+
+    csv_file, patient_id = load_data_from_environment()
+    with tempfile.TemporaryDirectory() as folder:
+        if args.synthetic_days:
+            csv_file = os.path.join(folder, f"synthetic_{args.synthetic_days}_days.csv")
+            write_carelink_export(csv_file, args.synthetic_days, seed=args.seed)
+        else:
+            csv_file = args.csv_file or csv_file
+
+        if args.suite == "serialization":
+            df = read_medtronic_csv(csv_file)
+            if args.rows:
+                df = df.iloc[:args.rows]
+            results = benchmark_serialization(df, patient_id, settings, args.repeat)
+            print_results(results)
+        else:
+            results = benchmark_pipeline(csv_file, patient_id, settings, args.repeat, args.rows)
+            print_pipeline_results(results)
+
+    if args.save:
+        save_results(args.save, args.suite, results,
+                     f"synthetic:{args.synthetic_days}:{args.seed}" if args.synthetic_days else csv_file, settings)
+    if args.compare:
+        return 1 if compare_results(args.compare, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
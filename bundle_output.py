@@ -0,0 +1,232 @@
+"""
+Compressed and archived bundle files.
+
+OUTPUT_COMPRESSION compresses every bundle file ('.json.gz', '.json.lz4' or '.json.zst'), OUTPUT_ARCHIVE packs
+the bundle files of a run into one tar archive (its name can hold strftime codes, e.g. 'bundles_%Y%m%d.tar')
+next to an index ('<archive>.index.json') with the offset and size of every member, so a bundle can be read
+without scanning the archive. In an archive, the members are compressed one by one.
+
+Compression and writing are done by a background thread, overlapping with the conversion.
+"""
+import gzip
+import io
+import json
+import os
+import queue
+import tarfile
+import threading
+import time
+
+try:
+    import lz4.frame
+except ImportError:  # optional, only needed for OUTPUT_COMPRESSION=lz4
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for OUTPUT_COMPRESSION=zstd
+    zstandard = None
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_LZ4 = "lz4"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_LZ4, COMPRESSION_ZSTD)
+
+# Suffix added to the '.json' of the bundle files
+COMPRESSION_EXTENSIONS = {
+    COMPRESSION_NONE: "",
+    COMPRESSION_GZIP: ".gz",
+    COMPRESSION_LZ4: ".lz4",
+    COMPRESSION_ZSTD: ".zst",
+}
+
+# Level 6 compresses JSON almost as well as 9, in half the time
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Bundles waiting for the writer thread, bounds the memory when the disk is slower than the conversion
+WRITE_QUEUE_SIZE = 32
+
+
+def compression_codec(compression):
+    """
+    Args:
+        compression (str): One of COMPRESSIONS.
+
+    Returns:
+        tuple: (compress, decompress) functions on bytes.
+
+    Raises:
+        ValueError: If the compression is unknown or its package is not installed.
+    """
+    if compression == COMPRESSION_NONE:
+        return bytes, bytes
+    if compression == COMPRESSION_GZIP:
+        # mtime=0: the same bundle always gives the same file
+        return lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0), gzip.decompress
+    if compression == COMPRESSION_LZ4:
+        if lz4 is None:
+            raise ValueError("OUTPUT_COMPRESSION 'lz4' needs the lz4 package (pip install lz4)")
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("OUTPUT_COMPRESSION 'zstd' needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f"Unknown output compression '{compression}', expected one of {COMPRESSIONS}")
+
+
+def read_bundle_file(path):
+    """
+    Returns:
+        bytes: JSON of a bundle file, decompressed according to its extension.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if extension and path.endswith(extension):
+            return compression_codec(compression)[1](data)
+    return data
+
+
+class BundleWriter:
+    """
+    Writes bundle files, compressed and/or archived, from a background thread.
+
+    Args:
+        folder (str): Destination folder.
+        compression (str): One of COMPRESSIONS.
+        archive_name (str): Name of the tar archive in the folder (strftime codes are replaced), empty for files.
+        background (bool): Write from a thread, otherwise write() does the work itself.
+        verbose (bool): Print a message for every file created (FILE_MESSAGES).
+    """
+
+    def __init__(self, folder, compression=COMPRESSION_NONE, archive_name="", background=True, verbose=True):
+        self.folder = folder
+        self.compression = compression
+        self.archive_name = time.strftime(archive_name) if archive_name else ""
+        self.background = background
+        self.verbose = verbose
+        self.extension = COMPRESSION_EXTENSIONS[compression]
+        self._compress, self._decompress = compression_codec(compression)
+        # Called with (path, JSON) once a bundle is stored, e.g. FhirUploader.submit
+        self.listener = None
+        # Worker processes cannot share the archive, they keep the (path, compressed data) for the main process
+        self.collected = None
+        self.file_paths = []
+        # Bytes of the files (or archive members) stored, after compression
+        self.bytes_written = 0
+        self._archive = None
+        self._index = {}
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def for_worker(self):
+        """
+        Returns:
+            BundleWriter: Writer for a worker process, which writes its files itself and collects the archive members.
+        """
+        writer = BundleWriter(self.folder, self.compression, background=False, verbose=self.verbose)
+        if self.archive_name:
+            writer.collected = []
+        return writer
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.folder, self.archive_name) if self.archive_name else None
+
+    def write(self, file_path, bundle_json):
+        """
+        Queues a bundle file.
+
+        Args:
+            file_path (str): Path of the uncompressed file, see utils.bundle_file_path.
+            bundle_json (str): JSON of the bundle.
+
+        Returns:
+            str: Path of the file written, or of the member in the archive.
+        """
+        return self._put(file_path + self.extension, bundle_json, None)
+
+    def add(self, file_path, data):
+        """
+        Queues an already compressed bundle (collected by a worker process).
+        """
+        return self._put(file_path, None, data)
+
+    def _put(self, file_path, bundle_json, data):
+        if self._error is not None:
+            raise self._error
+        if self.collected is not None:
+            self.collected.append((file_path, self._compress(bundle_json.encode())))
+        elif not self.background:
+            self._store(file_path, bundle_json, data)
+        else:
+            if self._thread is None:
+                self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+                self._thread = threading.Thread(target=self._run, name="bundle-writer", daemon=True)
+                self._thread.start()
+            self._queue.put((file_path, bundle_json, data))
+        return file_path
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    self._store(*item)
+                except Exception as e:
+                    # Raised in the conversion by the next write() or close()
+                    self._error = e
+
+    def _store(self, file_path, bundle_json, data):
+        if data is None:
+            data = self._compress(bundle_json.encode())
+        if self.archive_name:
+            if self._archive is None:
+                self._archive = tarfile.open(self.archive_path, "w")
+            member = tarfile.TarInfo(os.path.basename(file_path))
+            member.size = len(data)
+            member.mtime = int(time.time())
+            self._archive.addfile(member, io.BytesIO(data))
+            # The data ends where the archive is now, before the padding to 512 bytes
+            self._index[member.name] = {
+                "offset": self._archive.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE,
+                "size": len(data),
+            }
+        else:
+            with open(file_path, "wb") as f:
+                f.write(data)
+            if self.verbose:
+                print(f"File '{file_path}' successfully created.")
+        self.bytes_written += len(data)
+        self.file_paths.append(file_path)
+        if self.listener is not None:
+            self.listener(file_path, bundle_json if bundle_json is not None else self._decompress(data))
+
+    def close(self):
+        """
+        Waits for the queued bundles and closes the archive, writing its index.
+
+        Returns:
+            list: Paths of the files written (or of the members of the archive).
+
+        Raises:
+            Exception: The error of a write done in the background.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            with open(self.archive_path + ".index.json", "w") as f:
+                json.dump({"compression": self.compression, "members": self._index}, f, indent=1)
+            print(f"File '{self.archive_path}' successfully created ({len(self._index)} bundle(s)).")
+        if self._error is not None:
+            raise self._error
+        return self.file_paths
@@ -0,0 +1,350 @@
+"""
+Reading of the CareLink CSV exports.
+
+An export starts with a patient header (two lines: names, export period, devices), then holds one section per device
+and kind of data, each introduced by a separator line ('-------;MiniMed 780G MMT-1885;Pump;NG1234567H;-------')
+followed by its column header. scan_carelink_file indexes the sections in one pass over the file, then every section
+is parsed on its own, from its byte range.
+"""
+import csv
+import io
+import mmap
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utils import column_to_float
+
+# Lines before the column header of the pump section, in files without section separator
+CSV_SKIP_ROWS = 6
+CSV_SEPARATOR = ';'
+# Start of the separator line of a section
+SECTION_MARKER = b'-------;'
+# Version of the parsing done by read_medtronic_csv, increase it when the parsed frame changes (see parse_cache.py)
+PARSER_VERSION = 3
+
+# A device section: the device, the kind of data ('Pump', 'Sensor'), the serial number, the column names
+# and the byte range of its rows in the file
+CarelinkSection = namedtuple("CarelinkSection", ["device", "kind", "serial", "columns", "start", "end"])
+# Index of an export: the patient header fields (see read_carelink_header), the devices and the sections
+CarelinkExport = namedtuple("CarelinkExport", ["header", "devices", "sections"])
+
+# Columns read from the exports, by name prefix (the units in the names depend on the settings of the export).
+# The other columns (Prime, Alarm, Sensor Calibration, ...) are not used by the conversion and are not read.
+# Numbers, written with decimal commas, are parsed as float64
+CSV_FLOAT_COLUMNS = ('BG Reading', 'Sensor Glucose', 'Basal Rate', 'Temp Basal Amount', 'Bolus Volume Delivered',
+                     'BWZ Carb Ratio', 'BWZ Food Estimate')
+# Text columns, kept as written
+CSV_TEXT_COLUMNS = ('Index', 'Date', 'Time', 'BG Source', 'Temp Basal Type', 'Temp Basal Duration', 'Bolus Type',
+                    'Bolus Duration', 'Bolus Source')
+# Numbers kept as text, with a decimal point: the carbohydrate identifiers are computed from the value as written
+CSV_DECIMAL_TEXT_COLUMNS = ('BWZ Carb Input',)
+
+
+def csv_column_dtype(name):
+    """
+    Returns:
+        The dtype a CareLink column is read with ('float64' or str), None for a column that is not read.
+    """
+    if name.startswith(CSV_FLOAT_COLUMNS):
+        return 'float64'
+    if name.startswith(CSV_TEXT_COLUMNS + CSV_DECIMAL_TEXT_COLUMNS):
+        return str
+    return None
+
+
+def csv_read_options(section):
+    """
+    Arguments of pandas.read_csv for the rows of a section: the columns used and their dtypes.
+
+    Args:
+        section (CarelinkSection): The section.
+
+    Returns:
+        dict: Keyword arguments of pandas.read_csv.
+    """
+    dtypes = {name: csv_column_dtype(name) for name in section.columns if csv_column_dtype(name) is not None}
+    return dict(sep=CSV_SEPARATOR, header=None, names=section.columns, index_col='Index' if 'Index' in dtypes else None,
+                usecols=list(dtypes), dtype=dtypes, decimal=',')
+
+
+def normalize_medtronic_columns(df, float_columns=()):
+    """
+    Decimal handling of the columns that the parser left as text.
+
+    Args:
+        df (pandas.DataFrame): Rows as read with csv_read_options.
+        float_columns (list): Number columns read as text, converted to float64 (values that are not numbers become NaN).
+
+    Returns:
+        pandas.DataFrame: The rows, with decimal points in the CSV_DECIMAL_TEXT_COLUMNS.
+    """
+    for name in float_columns:
+        df[name] = column_to_float(df[name])
+    for name in df.columns:
+        if name.startswith(CSV_DECIMAL_TEXT_COLUMNS):
+            df[name] = df[name].str.replace(',', '.', regex=False)
+    return df
+
+
+def prepare_medtronic_frame(df):
+    """
+    Parses the 'Date' and 'Time' columns of CareLink rows and adds the 'Timestamp' column.
+
+    Args:
+        df (pandas.DataFrame): Rows as read from the CSV.
+
+    Returns:
+        pandas.DataFrame: The rows with a valid date, with 'Date', 'Time' and 'Timestamp' parsed.
+    """
+    # Convert 'Date' column to datetime objects with a specific format
+    df['Date'] = pd.to_datetime(df['Date'], format='%Y/%m/%d', errors='coerce')
+
+    # Drop rows with NaT (not a time) values in the 'Date' column
+    df.dropna(subset=['Date'], inplace=True)
+    df['Time'] = pd.to_timedelta(df['Time'])
+
+    # Merge 'Date' and 'Time' columns into a single datetime column 'Timestamp'
+    df['Timestamp'] = df['Date'] + df['Time']
+    return df
+
+
+def _split_line(line):
+    return next(csv.reader([line], delimiter=CSV_SEPARATOR), [])
+
+
+def parse_carelink_header(names_line, values_line):
+    """
+    Parses the patient header of an export.
+
+    Args:
+        names_line (str): First line ('Last Name;First Name;Patient ID;...;Device;MiniMed 780G MMT-1885;Hardware Version;...').
+        values_line (str): Second line, the values of the patient fields.
+
+    Returns:
+        tuple: The patient fields before 'Device' (dict, e.g. 'Start Date' -> '14.11.2023 00:00:00') and the devices
+            (list of dicts with the 'name' and the '... Version' fields of every device).
+    """
+    names, values = _split_line(names_line), _split_line(values_line)
+    header = {}
+    devices = []
+    for i, name in enumerate(names):
+        if name == 'Device':
+            # Device names, each followed by '<...> Version;<value>' pairs
+            fields = [field.strip() for field in names[i + 1:]]
+            j = 0
+            while j < len(fields):
+                if fields[j].endswith('Version') and devices:
+                    devices[-1][fields[j]] = fields[j + 1] if j + 1 < len(fields) else ''
+                    j += 2
+                else:
+                    if fields[j]:
+                        devices.append({'name': fields[j]})
+                    j += 1
+            break
+        header[name] = values[i] if i < len(values) else ''
+    return header, devices
+
+
+def read_carelink_header(csv_file):
+    """
+    Returns:
+        tuple: The patient fields and the devices of the header of an export, see parse_carelink_header.
+    """
+    with open(csv_file, encoding='utf-8-sig', newline='') as f:
+        return parse_carelink_header(f.readline(), f.readline())
+
+
+def read_export_period(csv_file):
+    """
+    Reads the 'Start Date' and 'End Date' of the export from the patient header of a CareLink CSV.
+
+    Args:
+        csv_file (str): Path of the CSV file.
+
+    Returns:
+        tuple: Start and end (pandas.Timestamp), None for a date that is missing or cannot be parsed.
+    """
+    header, _ = read_carelink_header(csv_file)
+    period = [pd.to_datetime(header.get(name), format='%d.%m.%Y %H:%M:%S', errors='coerce')
+              for name in ('Start Date', 'End Date')]
+    return tuple(None if pd.isna(date) else date for date in period)
+
+
+def _parse_columns(line):
+    # pandas names the columns of the rows, duplicated names get the same suffixes as in a normal read
+    return pd.read_csv(io.StringIO(line), sep=CSV_SEPARATOR, nrows=0).columns.tolist()
+
+
+def scan_carelink_file(csv_file):
+    """
+    Indexes an export in one pass: the patient header, and the byte range, device and columns of every section.
+    Files without section separator are one section whose column header is line CSV_SKIP_ROWS + 1.
+
+    Args:
+        csv_file (str): Path of the CSV file.
+
+    Returns:
+        CarelinkExport: The index of the export.
+    """
+    with open(csv_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return CarelinkExport({}, [], [])
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            def line_end(start):
+                end = mm.find(b'\n', start)
+                return len(mm) if end == -1 else end + 1
+
+            def line(start, end):
+                return mm[start:end].decode('utf-8-sig').rstrip('\r\n')
+
+            second = line_end(0)
+            header, devices = parse_carelink_header(line(0, second), line(second, line_end(second)))
+
+            markers = []
+            position = mm.find(SECTION_MARKER)
+            while position != -1:
+                if position == 0 or mm[position - 1] == ord('\n'):
+                    markers.append(position)
+                position = mm.find(SECTION_MARKER, position + 1)
+
+            sections = []
+            if not markers:
+                columns_start = 0
+                for _ in range(CSV_SKIP_ROWS):
+                    columns_start = line_end(columns_start)
+                columns_end = line_end(columns_start)
+                sections.append(CarelinkSection(None, None, None, _parse_columns(line(columns_start, columns_end)),
+                                                columns_end, len(mm)))
+            for marker, next_marker in zip(markers, markers[1:] + [len(mm)]):
+                columns_start = line_end(marker)
+                columns_end = line_end(columns_start)
+                fields = _split_line(line(marker, columns_start)) + [None] * 4
+                sections.append(CarelinkSection(fields[1], fields[2], fields[3],
+                                                _parse_columns(line(columns_start, columns_end)),
+                                                min(columns_end, next_marker), next_marker))
+    return CarelinkExport(header, devices, sections)
+
+
+class _ByteRange(io.RawIOBase):
+    """
+    Read-only file object over a byte range of a file, so a section is parsed without copying it.
+    """
+
+    def __init__(self, path, start, end):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        count = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= count
+        return count
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_section(csv_file, section):
+    """
+    Returns:
+        io.BufferedReader: The rows of a section, as a binary file.
+    """
+    return io.BufferedReader(_ByteRange(csv_file, section.start, section.end), buffer_size=1 << 20)
+
+
+def export_columns(sections):
+    """
+    Returns:
+        list: The columns read from the sections (see csv_read_options), in the order they first appear.
+    """
+    columns = {}
+    for section in sections:
+        options = csv_read_options(section)
+        columns.update(dict.fromkeys(name for name in options['usecols'] if name != options['index_col']))
+    return list(columns)
+
+
+def read_section(csv_file, section):
+    """
+    Parses the rows of one section (see csv_read_options and normalize_medtronic_columns).
+
+    Returns:
+        pandas.DataFrame: The rows, before prepare_medtronic_frame.
+    """
+    options = csv_read_options(section)
+    float_columns = [name for name, dtype in options['dtype'].items() if dtype == 'float64']
+    try:
+        with open_section(csv_file, section) as f:
+            return normalize_medtronic_columns(pd.read_csv(f, **options))
+    except ValueError:
+        # Text in a number column: the numbers are read as text and converted afterwards
+        options['dtype'] = dict.fromkeys(options['dtype'], str)
+        with open_section(csv_file, section) as f:
+            return normalize_medtronic_columns(pd.read_csv(f, **options), float_columns)
+
+
+def read_medtronic_csv(csv_file, parse_cache=None):
+    """
+    Reads a whole CareLink CSV export: the sections are indexed (see scan_carelink_file), parsed in parallel
+    threads and put together in the order of the file.
+
+    Args:
+        csv_file (str): Path of the CSV file.
+        parse_cache (ParseCache): Cache of the parsed frames (see parse_cache.py), the file is always parsed when not given.
+
+    Returns:
+        pandas.DataFrame: The parsed rows (see prepare_medtronic_frame).
+    """
+    if parse_cache is not None:
+        df = parse_cache.load(csv_file)
+        if df is not None:
+            return df
+    sections = [section for section in scan_carelink_file(csv_file).sections if section.end > section.start]
+    if not sections:
+        raise ValueError(f"No CareLink data in '{csv_file}'")
+    if len(sections) == 1:
+        df = read_section(csv_file, sections[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(sections), os.cpu_count() or 1)) as executor:
+            df = pd.concat(list(executor.map(lambda section: read_section(csv_file, section), sections)))
+    df = prepare_medtronic_frame(df)
+    if parse_cache is not None:
+        parse_cache.store(csv_file, df)
+    return df
+
+
+def iter_medtronic_csv(csv_file, chunk_size):
+    """
+    Reads a CareLink CSV export in chunks, section after section, so that memory is bounded by the chunk size.
+
+    Args:
+        csv_file (str): Path of the CSV file.
+        chunk_size (int): Number of CSV rows per chunk.
+
+    Yields:
+        pandas.DataFrame: The parsed rows of each chunk (see prepare_medtronic_frame).
+    """
+    sections = scan_carelink_file(csv_file).sections
+    # Every chunk has the columns of all the sections, like the frame of read_medtronic_csv
+    columns = export_columns(sections)
+    for section in sections:
+        options = csv_read_options(section)
+        float_columns = [name for name, dtype in options['dtype'].items() if dtype == 'float64']
+        # The numbers are read as text: a bad value in a late chunk cannot fall back to it
+        options['dtype'] = dict.fromkeys(options['dtype'], str)
+        with open_section(csv_file, section) as f, pd.read_csv(f, chunksize=chunk_size, **options) as reader:
+            for chunk in reader:
+                chunk = prepare_medtronic_frame(normalize_medtronic_columns(chunk, float_columns).reindex(columns=columns))
+                if not chunk.empty:
+                    yield chunk
@@ -1,73 +1,63 @@
 import math
-import os
 from datetime import datetime
 import numpy as np
+import pandas as pd
 
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
 from fhir.resources.medicationadministration import MedicationAdministration
 from fhir.resources.observation import Observation
 
-from utils import generate_unique_identifier
+from emitter import emit_resource, emit_resources, create_fast_bundle, EMITTER_FAST, BUNDLE_OVERHEAD, \
+    estimate_entry_size, render_resource
+from partitioning import partition_of
+from serialization import json_dumps_function
+from settings import get_settings
+from utils import generate_unique_identifier, generate_unique_identifiers
 
-from utils import replace_commas_with_periods
+from utils import column_to_float
 
 
-def generate_glucose_fhir_interpretation(glucose_value, unit):
-    interpretation = [
-        {
-            "coding": [
-                {
-                    "system": os.getenv("GLUCOSE_INTERPRETATION_SYSTEM", "http://loinc.org"),
-                    "code": os.getenv("GLUCOSE_INTERPRETATION_CODE", "LA6576-8"),
-                    "display": os.getenv("GLUCOSE_INTERPRETATION_DISPLAY", "Glucose interpretation")
-                }
-            ]
-        }
-    ]
-
-    value_map = {
-        "mmol": {
-            "LU": float(os.getenv("GLUCOSE_INTERPRETATION_LU_MMOL", 3)),
-            "L": float(os.getenv("GLUCOSE_INTERPRETATION_L_MMOL", 3.9)),
-            "N": float(os.getenv("GLUCOSE_INTERPRETATION_H_MMOL", 10)),
-            "H": float(os.getenv("GLUCOSE_INTERPRETATION_HU_MMOL", 13.9)),
-            "HU": float(os.getenv("GLUCOSE_INTERPRETATION_HU_MMOL", 13.9))
-        },
-        "mg": {
-            "LU": float(os.getenv("GLUCOSE_INTERPRETATION_LU_MG", 54)),
-            "L": float(os.getenv("GLUCOSE_INTERPRETATION_L_MG", 70)),
-            "N": float(os.getenv("GLUCOSE_INTERPRETATION_H_MG", 180)),
-            "H": float(os.getenv("GLUCOSE_INTERPRETATION_HU_MG", 250)),
-            "HU": float(os.getenv("GLUCOSE_INTERPRETATION_HU_MG", 250))
-        }
-    }
+def generate_glucose_fhir_interpretation(glucose_value, unit, settings=None):
+    """
+    Args:
+        glucose_value (float): Glucose value.
+        unit (str): 'mmol' or 'mg'.
+        settings (Settings): Configuration, the environment settings when not given.
 
-    ranges = value_map[unit]
+    Returns:
+        list: FHIR interpretation of the value (LU, L, N, H or HU).
+    """
+    settings = settings or get_settings()
+    coding = settings.glucose_interpretation.interpret(glucose_value, unit)
+    return [{"coding": [coding.dict()]}]
 
-    for code, threshold in ranges.items():
-        if glucose_value <= threshold:
-            interpretation[0]['coding'][0]['code'] = os.getenv(f"GLUCOSE_INTERPRETATION_{code}_CODE", code)
-            interpretation[0]['coding'][0]['display'] = os.getenv(f"GLUCOSE_INTERPRETATION_{code}_DISPLAY", code)
-            break  # Stop checking further thresholds once the condition is met
 
-    return interpretation
+def glucose_interpretation_unit(scale, settings):
+    """
+    Returns:
+        str: 'mmol' or 'mg', the unit of the interpretation thresholds for a glucose scale.
+    """
+    return "mmol" if scale.lower() == settings.glucose_scale_mmol.lower() else "mg"
 
 
 # we can create either a CGM OR BG GLUCOSE OBSERVATION
-def create_glucose_observation_json(value, scale, timestamp, patient_id, code, scale_display):
+def create_glucose_observation_json(value, scale, timestamp, patient_id, code, scale_display, settings=None,
+                                    unique_id=None, interpretation=None):
+    settings = settings or get_settings()
     narrative = "<div xmlns=\"http://www.w3.org/1999/xhtml\">Glucose " + scale_display + " in Body Fluid</div>"
 
-    # todo, intepretation depends on the user version, removed in this case
-    # "interpretation": interpretation,
-    # if scale.lower() == os.getenv("GLUCOSE_SCALE_MMOL", "mmol/l").lower():
-    #     interpretation = generate_glucose_fhir_interpretation(value, "mmol")
-    # else:
-    #     interpretation = generate_glucose_fhir_interpretation(value, "mg")
+    # The interpretation depends on the thresholds of the user, only added with GLUCOSE_INTERPRETATION_ENABLED
+    if interpretation is None and settings.glucose_interpretation.enabled:
+        interpretation = generate_glucose_fhir_interpretation(value, glucose_interpretation_unit(scale, settings),
+                                                              settings)
 
-    unique_id = generate_unique_identifier(["Glucose", patient_id, timestamp, value, code])
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["Glucose", patient_id, timestamp, value, code],
+                                               settings.identifier_hash)
 
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    ID_SYSTEM = settings.id_system
     json_obj = {
+        "resourceType": "Observation",
         "status": "final",
         "identifier": [{
             "system": ID_SYSTEM,  # Replace with your system identifier
@@ -88,19 +78,52 @@ def create_glucose_observation_json(value, scale, timestamp, patient_id, code, s
             "div": narrative
         }
     }
+    if interpretation is not None:
+        json_obj["interpretation"] = interpretation
 
     return json_obj
 
 
-def create_glucose_observation(value, scale, timestamp, patient_id, scale_code, scale_display):
-    json_obj = create_glucose_observation_json(value, scale, timestamp, patient_id, scale_code, scale_display)
-    return Observation.parse_obj(json_obj)
+def create_glucose_observation(value, scale, timestamp, patient_id, scale_code, scale_display, settings=None):
+    json_obj = create_glucose_observation_json(value, scale, timestamp, patient_id, scale_code, scale_display,
+                                               settings)
+    return emit_resource(json_obj, Observation, settings)
 
 
-def generate_medtronic_glucose_observation(df_original, patient_id):
-    # Create a copy of the input DataFrame
-    df = df_original.copy()
+def resample_cgm_readings(times, values, use_bg, interval, aggregation):
+    """
+    Replaces the sensor readings by one reading per time interval (CGM_RESAMPLE_INTERVAL), the manual BG
+    readings are kept as they are.
 
+    Args:
+        times (pandas.Series): Timestamps of the readings.
+        values (numpy.ndarray): Glucose values.
+        use_bg (numpy.ndarray): True for the manual BG readings.
+        interval (str): pandas interval, e.g. '15min' or '1h'.
+        aggregation (str): 'mean', 'min', 'max' or 'last' (the latest reading of the interval).
+
+    Returns:
+        tuple: (times, values, use_bg) of the readings, in time order. A resampled reading has the start of its
+            interval as timestamp.
+    """
+    times = times.to_numpy()
+    sensor = ~use_bg
+    sensor_values = pd.Series(values[sensor], index=pd.DatetimeIndex(times[sensor]))
+    # Stable sort, so 'last' is the latest reading even when the rows are not in time order
+    sensor_values = sensor_values.sort_index(kind="stable")
+    resampled = sensor_values.groupby(sensor_values.index.floor(interval), sort=True).agg(aggregation)
+    if aggregation == "mean":
+        resampled = resampled.round(2)
+
+    times = np.concatenate([times[use_bg], resampled.index.to_numpy()])
+    values = np.concatenate([values[use_bg], resampled.to_numpy()])
+    use_bg = np.concatenate([np.ones(int(use_bg.sum()), dtype=bool), np.zeros(len(resampled), dtype=bool)])
+    order = np.argsort(times, kind="stable")
+    return pd.Series(times[order]), values[order], use_bg[order]
+
+
+def generate_medtronic_glucose_observation(df_original, patient_id, settings=None):
+    settings = settings or get_settings()
     observations = []
 
     scale_cgm, scale_code_cgm, scale_display_cgm = "", "", ""
@@ -109,86 +132,236 @@ def generate_medtronic_glucose_observation(df_original, patient_id):
     # identify based on Medtronic description the variables
     # todo add the ('Sensor Glucose') as a global variable
 
-    cols_with_cgm_glucose = df.columns[df.columns.str.contains('Sensor Glucose')]
-    #cols_with_cgm_glucose = [col for col in df.columns if df[col].dtype == 'object' and col.startswith('Sensor Glucose')]
-
-    cols_with_bg_glucose = df.columns[df.columns.str.contains('BG Reading')]
-    #cols_with_bg_glucose = [col for col in df.columns if df[col].dtype == 'object' and col.startswith('BG Reading')]
+    cols_with_cgm_glucose = df_original.columns[df_original.columns.str.contains('Sensor Glucose')]
+    cols_with_bg_glucose = df_original.columns[df_original.columns.str.contains('BG Reading')]
 
     if len(cols_with_cgm_glucose) != 0:
         for col in cols_with_cgm_glucose:
             # We assume 2 units only
             if "mmol/L" in col:
-                scale_cgm = os.getenv("GLUCOSE_SCALE_MMOL", "mmol/L")
-                scale_display_cgm = os.getenv("GLUCOSE_SCALE_MMOL_DISPLAY", "[Moles/volume]")
-                scale_code_cgm = os.getenv("CGM_GLUCOSE_CODE", "14745-4")
+                scale_cgm = settings.glucose_scale_mmol
+                scale_display_cgm = settings.glucose_scale_mmol_display
             else:
-                scale_cgm = os.getenv("GLUCOSE_SCALE_MG", "mg/dL")
-                scale_display_cgm = os.getenv("GLUCOSE_SCALE_MG_DISPLAY", "[Milligrams per deciliter]")
-                scale_code_cgm = os.getenv("CGM_GLUCOSE_CODE", "14745-4")
+                scale_cgm = settings.glucose_scale_mg
+                scale_display_cgm = settings.glucose_scale_mg_display
+            scale_code_cgm = settings.cgm_glucose_code
 
     if len(cols_with_bg_glucose) != 0:
         for col in cols_with_bg_glucose:
             if "mmol/L" in col:
-                scale_bg = os.getenv("GLUCOSE_SCALE_MMOL", "mmol/L")
-                scale_display_bg = os.getenv("GLUCOSE_SCALE_MMOL_DISPLAY", "[Moles/volume]")
-                scale_code_bg = os.getenv("BG_GLUCOSE_CODE", "41653-7")
+                scale_bg = settings.glucose_scale_mmol
+                scale_display_bg = settings.glucose_scale_mmol_display
             else:
-                scale_bg = os.getenv("GLUCOSE_SCALE_MG", "mg/dL")
-                scale_display_bg = os.getenv("GLUCOSE_SCALE_MG_DISPLAY", "[Milligrams per deciliter]")
-                scale_code_bg = os.getenv("BG_GLUCOSE_CODE", "41653-7")
+                scale_bg = settings.glucose_scale_mg
+                scale_display_bg = settings.glucose_scale_mg_display
+            scale_code_bg = settings.bg_glucose_code
 
     if len(cols_with_cgm_glucose) == 0 and len(cols_with_bg_glucose) == 0:
         return observations
 
-    # Merge the two index arrays into a single array
-    columns_to_check = np.concatenate([cols_with_cgm_glucose, cols_with_bg_glucose])
+    # Work on whole columns: the first column of each kind carries the value (as in the CSV layout)
+    if len(cols_with_cgm_glucose) != 0:
+        cgm_values = column_to_float(df_original[cols_with_cgm_glucose[0]])
+        has_cgm = df_original[cols_with_cgm_glucose].notna().any(axis=1)
+    else:
+        cgm_values = pd.Series(np.nan, index=df_original.index)
+        has_cgm = pd.Series(False, index=df_original.index)
+    if len(cols_with_bg_glucose) != 0:
+        bg_values = column_to_float(df_original[cols_with_bg_glucose[0]])
+        has_bg = df_original[cols_with_bg_glucose].notna().any(axis=1)
+    else:
+        bg_values = pd.Series(np.nan, index=df_original.index)
+        has_bg = pd.Series(False, index=df_original.index)
 
-    # Drop rows where all columns in columns_to_check are NaN
-    df.dropna(subset=columns_to_check, how='all', inplace=True)
+    # We can assume that the only relevant value is the BG_READIN_RECEIVED
+    bg_received = df_original['BG Source'] == settings.bg_readin_received
+    selected = ((bg_received & has_bg) | has_cgm).to_numpy()
+
+    # A manual BG reading wins over the sensor value of the same row
+    use_bg = bg_values.notna().to_numpy()[selected]
+    values = np.where(use_bg, bg_values.to_numpy()[selected], cgm_values.to_numpy()[selected])
+    # Rows without a number in the value column (empty, or text that is not a number) are skipped; the row loop
+    # this replaced failed on them (ValueError from float(), or a ValidationError for a NaN valueQuantity)
+    valid = ~np.isnan(values)
+    use_bg = use_bg[valid]
+    values = values[valid]
+    times = df_original['Timestamp'][selected][valid]
+    if settings.cgm_resample_interval:
+        times, values, use_bg = resample_cgm_readings(times, values, use_bg, settings.cgm_resample_interval,
+                                                      settings.cgm_resample_aggregation)
+
+    timestamps = times.dt.strftime(settings.timestamp_format).tolist()
+
+    # Interpretation of all the values at once: one binary search per value in the thresholds of its unit
+    interpretation = settings.glucose_interpretation
+    if interpretation.enabled:
+        code_indexes = np.where(
+            use_bg,
+            interpretation.interpret_values(values, glucose_interpretation_unit(scale_bg or scale_cgm, settings)),
+            interpretation.interpret_values(values, glucose_interpretation_unit(scale_cgm or scale_bg, settings))
+        ).tolist()
+        # One interpretation element per code, shared by the Observations with that code
+        interpretations = [[{"coding": [coding.dict()]}] for coding in interpretation.codes]
+        interpretations = [interpretations[i] for i in code_indexes]
+    else:
+        interpretations = [None] * len(values)
+
+    cgm_scale = (scale_cgm, scale_code_cgm, scale_display_cgm)
+    bg_scale = (scale_bg, scale_code_bg, scale_display_bg)
+    values = values.tolist()
+    use_bg = use_bg.tolist()
+    codes = [scale_code_bg if is_bg else scale_code_cgm for is_bg in use_bg]
+    unique_ids = generate_unique_identifiers(["Glucose", patient_id], zip(timestamps, values, codes),
+                                             settings.identifier_hash)
+    json_objs = []
+    for value, timestamp, is_bg, unique_id, value_interpretation in zip(values, timestamps, use_bg, unique_ids,
+                                                                          interpretations):
+        scale, scale_code, scale_display = bg_scale if is_bg else cgm_scale
+        json_objs.append(
+            create_glucose_observation_json(value, scale, timestamp, patient_id, scale_code, scale_display, settings,
+                                            unique_id, value_interpretation)
+        )
 
-    # Apply the function only to specific columns in the DataFrame to avoid float issues
-    df[columns_to_check] = df[columns_to_check].apply(replace_commas_with_periods)
+    return emit_resources(json_objs, Observation, settings)
 
-    # Filter rows based on conditions
-    # We can assume that the only relevant value is the BG_READIN_RECEIVED
-    df = df[
-        ((df['BG Source'] == os.getenv("MEDTRONIC_BG_READIN_RECEIVED", "BG_READIN_RECEIVED")) & (
-            df[cols_with_bg_glucose].notna().any(axis=1))) |
-        (df[cols_with_cgm_glucose].notna().any(axis=1))
-        ]
 
-    # Apply the function only to specific columns in the DataFrame to avoid float issues
-    df[cols_with_cgm_glucose] = df[cols_with_cgm_glucose].applymap(replace_commas_with_periods)
-    df[cols_with_bg_glucose] = df[cols_with_bg_glucose].applymap(replace_commas_with_periods)
+#### Block CGM summary:
+# Aggregates of the sensor glucose of a partition (a week by default), so that consumers read one Observation
+# instead of every reading: time in the glucose ranges of the interpretation thresholds (very low to very high),
+# mean glucose, glucose management indicator (GMI) and coefficient of variation (CV).
 
-    # df now contains the filtered and modified DataFrame
-    for _, row in df.iloc[0:].iterrows():
+# mg/dL per mmol/L of glucose
+GLUCOSE_MG_PER_MMOL = 18.016
+UCUM_SYSTEM = "http://unitsofmeasure.org"
 
-        if len(cols_with_cgm_glucose) != 0:
-            cgm_value = float(row[cols_with_cgm_glucose].iloc[0])
-        else:
-            cgm_value = math.nan
-        if len(cols_with_bg_glucose) != 0:
-            bg_value = float(row[cols_with_bg_glucose].iloc[0])
-        else:
-            bg_value = math.nan
 
-        timestamp = row['Timestamp']
+def glucose_summary_metrics(values, unit, settings=None):
+    """
+    Args:
+        values (numpy.ndarray): Sensor glucose values, without NaN.
+        unit (str): 'mmol' or 'mg'.
+        settings (Settings): Configuration, the environment settings when not given.
+
+    Returns:
+        dict: Number of readings, mean, GMI (%), CV (%) and the percentage of the readings in every range of
+            the interpretation codes (LU, L, N, H, HU).
+    """
+    settings = settings or get_settings()
+    interpretation = settings.glucose_interpretation
+    count = len(values)
+    mean = float(values.mean())
+    sd = float(values.std(ddof=1)) if count > 1 else 0.0
+    mean_mg = mean * GLUCOSE_MG_PER_MMOL if unit == "mmol" else mean
+    in_ranges = np.bincount(interpretation.interpret_values(values, unit), minlength=len(interpretation.codes))
+    return {
+        "readings": count,
+        "mean": mean,
+        # Bergenstal et al. 2018: GMI (%) = 3.31 + 0.02392 x mean glucose (mg/dL)
+        "gmi": 3.31 + 0.02392 * mean_mg,
+        "cv": sd / mean * 100 if mean else 0.0,
+        "ranges": (in_ranges * 100 / count).tolist(),
+    }
+
+
+def create_glucose_summary_json(metrics, scale, unit, start, end, patient_id, settings=None, unique_id=None):
+    """
+    Args:
+        metrics (dict): See glucose_summary_metrics.
+        scale (str): Unit of the glucose values (e.g. mmol/L).
+        unit (str): 'mmol' or 'mg'.
+        start (str): Timestamp of the first reading.
+        end (str): Timestamp of the last reading.
+        patient_id (str): FHIR id of the patient.
+        settings (Settings): Configuration, the environment settings when not given.
+        unique_id (str): Identifier of the summary, the one of its first reading when not given
+            (see generate_medtronic_glucose_summary).
+
+    Returns:
+        dict: Observation with one component per metric, its logical id is the identifier: a summary
+            computed again over more readings replaces the earlier one.
+    """
+    settings = settings or get_settings()
+    summary = settings.glucose_summary
+
+    def percent(value):
+        return {"value": round(value, 2), "unit": "%", "system": UCUM_SYSTEM, "code": "%"}
+
+    mean = round(metrics["mean"], 2)
+    components = [{"code": {"coding": [(summary.mean_mmol if unit == "mmol" else summary.mean_mg).dict()]},
+                   "valueQuantity": {"value": mean, "unit": scale}}]
+    components += [{"code": {"coding": [coding.dict()]}, "valueQuantity": percent(value)}
+                   for coding, value in zip(summary.ranges, metrics["ranges"])]
+    components.append({"code": {"coding": [summary.gmi.dict()]}, "valueQuantity": percent(metrics["gmi"])})
+    components.append({"code": {"coding": [summary.cv.dict()]}, "valueQuantity": percent(metrics["cv"])})
+
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["GlucoseSummary", patient_id, summary.coding.code, start],
+                                               settings.identifier_hash)
+    narrative = (f"<div xmlns=\"http://www.w3.org/1999/xhtml\">CGM summary of {metrics['readings']} readings, "
+                 f"mean glucose {mean} {scale}</div>")
+
+    return {
+        "resourceType": "Observation",
+        "id": unique_id,
+        "status": "final",
+        "identifier": [{
+            "system": settings.id_system,
+            "value": unique_id
+        }],
+        "subject": {"reference": f"Patient/{patient_id}", "display": "Patient"},
+        "code": {"coding": [summary.coding.dict()]},
+        "effectivePeriod": {"start": start, "end": end},
+        "component": components,
+        "text": {
+            "status": "generated",
+            "div": narrative
+        }
+    }
 
-        timestamp = timestamp.strftime(os.getenv("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00"))
 
-        value = cgm_value if math.isnan(bg_value) else bg_value
-        scale = scale_cgm if math.isnan(bg_value) else scale_bg
-        scale_code = scale_code_cgm if math.isnan(bg_value) else scale_code_bg
-        scale_display = scale_display_cgm if math.isnan(bg_value) else scale_display_bg
+def generate_medtronic_glucose_summary(df_original, patient_id, settings=None, partition_label=None):
+    """
+    Computes the CGM summary of the rows (a partition) over the whole sensor glucose column at once.
+
+    The identifier is the one of the partition (patient, summary code and partition label), not of the readings,
+    so the summary of a partition converted again with more readings replaces the earlier one.
+
+    Args:
+        df_original (pandas.DataFrame): Rows of the partition.
+        patient_id (str): FHIR id of the patient.
+        settings (Settings): Configuration, the environment settings when not given.
+        partition_label (str): Label of the partition (see partitioning.Partition), the partition of the first
+            reading when not given.
 
-        observation = create_glucose_observation(value, scale, timestamp, patient_id, scale_code, scale_display)
-        observations.append(observation)
+    Returns:
+        list: One summary Observation, none without sensor glucose values.
+    """
+    settings = settings or get_settings()
+    cols_with_cgm_glucose = df_original.columns[df_original.columns.str.contains('Sensor Glucose')]
+    if len(cols_with_cgm_glucose) == 0:
+        return []
+    # As in generate_medtronic_glucose_observation, the first column carries the value
+    col = cols_with_cgm_glucose[0]
+    values = column_to_float(df_original[col]).to_numpy()
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return []
+    if "mmol/L" in col:
+        scale, unit = settings.glucose_scale_mmol, "mmol"
+    else:
+        scale, unit = settings.glucose_scale_mg, "mg"
 
-    # for debug purposes
-    # print(observation.json())
-    return observations
+    timestamps = df_original['Timestamp'].to_numpy()[valid]
+    start, end = (pd.Timestamp(timestamp).strftime(settings.timestamp_format)
+                  for timestamp in (timestamps.min(), timestamps.max()))
+    if partition_label is None:
+        partition_label = partition_of(pd.Timestamp(timestamps.min()), settings.partition_granularity).label
+    unique_id = generate_unique_identifier(
+        ["GlucoseSummary", patient_id, settings.glucose_summary.coding.code, partition_label],
+        settings.identifier_hash)
+    metrics = glucose_summary_metrics(values[valid], unit, settings)
+    json_obj = create_glucose_summary_json(metrics, scale, unit, start, end, patient_id, settings, unique_id)
+    return emit_resources([json_obj], Observation, settings)
 
 
 #### Block Insulin:
@@ -228,39 +401,83 @@ def generate_medtronic_glucose_observation(df_original, patient_id):
 # df['Rewind']
 # "Suspend" would indicate that the pump has been paused or temporarily halted from delivering insulin.
 
+def effective_time(start, end=None):
+    """
+    Returns:
+        dict: effectiveDateTime of a resource, or its effectivePeriod when it has an end.
+    """
+    if end is None:
+        return {"effectiveDateTime": start}
+    return {"effectivePeriod": {"start": start, "end": end}}
+
+
+def period_id(unique_id, end=None):
+    """
+    Returns:
+        dict: Logical id of a resource over a period (the identifier, see emitter.resource_id), so the period
+            extended by a later export replaces the earlier one, nothing for a point in time.
+    """
+    if end is None:
+        return {}
+    return {"id": unique_id}
+
+
+def setting_change_runs(settings_frame, times):
+    """
+    Change-point compression: groups the rows that have the same setting as the row before them in time
+    (COMPRESS_SETTING_CHANGES). CareLink exports list the newest rows first, the runs follow the timestamps.
+
+    Args:
+        settings_frame (pandas.DataFrame): Setting of every row (e.g. basal rate and insulin type), without
+            missing values.
+        times (pandas.Series): Timestamps of the rows.
+
+    Returns:
+        tuple: (positions of the first row of every run, positions of the row where every run ends) in the rows,
+            in time order: a run lasts until the first row of the next one, the last run until its last row.
+    """
+    if settings_frame.empty:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    order = np.argsort(times.to_numpy(), kind="stable")
+    ordered = settings_frame.iloc[order].reset_index(drop=True)
+    changed = ordered.ne(ordered.shift()).any(axis=1).to_numpy()
+    starts = np.flatnonzero(changed)
+    ends = np.append(starts[1:], len(ordered) - 1)
+    return order[starts], order[ends]
+
+
 # Background (Basal) Insulin:
 # Small amounts of insulin released continuously throughout the day.
 def basal_medication_administration_json(patient_id, insulin_type, dose, timestamp,
-                                         temp_basal_amount=None, temp_basal_type=None, temp_basal_duration=None):
+                                         temp_basal_amount=None, temp_basal_type=None, temp_basal_duration=None,
+                                         settings=None, unique_id=None, effective_end=None):
+    settings = settings or get_settings()
     narrative = "<div xmlns=\"http://www.w3.org/1999/xhtml\">Basal Insulin Injection</div>"
 
-    unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, dose, "BASAL"])
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, dose, "BASAL"],
+                                               settings.identifier_hash)
+    ID_SYSTEM = settings.id_system
 
     medication_administration = {
         "resourceType": "MedicationAdministration",
+        **period_id(unique_id, effective_end),
         "status": "completed",
         "identifier": [{
             "system": ID_SYSTEM,  # Replace with your system identifier
             "value": unique_id
         }],
         "medicationCodeableConcept": {
-            "coding": [
-                {
-                    "system": os.getenv("MEDICATION_ADMINISTRATION_BASAL_SYSTEM", "http://snomed.info/sct"),
-                    "code": os.getenv("MEDICATION_ADMINISTRATION_BASAL_CODE", "25305005"),
-                    "display": os.getenv("MEDICATION_ADMINISTRATION_BASAL_DISPLAY", "25305005"),
-                }
-            ],
+            "coding": [settings.basal_coding.dict()],
             "text": insulin_type,  # Replace with the appropriate display name
         },
-        "effectiveDateTime": timestamp,  # Date and time of administration
-        # A specific date/time or interval of time during which the administration took place
+        # Date and time of administration, or the period of a basal rate (COMPRESS_SETTING_CHANGES)
+        **effective_time(timestamp, effective_end),
         "dosage": {
             "rateQuantity": {
                 "value": dose,
-                "unit": os.getenv("MEDICATION_ADMINISTRATION_BASAL_UNIT_CODE", "U/h"),
-                "system": os.getenv("MEDICATION_ADMINISTRATION_BASAL_UNIT_SYSTEM", "http://unitsofmeasure.org")
+                "unit": settings.basal_unit,
+                "system": settings.basal_unit_system
             }
         },
         "subject": {
@@ -314,11 +531,14 @@ def basal_medication_administration_json(patient_id, insulin_type, dose, timesta
 # Mealtime (Bolus) Insulin:
 # Additional insulin can be delivered on demand to match food intake or to correct high blood glucose.
 def bolus_medication_administration_json(patient_id, insulin_type, bolus_volume_delivered, timestamp,
-                                         bolus_type, programmed_duration):
+                                         bolus_type, programmed_duration, settings=None, unique_id=None):
+    settings = settings or get_settings()
     narrative = "<div xmlns=\"http://www.w3.org/1999/xhtml\">BOLUS Insulin - " + insulin_type + "</div>"
 
-    unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, bolus_volume_delivered, "BOLUS"])
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, bolus_volume_delivered, "BOLUS"],
+                                               settings.identifier_hash)
+    ID_SYSTEM = settings.id_system
 
     medication_administration = {
         "resourceType": "MedicationAdministration",
@@ -332,13 +552,7 @@ def bolus_medication_administration_json(patient_id, insulin_type, bolus_volume_
         }],
         "status": "completed",
         "medicationCodeableConcept": {
-            "coding": [
-                {
-                    "system": os.getenv("MEDICATION_ADMINISTRATION_BOLUS_SYSTEM", "http://snomed.info/sct"),
-                    "code": os.getenv("MEDICATION_ADMINISTRATION_BOLUS_CODE", "A10AB"),
-                    "display": os.getenv("MEDICATION_ADMINISTRATION_BOLUS_DISPLAY", "Background Insulin"),
-                }
-            ],
+            "coding": [settings.bolus_coding.dict()],
             "text": insulin_type,  # Replace with the appropriate display name
         },
         "subject": {
@@ -348,8 +562,8 @@ def bolus_medication_administration_json(patient_id, insulin_type, bolus_volume_
         "dosage": {
             "dose": {
                 "value": bolus_volume_delivered,  # Use the delivered bolus volume
-                "unit": os.getenv("MEDICATION_ADMINISTRATION_BOLUS_UNIT_CODE", "U"),
-                "system": os.getenv("MEDICATION_ADMINISTRATION_BOLUS_UNIT_SYSTEM", "http://unitsofmeasure.org"),
+                "unit": settings.bolus_unit,
+                "system": settings.bolus_unit_system,
             }
         }
     }
@@ -385,21 +599,27 @@ def bolus_medication_administration_json(patient_id, insulin_type, bolus_volume_
     return medication_administration
 
 
-def correction_medication_administration_json(patient_id, insulin_type, dose, timestamp):
+def correction_medication_administration_json(patient_id, insulin_type, dose, timestamp, settings=None,
+                                              unique_id=None):
     """
     Args:
         patient_id:
         insulin_type:
         dose:
         timestamp:
+        settings: Configuration, the environment settings when not given.
+        unique_id: Precomputed identifier (see generate_unique_identifiers), computed here when not given.
 
     Returns:
 
     """
+    settings = settings or get_settings()
     narrative = "<div xmlns=\"http://www.w3.org/1999/xhtml\">Correction Insulin Injection</div>"
 
-    unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, dose, "CORRECTION"])
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["Insulin", patient_id, timestamp, dose, "CORRECTION"],
+                                               settings.identifier_hash)
+    ID_SYSTEM = settings.id_system
 
     medication_administration = {
         "resourceType": "MedicationAdministration",
@@ -409,13 +629,7 @@ def correction_medication_administration_json(patient_id, insulin_type, dose, ti
             "value": unique_id
         }],
         "medicationCodeableConcept": {
-            "coding": [
-                {
-                    "system": os.getenv("MEDICATION_ADMINISTRATION_CORRECTION_SYSTEM", "http://snomed.info/sct"),
-                    "code": os.getenv("MEDICATION_ADMINISTRATION_CORRECTION_CODE", "CORRECTION"),
-                    "display": os.getenv("MEDICATION_ADMINISTRATION_CORRECTION_DISPLAY", "Corretion Insulin"),
-                }
-            ],
+            "coding": [settings.correction_coding.dict()],
             "text": insulin_type,  # Replace with the appropriate display name
         },
         "effectiveDateTime": timestamp,  # Date and time of administration
@@ -423,8 +637,8 @@ def correction_medication_administration_json(patient_id, insulin_type, dose, ti
         "dosage": {
             "dose": {
                 "value": dose,
-                "unit": os.getenv("MEDICATION_ADMINISTRATION_CORRECTION_UNIT_CODE", "U"),
-                "system": os.getenv("MEDICATION_ADMINISTRATION_CORRECTION_UNIT_SYSTEM", "http://unitsofmeasure.org"),
+                "unit": settings.correction_unit,
+                "system": settings.correction_unit_system,
             }
         },
         "subject": {
@@ -439,102 +653,150 @@ def correction_medication_administration_json(patient_id, insulin_type, dose, ti
     return medication_administration
 
 
-def generate_medtronic_insulin_medication_administration(df_original, patient_id):
-    # Create a copy of the input DataFrame
-    df = df_original.copy()
+def _insulin_identifiers(patient_id, doses, timestamps, kind, settings):
+    rows = ((timestamp, dose, kind) for timestamp, dose in zip(timestamps, doses))
+    return generate_unique_identifiers(["Insulin", patient_id], rows, settings.identifier_hash)
 
-    medication_administrations = []
 
-    cols_with_bolus = [col for col in df.columns if df[col].dtype == 'object' and 'Bolus' in col]
-    cols_with_basal = [col for col in df.columns if df[col].dtype == 'object' and 'Basal' in col]
-    columns_to_check = cols_with_bolus + cols_with_basal
-    df.dropna(subset=columns_to_check, how='all', inplace=True)
+def _correction_medication_administrations(patient_id, insulin_types, doses, timestamps, settings):
+    unique_ids = _insulin_identifiers(patient_id, doses, timestamps, "CORRECTION", settings)
+    return [
+        correction_medication_administration_json(patient_id, insulin_type, dose, timestamp, settings, unique_id)
+        for insulin_type, dose, timestamp, unique_id in zip(insulin_types, doses, timestamps, unique_ids)
+    ]
 
-    # Apply the function only to specific columns in the DataFrame to avoid float issues
-    df[columns_to_check] = df[columns_to_check].apply(replace_commas_with_periods)
 
-    # Store environment variables in variables
-    BOLUS_CONSTANT = os.getenv("MEDTRONIC_CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS", "CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS")
-    BASAL_CONSTANT = [ os.getenv("MEDTRONIC_CLOSED_LOOP_AUTO_BASAL", "CLOSED_LOOP_AUTO_BASAL"),
-                       os.getenv("MEDTRONIC_CLOSED_LOOP_AUTO_INSULIN", "CLOSED_LOOP_AUTO_INSULIN")
+def _bolus_medication_administrations(patient_id, insulin_types, doses, timestamps, bolus_types, durations,
+                                      settings):
+    unique_ids = _insulin_identifiers(patient_id, doses, timestamps, "BOLUS", settings)
+    return [
+        bolus_medication_administration_json(patient_id, insulin_type, dose, timestamp, bolus_type, duration,
+                                             settings, unique_id)
+        for insulin_type, dose, timestamp, bolus_type, duration, unique_id
+        in zip(insulin_types, doses, timestamps, bolus_types, durations, unique_ids)
     ]
-    CORRECTION_CONSTANT = [os.getenv("MEDTRONIC_CLOSED_LOOP_AUTO_BOLUS", "CLOSED_LOOP_AUTO_BOLUS"),
-                           os.getenv("MEDTRONIC_CLOSED_LOOP_BG_CORRECTION", "CLOSED_LOOP_BG_CORRECTION")]
-    insulin_threshold = float(os.getenv("INSULIN_THRESHOLD", "0"))
-
-    # Iterate over rows and generate MedicationAdministration for each row
-    for _, row in df.iloc[1:].iterrows():
-        # Extract relevant data from the row
-        timestamp = row['Timestamp']
-
-        # If you need to use an environment variable for format, ensure it includes the offset
-        timestamp = timestamp.strftime(os.getenv("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00"))
-
-        basal = float(
-            replace_commas_with_periods(
-                row['Basal Rate (U/h)']
-            )
-        )
-        bolus = float(
-            replace_commas_with_periods(
-                row['Bolus Volume Delivered (U)']
-            )
-        )
-        auto_bolus = str(row['Bolus Source'])
-
-        json_obj = None
-
-        if not math.isnan(bolus) and bolus >= insulin_threshold:
-            insulin_type = auto_bolus + " Insulin"
-            if auto_bolus in CORRECTION_CONSTANT:
-                json_obj = correction_medication_administration_json(patient_id, insulin_type, bolus, timestamp)
-            elif auto_bolus in BOLUS_CONSTANT:
-                json_obj = bolus_medication_administration_json(
-                    patient_id,
-                    insulin_type,
-                    bolus,
-                    timestamp,
-                    row['Bolus Type'],
-                    row['Bolus Duration (h:mm:ss)']
-                )
-            elif auto_bolus in BASAL_CONSTANT:
-                insulin_type = "Total Insulin Daily (Basal) Insulin "
-                json_obj = basal_medication_administration_json(
-                    patient_id,
-                    insulin_type,
-                    bolus,
-                    timestamp,
-                    row['Temp Basal Amount'],
-                    row['Temp Basal Type'],
-                    row['Temp Basal Duration (h:mm:ss)']
-                )
-
-        elif not math.isnan(basal) and basal >= insulin_threshold and auto_bolus in BASAL_CONSTANT:
-            insulin_type = "Background (Basal) Insulin " + auto_bolus
-            json_obj = basal_medication_administration_json(
-                patient_id,
-                insulin_type,
-                basal,
-                timestamp,
-                row['Temp Basal Amount'],
-                row['Temp Basal Type'],
-                row['Temp Basal Duration (h:mm:ss)']
-            )
-
-        if json_obj is not None:
-            medication_administration = MedicationAdministration.parse_obj(json_obj)
-            medication_administrations.append(medication_administration)
-
-    return medication_administrations
+
+
+def _basal_medication_administrations(patient_id, insulin_types, doses, timestamps,
+                                      temp_basal_amounts, temp_basal_types, temp_basal_durations, settings,
+                                      effective_ends=None):
+    if effective_ends is None:
+        unique_ids = _insulin_identifiers(patient_id, doses, timestamps, "BASAL", settings)
+        effective_ends = [None] * len(doses)
+    else:
+        # A period is not the administration of its first row (its own kind), and its end is not part of the
+        # identifier: the last period of a partition is extended by a later export and replaces the earlier one
+        unique_ids = _insulin_identifiers(patient_id, doses, timestamps, "BASAL_PERIOD", settings)
+    return [
+        basal_medication_administration_json(patient_id, insulin_type, dose, timestamp,
+                                             temp_basal_amount, temp_basal_type, temp_basal_duration, settings,
+                                             unique_id, effective_end)
+        for insulin_type, dose, timestamp, temp_basal_amount, temp_basal_type, temp_basal_duration, unique_id,
+        effective_end
+        in zip(insulin_types, doses, timestamps, temp_basal_amounts, temp_basal_types, temp_basal_durations,
+               unique_ids, effective_ends)
+    ]
+
+
+def generate_medtronic_insulin_medication_administration(df_original, patient_id, settings=None):
+    settings = settings or get_settings()
+    df = df_original
+
+    BOLUS_CONSTANT = settings.bolus_source
+    BASAL_CONSTANT = list(settings.basal_sources)
+    CORRECTION_CONSTANT = list(settings.correction_sources)
+    insulin_threshold = settings.insulin_threshold
+
+    if df.empty:
+        return []
+
+    # Classify every row at once
+    basal = column_to_float(df['Basal Rate (U/h)'])
+    bolus = column_to_float(df['Bolus Volume Delivered (U)'])
+    auto_bolus = df['Bolus Source'].astype(str)
+
+    with_bolus = bolus.notna() & (bolus >= insulin_threshold)
+    is_correction = with_bolus & auto_bolus.isin(CORRECTION_CONSTANT)
+    # As in the row loop this replaced, a bolus source is any part of BOLUS_CONSTANT (a substring test on the
+    # string), e.g. a custom MEDTRONIC_CLOSED_LOOP_BG_CORRECTION that is not in the correction sources
+    bolus_sources = [source for source in auto_bolus.unique() if source in BOLUS_CONSTANT]
+    is_bolus = with_bolus & ~is_correction & auto_bolus.isin(bolus_sources)
+    is_basal_bolus = with_bolus & ~is_correction & ~is_bolus & auto_bolus.isin(BASAL_CONSTANT)
+    is_basal = ~with_bolus & basal.notna() & (basal >= insulin_threshold) & auto_bolus.isin(BASAL_CONSTANT)
+
+    timestamps = df['Timestamp'].dt.strftime(settings.timestamp_format)
+
+    # Each branch is built in one batch, then everything is put back in the row order of the CSV
+    positions = []
+    json_objs = []
+
+    mask = is_correction.to_numpy()
+    positions.append(np.flatnonzero(mask))
+    json_objs += _correction_medication_administrations(
+        patient_id,
+        (auto_bolus[mask] + " Insulin").tolist(),
+        bolus[mask].tolist(),
+        timestamps[mask].tolist(),
+        settings
+    )
+
+    mask = is_bolus.to_numpy()
+    positions.append(np.flatnonzero(mask))
+    json_objs += _bolus_medication_administrations(
+        patient_id,
+        (auto_bolus[mask] + " Insulin").tolist(),
+        bolus[mask].tolist(),
+        timestamps[mask].tolist(),
+        df['Bolus Type'][mask].tolist(),
+        df['Bolus Duration (h:mm:ss)'][mask].tolist(),
+        settings
+    )
+
+    temp_basal_columns = ['Temp Basal Amount', 'Temp Basal Type', 'Temp Basal Duration (h:mm:ss)']
+
+    def basal_administrations(mask, insulin_types, doses):
+        row_positions = np.flatnonzero(mask)
+        columns = [insulin_types, doses, timestamps[mask], *(df[col][mask] for col in temp_basal_columns)]
+        effective_ends = None
+        if settings.compress_setting_changes:
+            # One administration per basal rate, from the row where it is set to the next change
+            starts, ends = setting_change_runs(pd.DataFrame({"rate": doses, "type": insulin_types}),
+                                               df['Timestamp'][mask])
+            effective_ends = timestamps[mask].iloc[ends].tolist()
+            row_positions = row_positions[starts]
+            columns = [column.iloc[starts] for column in columns]
+        positions.append(row_positions)
+        return _basal_medication_administrations(patient_id, *(column.tolist() for column in columns), settings,
+                                                 effective_ends)
+
+    mask = is_basal_bolus.to_numpy()
+    json_objs += basal_administrations(
+        mask,
+        pd.Series("Total Insulin Daily (Basal) Insulin ", index=df.index[mask]),
+        bolus[mask]
+    )
+
+    mask = is_basal.to_numpy()
+    json_objs += basal_administrations(
+        mask,
+        "Background (Basal) Insulin " + auto_bolus[mask],
+        basal[mask]
+    )
+
+    order = np.argsort(np.concatenate(positions), kind='stable')
+    return emit_resources([json_objs[i] for i in order], MedicationAdministration, settings)
 
 
 # Function to generate a FHIR Observation resource for carbohydrates as JSON
-def generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp):
+def generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp, settings=None, unique_id=None):
+    settings = settings or get_settings()
     # Create a narrative for the observation
     narrative = "<div xmlns=\"http://www.w3.org/1999/xhtml\">Carbohydrate intake estimated</div>"
 
-    unique_id = generate_unique_identifier(["Obervation", patient_id, timestamp, bwz_carb_input, "CARB"])
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["Obervation", patient_id, timestamp, bwz_carb_input, "CARB"],
+                                               settings.identifier_hash)
+    ID_SYSTEM = settings.id_system
 
     observation = {
         "resourceType": "Observation",
@@ -544,13 +806,7 @@ def generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp
             "value": unique_id
         }],
         "code": {
-            "coding": [
-                {
-                    "system": os.getenv("CARBOHYDRATES_EST_SYSTEM", "http://loinc.org"),
-                    "code": os.getenv("CARBOHYDRATES_EST_CODE", "9059-7"),
-                    "display": os.getenv("CARBOHYDRATES_EST_DISPLAY", "Carbohydrate intake estimated"),
-                }
-            ],
+            "coding": [settings.carbohydrates_coding.dict()],
             "text": "Carbohydrates"
         },
         "subject": {
@@ -559,9 +815,9 @@ def generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp
         "effectiveDateTime": timestamp,
         "valueQuantity": {
             "value": float(bwz_carb_input),
-            "unit": os.getenv("CARBOHYDRATES_EST_UNIT", "g"),
-            "system": os.getenv("CARBOHYDRATES_EST_UNIT_SYSTEM", "http://unitsofmeasure.org"),
-            "code": os.getenv("CARBOHYDRATES_EST_UNIT_CODE", "g"),
+            "unit": settings.carbohydrates_unit,
+            "system": settings.carbohydrates_unit_system,
+            "code": settings.carbohydrates_unit_code,
         },
         "text": {
             "status": "generated",
@@ -588,55 +844,48 @@ def generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp
 # the expected amount of carbohydrate consumption,
 # as calculated through the Bolus Wizard feature.
 
-def generate_medtronic_carbohydrate_observation(df_original, patient_id):
-    # Create a copy of the input DataFrame
-    df = df_original.copy()
+def generate_medtronic_carbohydrate_observation(df_original, patient_id, settings=None):
+    settings = settings or get_settings()
 
     observations = []
-    cols_with_grams = [col for col in df.columns if df[col].dtype == 'object' and 'Carb' in col]
-    cols_with_grams.append("BWZ Food Estimate (U)")
-    df.dropna(subset=cols_with_grams, how='all', inplace=True)
-
-    # Apply the function only to specific columns in the DataFrame to avoid float issues
-    df[cols_with_grams] = df[cols_with_grams].applymap(replace_commas_with_periods)
-
-    # Iterate over rows and generate MedicationAdministration for each row
-    for _, row in df.iloc[1:].iterrows():
-        # Extract relevant data from the row
-        json_obj = ''
-
-        timestamp = row['Timestamp']
-
-        # If you need to use an environment variable for format, ensure it includes the offset
-        timestamp = timestamp.strftime(os.getenv("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00"))
-
-        bwz_carb_input = row['BWZ Carb Input (grams)']
-
-        # TODO decide what we can use for it
-        bwz_carb_ratio = row['BWZ Carb Ratio (g/U)']
-        bwz_food_estimate = row['BWZ Food Estimate (U)']
-
-        json_obj = generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp)
+    # The Bolus Wizard columns (decimal commas are already handled by the parser, see carelink.csv_read_options)
+    cols_with_grams = [col for col in df_original.columns if col.startswith(('BWZ Carb', 'BWZ Food Estimate'))]
+    # Rows with a Bolus Wizard value (a new frame, the input is left as is)
+    df = df_original.dropna(subset=cols_with_grams, how='all')
+
+    # The TIMESTAMP_FORMAT setting must include the offset
+    timestamps = df['Timestamp'].dt.strftime(settings.timestamp_format).tolist()
+    carb_inputs = df['BWZ Carb Input (grams)'].tolist()
+    rows = ((timestamp, carb_input, "CARB") for timestamp, carb_input in zip(timestamps, carb_inputs))
+    unique_ids = generate_unique_identifiers(["Obervation", patient_id], rows, settings.identifier_hash)
+
+    # TODO decide what we can use for 'BWZ Carb Ratio (g/U)' and 'BWZ Food Estimate (U)'
+    # Generate an Observation for each row
+    for bwz_carb_input, timestamp, unique_id in zip(carb_inputs, timestamps, unique_ids):
+        json_obj = generate_carbohydrate_fhir_observation(patient_id, bwz_carb_input, timestamp, settings,
+                                                          unique_id)
 
         if json_obj != '':
-            observation = Observation.parse_obj(json_obj)
-            observations.append(observation)
-            # for debug purposes
-            # print(observation.json())
+            observations.append(json_obj)
 
-    return observations
+    return emit_resources(observations, Observation, settings)
 
 
-def create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, code, display):
+def create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, code, display, settings=None,
+                                   unique_id=None, effective_end=None):
+    settings = settings or get_settings()
 
     narrative = "Insulin Carb Ratio set by the pump"
 
-    unique_id = generate_unique_identifier(["InsulinCarbRatio", patient_id, timestamp, value, "ICR"])
-    ID_SYSTEM = os.getenv("ID_SYSTEM", "")
+    if unique_id is None:
+        unique_id = generate_unique_identifier(["InsulinCarbRatio", patient_id, timestamp, value, "ICR"],
+                                               settings.identifier_hash)
+    ID_SYSTEM = settings.id_system
 
 
     json_obj = {
         "resourceType": "Observation",
+        **period_id(unique_id, effective_end),
         "status": "final",
         "identifier": [{
             "system": ID_SYSTEM,  # Replace with your system identifier
@@ -653,7 +902,7 @@ def create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, c
             "reference": f"Patient/{patient_id}",
             "display": "Patient"
         },
-        "effectiveDateTime": timestamp,
+        **effective_time(timestamp, effective_end),
         "valueQuantity": {
             "value": value,
             "unit": unit
@@ -667,62 +916,130 @@ def create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, c
     return json_obj
 
 
-def generate_medtronic_carb_ratio(df_original, patient_id):
-    # Assuming df is your DataFrame
-
-    # Create a copy of the input DataFrame
-    df = df_original.copy()
-
-    filtered_df = df[df[df.columns[df.columns.str.startswith('BWZ Carb Ratio')]].notna().all(axis=1)]
-
-    system = (os.getenv("ICR_SYSTEM", "http://loinc.org"))
-    code = (os.getenv("ICR_CODE", "Insulin-carb-ratio"))
-    display = (os.getenv("ICR_DISPLAY", "Insulin-Carb Ratio"))
-    unit = (os.getenv("ICR_UNIT", "units/g"))
-    # unit_system = (os.getenv("ICR_UNIT_SYSTEM", "http://unitsofmeasure.org"))
-
-    col_with_icr = [col for col in df.columns if df[col].dtype == 'object' and 'BWZ Carb Ratio' in col]
-
-    observations = []
+def generate_medtronic_carb_ratio(df_original, patient_id, settings=None):
+    settings = settings or get_settings()
+    df = df_original
+
+    col_with_icr = [col for col in df.columns if col.startswith('BWZ Carb Ratio')]
+    if not col_with_icr:
+        return []
+
+    system = settings.icr_coding.system
+    code = settings.icr_coding.code
+    display = settings.icr_coding.display
+    unit = settings.icr_unit
+
+    # Rows with a ratio, the value of the first ratio column, on whole columns
+    filtered_df = df[df[col_with_icr].notna().all(axis=1)]
+    values = column_to_float(filtered_df[col_with_icr[0]])
+    valid = values.notna()
+    values = values[valid]
+    timestamps = filtered_df['Timestamp'][valid].dt.strftime(settings.timestamp_format)
+
+    if settings.compress_setting_changes:
+        # One Observation per ratio, from the row where it is set to the next change
+        starts, ends = setting_change_runs(values.to_frame(), filtered_df['Timestamp'][valid])
+        timestamps = timestamps.to_numpy()
+        values = values.iloc[starts].tolist()
+        effective_ends = timestamps[ends].tolist()
+        timestamps = timestamps[starts].tolist()
+        # Identified by the start, the ratio and the kind: the last period of a partition is extended by a later
+        # export and replaces the earlier one (see period_id)
+        rows = zip(timestamps, values, ["ICR_PERIOD"] * len(values))
+    else:
+        values = values.tolist()
+        timestamps = timestamps.tolist()
+        effective_ends = [None] * len(values)
+        rows = zip(timestamps, values, ["ICR"] * len(values))
+    unique_ids = generate_unique_identifiers(["InsulinCarbRatio", patient_id], rows, settings.identifier_hash)
+
+    observations = [
+        create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, code, display, settings,
+                                       unique_id, effective_end)
+        for value, timestamp, unique_id, effective_end in zip(values, timestamps, unique_ids, effective_ends)
+    ]
+    return emit_resources(observations, Observation, settings)
 
-    for _, row in filtered_df.iloc[1:].iterrows():
-        # Extract relevant data from the row
-        json_obj = ''
 
-        timestamp = row['Timestamp']
-        timestamp = timestamp.strftime(os.getenv("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00"))
+def pack_bundle_ranges(entry_sizes, max_entries, max_bytes):
+    """
+    Greedy packing of consecutive entries into bundles of at most max_entries entries and
+    max_bytes bytes. An entry larger than max_bytes gets a bundle of its own.
 
-        # TODO make it more secure
-        value = float(replace_commas_with_periods(row[col_with_icr].iloc[0]))
+    Args:
+        entry_sizes (list): Estimated size of every entry (see emitter.estimate_entry_size).
+        max_entries (int): Maximum number of entries per bundle.
+        max_bytes (int): Maximum size of a bundle.
 
-        json_obj = create_insulin_carb_ratio_json(value, unit, timestamp, patient_id, system, code, display)
+    Returns:
+        list: (start, end) index ranges of the bundles.
+    """
+    ranges = []
+    start = 0
+    size = BUNDLE_OVERHEAD
+    for i, entry_size in enumerate(entry_sizes):
+        if i > start and (i - start >= max_entries or size + entry_size > max_bytes):
+            ranges.append((start, i))
+            start = i
+            size = BUNDLE_OVERHEAD
+        size += entry_size
+    if start < len(entry_sizes):
+        ranges.append((start, len(entry_sizes)))
+    return ranges
+
+
+def create_bundles_by_size(resource_list, resource_type, settings):
+    """
+    create_bundles for MAX_BUNDLE_BYTES: the bundles are packed up to MAX_BUNDLE_BYTES and MAX_BUNDLE_SIZE entries.
 
-        if json_obj != '':
-            observation = Observation.parse_obj(json_obj)
-            observations.append(observation)
+    The size of the resources is estimated without serializing the models (see emitter.estimate_json_size).
+    Dictionaries of the "fast" mode are rendered once (with BUNDLE_SERIALIZER) and the JSON is reused when the
+    bundle is written.
+    """
+    rendered = None
+    if settings.fhir_emitter == EMITTER_FAST:
+        dumps = json_dumps_function(settings.bundle_serializer)
+        rendered = [render_resource(resource, dumps) for resource in resource_list]
+        entry_sizes = [estimate_entry_size(resource, resource_type, resource_size=len(resource_json))
+                       for resource, resource_json in zip(resource_list, rendered)]
+    else:
+        entry_sizes = [estimate_entry_size(resource, resource_type) for resource in resource_list]
 
-    return observations
+    bundles = []
+    for start, end in pack_bundle_ranges(entry_sizes, settings.max_bundle_size, settings.max_bundle_bytes):
+        if rendered is not None:
+            bundles.append(create_fast_bundle(resource_list[start:end], resource_type, settings=settings,
+                                              rendered=rendered[start:end]))
+        else:
+            bundles.append(create_fhir_bundle(resource_list[start:end], resource_type, settings=settings))
+    return bundles
 
 
-def create_bundles(resource_list, resource_type):
+def create_bundles(resource_list, resource_type, settings=None):
     """
-        This function takes two parameters and performs a specific task.
+    Splits the resources into transaction bundles of at most MAX_BUNDLE_SIZE entries
+    (and MAX_BUNDLE_BYTES bytes when it is set, see create_bundles_by_size).
 
-        Parameters:
-        param1 (int): Description of parameter 1.
-        param2 (str): Description of parameter 2.
+    Args:
+        resource_list (list): Resources (models or dictionaries, see emitter.emit_resources).
+        resource_type (str): FHIR resource type of the resources.
+        settings (Settings): Configuration, the environment settings when not given.
 
-        Returns:
-        bool: Returns True if the task was successful, False otherwise.
+    Returns:
+        list: The bundles.
     """
+    settings = settings or get_settings()
     bundles = []
     observation_size = len(resource_list)
 
     if observation_size == 0:
         return bundles  # If observation_list is empty, return an empty list of bundles
 
+    if settings.max_bundle_bytes:
+        return create_bundles_by_size(resource_list, resource_type, settings)
+
     # to avoid that the bundle is too big
-    max_bundle_size = int(os.getenv("MAX_BUNDLE_SIZE", 500))
+    max_bundle_size = settings.max_bundle_size
     if observation_size > max_bundle_size:
         num_bundles = (observation_size + max_bundle_size - 1) // max_bundle_size
 
@@ -730,15 +1047,20 @@ def create_bundles(resource_list, resource_type):
             start_index = i * max_bundle_size
             end_index = min((i + 1) * max_bundle_size, observation_size)
             partial_resource = resource_list[start_index:end_index]
-            bundle = create_fhir_bundle(partial_resource, resource_type)
+            bundle = create_fhir_bundle(partial_resource, resource_type, settings=settings)
             bundles.append(bundle)
     else:
-        bundles.append(create_fhir_bundle(resource_list, resource_type))
+        bundles.append(create_fhir_bundle(resource_list, resource_type, settings=settings))
 
     return bundles
 
 
-def create_fhir_bundle(entries, resource_type, method="POST"):
+def create_fhir_bundle(entries, resource_type, method="POST", settings=None):
+    settings = settings or get_settings()
+    # With FHIR_EMITTER=fast the entries are plain dictionaries and the bundle is rendered from a template
+    if settings.fhir_emitter == EMITTER_FAST:
+        return create_fast_bundle(entries, resource_type, method, settings)
+
     # Step 1: Create the FHIR bundle resource
     bundle = Bundle(type='transaction')
 
@@ -758,11 +1080,15 @@ def create_fhir_bundle(entries, resource_type, method="POST"):
                 bundle_entry = BundleEntry(resource=entry)
 
                 # Set the request field for the entry
-                bundle_entry.request = BundleEntryRequest(
-                    method=method,  # Set the HTTP method (e.g., "POST" or "PUT")
-                    url=resource_type,  # Set the resource type as the URL
-                    ifNoneExist=f"identifier={system}|{value}"
-                )
+                if entry.id:
+                    # A resource with a logical id replaces its earlier version (see emitter.resource_id)
+                    bundle_entry.request = BundleEntryRequest(method="PUT", url=f"{resource_type}/{entry.id}")
+                else:
+                    bundle_entry.request = BundleEntryRequest(
+                        method=method,  # Set the HTTP method (e.g., "POST" or "PUT")
+                        url=resource_type,  # Set the resource type as the URL
+                        ifNoneExist=f"identifier={system}|{value}"
+                    )
 
                 bundle_entries.append(bundle_entry)
             else:
@@ -776,7 +1102,7 @@ def create_fhir_bundle(entries, resource_type, method="POST"):
 
     # Get the current date and time
     current_datetime = datetime.now()
-    bundle.timestamp = current_datetime.strftime(os.getenv("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00"))
+    bundle.timestamp = current_datetime.strftime(settings.timestamp_format)
 
     return bundle
 
@@ -0,0 +1,280 @@
+import json
+import random
+from datetime import date, datetime
+from decimal import Decimal
+
+from settings import get_settings
+
+# FHIR_EMITTER selects how resources and bundles are produced:
+#   "model": every resource is parsed into a fhir.resources model (full validation)
+#   "fast":  resources stay plain dictionaries and bundles are rendered from a JSON template,
+#            a sample of the resources is still validated with fhir.resources
+EMITTER_MODEL = "model"
+EMITTER_FAST = "fast"
+
+BUNDLE_TEMPLATE = '{"resourceType":"Bundle","id":"%s","type":"transaction","timestamp":%s,"entry":[%s]}'
+BUNDLE_ENTRY_TEMPLATE = '{"request":{"method":%s,"url":%s,"ifNoneExist":%s},"resource":%s}'
+# Entry of a resource with a logical id, replaced when it is converted again (see resource_id)
+BUNDLE_UPDATE_ENTRY_TEMPLATE = '{"request":{"method":"PUT","url":%s},"resource":%s}'
+
+# Size of a bundle without its entries: the template, the id and the timestamp
+BUNDLE_OVERHEAD = len(BUNDLE_TEMPLATE) + 40
+
+
+class ValidationSampler:
+    """
+    Decides which resources are still validated with fhir.resources in fast mode.
+
+    Args:
+        every (int): Validate every Nth resource (0 disables it).
+        fraction (float): Validate a random fraction of the resources (0 disables it).
+        seed (int): Optional seed for the random fraction, to make runs reproducible.
+    """
+
+    def __init__(self, every=0, fraction=0.0, seed=None):
+        if every < 0 or not 0 <= fraction <= 1:
+            raise ValueError("Validation sample must be a positive interval or a fraction between 0 and 1")
+        self.every = every
+        self.fraction = fraction
+        self.count = 0
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            every=settings.validation_sample_every,
+            fraction=settings.validation_sample_fraction,
+            seed=settings.validation_sample_seed
+        )
+
+    def should_validate(self):
+        self.count += 1
+        if self.every and self.count % self.every == 0:
+            return True
+        return bool(self.fraction) and self.random.random() < self.fraction
+
+
+# One sampler per sampling configuration, so the count of "every Nth" runs across the whole conversion
+_samplers = {}
+
+
+def get_validation_sampler(settings):
+    key = (settings.validation_sample_every, settings.validation_sample_fraction, settings.validation_sample_seed)
+    if key not in _samplers:
+        _samplers[key] = ValidationSampler.from_settings(settings)
+    return _samplers[key]
+
+
+def emit_resources(json_objs, model, settings=None):
+    """
+    Turns resource dictionaries into the objects that are bundled.
+
+    Args:
+        json_objs (list): Resource dictionaries, as built by the *_json functions.
+        model (type): fhir.resources model class of the resources (e.g. Observation).
+        settings (Settings): Configuration, the environment settings when not given.
+
+    Returns:
+        list: fhir.resources models in "model" mode, the (sample validated) dictionaries in "fast" mode.
+    """
+    settings = settings or get_settings()
+    if settings.fhir_emitter == EMITTER_MODEL:
+        return [model.parse_obj(json_obj) for json_obj in json_objs]
+
+    sampler = get_validation_sampler(settings)
+    for json_obj in json_objs:
+        if sampler.should_validate():
+            # raises a pydantic ValidationError, exactly like the "model" mode would
+            model.parse_obj(json_obj)
+    return json_objs
+
+
+def emit_resource(json_obj, model, settings=None):
+    return emit_resources([json_obj], model, settings)[0]
+
+
+def resource_identifier(resource):
+    """
+    Returns the (system, value) pair of the first identifier of a model or dictionary resource.
+    """
+    if isinstance(resource, dict):
+        identifiers = resource.get("identifier") or []
+        if not identifiers:
+            return None, None
+        return identifiers[0].get("system"), identifiers[0].get("value")
+
+    if not resource.identifier:
+        return None, None
+    return resource.identifier[0].system, resource.identifier[0].value
+
+
+def resource_id(resource):
+    """
+    Returns the logical id of a model or dictionary resource, None when it has none.
+
+    Only the resources computed over a period that can grow (the CGM summary of a partition, the compressed
+    setting periods) have one: they are updated with PUT when a later export converts their period again,
+    instead of being created once with ifNoneExist.
+    """
+    if isinstance(resource, dict):
+        return resource.get("id")
+    return resource.id
+
+
+def bundle_entry_request(resource, resource_type, method="POST"):
+    """
+    Returns:
+        dict: Request of the bundle entry of a resource, None without a valid identifier.
+    """
+    system, value = resource_identifier(resource)
+    system = system.strip() if system else None
+    value = value.strip() if value else None
+    if not (system and value):
+        return None
+    logical_id = resource_id(resource)
+    if logical_id:
+        return {"method": "PUT", "url": f"{resource_type}/{logical_id}"}
+    return {"method": method, "url": resource_type, "ifNoneExist": f"identifier={system}|{value}"}
+
+
+def estimate_json_size(value):
+    """
+    Cheap estimate of the length of the compact JSON of a value, without serializing it.
+
+    Walks dictionaries, lists and fhir.resources models (their fields that are set). Strings count
+    their quotes and the characters JSON escapes, so the estimate is within a few bytes of the real size
+    for the ASCII content produced by the converter.
+
+    Args:
+        value: Resource dictionary or model, or any value in it.
+
+    Returns:
+        int: Estimated number of bytes.
+    """
+    if value is None:
+        return 4
+    if isinstance(value, str):
+        return len(value) + value.count('"') + value.count('\\') + 2
+    if isinstance(value, bool):
+        return 5 if value else 4
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value))
+    if isinstance(value, (datetime, date)):
+        return len(value.isoformat()) + 2
+    if isinstance(value, (list, tuple)):
+        return 1 + sum(estimate_json_size(item) + 1 for item in value) if value else 2
+
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        # fhir.resources model: the fields that are set, like in model.json()
+        items = [(key, item) for key, item in value.__dict__.items()
+                 if item is not None and key not in ("resource_type", "fhir_comments")]
+    return 1 + sum(len(key) + 4 + estimate_json_size(item) for key, item in items) if items else 2
+
+
+def render_resource(resource, dumps=None):
+    """
+    Args:
+        resource (dict): Resource dictionary.
+        dumps (callable): JSON encoder of BUNDLE_SERIALIZER (see serialization.json_dumps_function), json when not given.
+
+    Returns:
+        str: Compact JSON of a resource dictionary, as written in the bundles of the "fast" mode.
+    """
+    if dumps is not None:
+        return dumps(resource)
+    return json.dumps(resource, separators=(",", ":"))
+
+
+def estimate_entry_size(resource, resource_type, method="POST", resource_size=None):
+    """
+    Estimated size of the bundle entry of a resource (request, resource and the comma between entries).
+
+    Args:
+        resource: Resource dictionary or model.
+        resource_type (str): FHIR resource type, the URL of the request.
+        method (str): HTTP method of the request.
+        resource_size (int): Size of the resource JSON when it is already known (see estimate_json_size).
+    """
+    system, value = resource_identifier(resource)
+    if resource_size is None:
+        resource_size = estimate_json_size(resource)
+        if not isinstance(resource, dict):
+            # "resourceType" is not a field of the model
+            resource_size += len(resource_type) + 18
+    logical_id = resource_id(resource)
+    if logical_id:
+        return len(BUNDLE_UPDATE_ENTRY_TEMPLATE) - 4 + len(resource_type) + len(logical_id) + 3 + resource_size + 1
+    return (len(BUNDLE_ENTRY_TEMPLATE) - 8 + len(method) + len(resource_type) + 4
+            + len(f"identifier={system}|{value}") + 2 + resource_size + 1)
+
+
+class FastBundle:
+    """
+    Transaction bundle built from plain resource dictionaries.
+
+    It has the same json() and dict() methods used on the fhir.resources Bundle,
+    so the rest of the pipeline does not need to know which emitter was used.
+    """
+
+    def __init__(self, entries, timestamp, bundle_id="0", rendered=None):
+        self.id = bundle_id
+        self.type = "transaction"
+        self.timestamp = timestamp
+        self.entry = entries
+        # JSON of the entry resources when it was already rendered (see render_resource)
+        self.rendered = rendered
+
+    def dict(self):
+        return {
+            "resourceType": "Bundle",
+            "id": self.id,
+            "type": self.type,
+            "timestamp": self.timestamp,
+            "entry": self.entry
+        }
+
+    def json(self, resource_dumps=None):
+        """
+        Args:
+            resource_dumps (callable): JSON encoder of the resources, see render_resource.
+        """
+        dumps = json.dumps
+        rendered = self.rendered or [render_resource(entry["resource"], resource_dumps) for entry in self.entry]
+        entries = ",".join(
+            BUNDLE_ENTRY_TEMPLATE % (
+                dumps(entry["request"]["method"]),
+                dumps(entry["request"]["url"]),
+                dumps(entry["request"]["ifNoneExist"]),
+                resource_json
+            ) if "ifNoneExist" in entry["request"] else
+            BUNDLE_UPDATE_ENTRY_TEMPLATE % (dumps(entry["request"]["url"]), resource_json)
+            for entry, resource_json in zip(self.entry, rendered)
+        )
+        return BUNDLE_TEMPLATE % (self.id, dumps(self.timestamp), entries)
+
+
+def create_fast_bundle(entries, resource_type, method="POST", settings=None, rendered=None):
+    """
+    Fast mode counterpart of conversion.create_fhir_bundle.
+
+    rendered is the JSON of the entries (see render_resource) when it is already known.
+    """
+    settings = settings or get_settings()
+    bundle_entries = []
+    bundle_rendered = []
+    for i, entry in enumerate(entries):
+        request = bundle_entry_request(entry, resource_type, method)
+
+        # Entries without a valid identifier are skipped, like in create_fhir_bundle
+        if request is not None:
+            bundle_entries.append({
+                "request": request,
+                "resource": entry
+            })
+            if rendered is not None:
+                bundle_rendered.append(rendered[i])
+
+    timestamp = datetime.now().strftime(settings.timestamp_format)
+    return FastBundle(bundle_entries, timestamp, rendered=bundle_rendered if rendered is not None else None)
@@ -0,0 +1,155 @@
+"""
+Local index of the resource identifiers already converted, to drop them from later conversions.
+
+Bundles use 'ifNoneExist', so the FHIR server would skip the duplicates anyway, but only after one search per entry.
+With IDENTIFIER_INDEX_PATH set, the resources whose identifier is in the index are dropped before they are bundled,
+and the identifiers of the saved bundles are added to it, across files and across runs. The identifiers of a run
+are kept in memory and only written when the run succeeds (commit), so the resources of a run whose bundles could
+not be uploaded are converted again by the next run.
+
+The resources with a logical id (see emitter.resource_id) replace their earlier version when their period is
+converted again: their key is the one of their identifier and content, so only a changed version is converted.
+
+The index is a SQLite database with one 16-byte key per identifier (BLAKE2b of 'system|value'),
+so tens of millions of identifiers fit in a few hundred MB and are looked up through the primary key.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+
+from emitter import resource_id, resource_identifier
+
+# Keys per membership query, below the SQLite limit of host parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+def identifier_key(system, value):
+    return hashlib.blake2b(f"{system}|{value}".encode(), digest_size=16).digest()
+
+
+def resource_key(resource):
+    """
+    Returns:
+        bytes: Key of a resource in the index (see identifier_key, with the content for the resources with a
+            logical id), None without identifier.
+    """
+    system, value = resource_identifier(resource)
+    if not (system and value):
+        return None
+    if not resource_id(resource):
+        return identifier_key(system, value)
+    if isinstance(resource, dict):
+        content = json.dumps(resource, sort_keys=True, separators=(",", ":"), default=str)
+    else:
+        content = resource.json()
+    return identifier_key(system, f"{value}|{hashlib.sha256(content.encode()).hexdigest()}")
+
+
+class IdentifierIndex:
+    """
+    Set of identifiers stored in SQLite.
+
+    The connection is opened on first use, so the index can be handed to worker processes
+    (each one opens its own connection). The identifiers added are pending until commit().
+
+    Args:
+        path (str): Database file, created when missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        # Keys added in this run, not written yet
+        self.pending = set()
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS identifiers (key BLOB PRIMARY KEY) WITHOUT ROWID")
+        return self._connection
+
+    def contains(self, keys):
+        """
+        Args:
+            keys (list): Keys, see identifier_key.
+
+        Returns:
+            set: The keys that are in the index (or pending).
+        """
+        found = {key for key in keys if key in self.pending}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start:start + LOOKUP_BATCH_SIZE]
+            query = f"SELECT key FROM identifiers WHERE key IN ({','.join('?' * len(batch))})"
+            found.update(row[0] for row in self.connection.execute(query, batch))
+        return found
+
+    def filter_new(self, resources):
+        """
+        Drops the resources whose identifier is in the index, or repeats one of an earlier resource of the list.
+        Resources without identifier are kept.
+
+        Args:
+            resources (list): fhir.resources models or dictionaries.
+
+        Returns:
+            list: The resources to convert, in the same order.
+        """
+        keys = [resource_key(resource) for resource in resources]
+        seen = self.contains([key for key in keys if key is not None])
+        new_resources = []
+        for resource, key in zip(resources, keys):
+            if key is None:
+                new_resources.append(resource)
+            elif key not in seen:
+                seen.add(key)
+                new_resources.append(resource)
+        self.skipped += len(resources) - len(new_resources)
+        return new_resources
+
+    def add(self, resources):
+        """
+        Adds the identifiers of the resources to the index, pending until commit().
+        """
+        self.pending.update(key for key in map(resource_key, resources) if key is not None)
+
+    def take_pending(self):
+        """
+        Returns:
+            set: The pending keys, which are removed (a worker process hands them to the main process).
+        """
+        pending, self.pending = self.pending, set()
+        return pending
+
+    def commit(self):
+        """
+        Writes the pending identifiers to the index.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO identifiers (key) VALUES (?)",
+                                        ((key,) for key in self.pending))
+        self.pending = set()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM identifiers").fetchone()[0]
+
+    def close(self):
+        """
+        Closes the index, pending identifiers that were not committed are dropped.
+        """
+        self.pending = set()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
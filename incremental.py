@@ -0,0 +1,203 @@
+"""
+Incremental conversion of overlapping CareLink exports.
+
+The state of every patient (INCREMENTAL_STATE_FOLDER/<patient id>.json) keeps the last converted timestamp
+(the watermark) and, for every partition, a digest of its CSV rows and the number of bundle files written
+per resource stream. On the next export:
+
+- partitions with the same digest are skipped,
+- new partitions and partitions whose rows changed are converted and rewritten (stale parts are removed),
+- a changed partition that starts before the 'Start Date' of the export only holds part of its rows,
+  so only its rows after the watermark are converted, as extra parts of the partition.
+
+The state is discarded when the settings that affect the bundles (see Settings.fingerprint) or the
+destination folder change.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from bundle_output import COMPRESSION_EXTENSIONS
+from utils import bundle_file_path
+
+STATE_VERSION = 1
+
+
+def partition_digest(rows):
+    """
+    Args:
+        rows (pandas.DataFrame): CSV rows of a partition.
+
+    Returns:
+        str: Digest of the columns and values of the rows (the index is ignored).
+    """
+    digest = hashlib.sha256('\x1f'.join(map(str, rows.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def state_file_path(folder, patient_id):
+    return os.path.join(folder, f"{patient_id or 'patient'}.json")
+
+
+class IncrementalState:
+    """
+    Conversion state of one patient, see the module documentation.
+
+    Args:
+        path (str): State file.
+        fingerprint (str): Settings.fingerprint() of the conversion.
+        output_folder (str): Destination folder of the bundles.
+        export_start (pandas.Timestamp): 'Start Date' of the export, None when unknown.
+    """
+
+    def __init__(self, path, fingerprint, output_folder, export_start=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.output_folder = output_folder
+        self.export_start = export_start
+        self.watermark = None
+        self.partitions = {}
+        # Partitions selected in this run: label -> (digest, True when rewritten, False when appended)
+        self.selected = {}
+        self.latest = None
+
+    @classmethod
+    def load(cls, path, fingerprint, output_folder, export_start=None):
+        """
+        Reads the state file, a missing or outdated state gives an empty state.
+        """
+        state = cls(path, fingerprint, output_folder, export_start)
+        if not os.path.exists(path):
+            return state
+
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != STATE_VERSION or data.get("output_folder") != output_folder:
+            return state
+
+        state.partitions = data.get("partitions", {})
+        if data.get("fingerprint") != fingerprint:
+            # Everything is converted again, the part counts are kept to remove stale files
+            for partition in state.partitions.values():
+                partition["digest"] = None
+            return state
+
+        if data.get("watermark"):
+            state.watermark = pd.Timestamp(data["watermark"])
+        return state
+
+    def select(self, partition, rows, written_parts):
+        """
+        Decides which rows of a partition must be converted.
+
+        Args:
+            partition (Partition): The partition.
+            rows (pandas.DataFrame): CSV rows of the partition in this export.
+            written_parts (dict): (resource name, label) -> parts already saved, the part counts of
+                appended partitions are added so that their new bundles come after the stored ones.
+
+        Returns:
+            numpy.ndarray: Boolean mask of the rows to convert, None when the partition is unchanged.
+        """
+        if rows.empty:
+            return None
+        latest = rows['Timestamp'].max()
+        self.latest = latest if self.latest is None else max(self.latest, latest)
+
+        digest = partition_digest(rows)
+        if partition.label in self.selected:
+            # More rows of a partition converted earlier in this run (streaming mode): they are added to it,
+            # and without a digest of the whole partition it is converted again on the next run
+            self.selected[partition.label] = (None, self.selected[partition.label][1])
+            return np.ones(len(rows), dtype=bool)
+
+        stored = self.partitions.get(partition.label)
+        if stored is None:
+            self.selected[partition.label] = (digest, True)
+            return np.ones(len(rows), dtype=bool)
+        if stored["digest"] == digest:
+            return None
+
+        truncated = (self.export_start is not None and self.watermark is not None
+                     and partition.start < self.export_start and stored["digest"] is not None)
+        if not truncated:
+            self.selected[partition.label] = (digest, True)
+            return np.ones(len(rows), dtype=bool)
+
+        mask = (rows['Timestamp'] > self.watermark).to_numpy()
+        if not mask.any():
+            return None
+        self.selected[partition.label] = (digest, False)
+        for resource_name, parts in stored["parts"].items():
+            written_parts[(resource_name, partition.label)] = parts
+        return mask
+
+    def rewrites(self, label):
+        """
+        Returns:
+            bool: True when the partition was selected in this run to be converted again entirely, its bundle
+                files are then replaced (so its resources must not be dropped by the identifier index).
+        """
+        selected = self.selected.get(label)
+        return selected is not None and selected[1]
+
+    def appends(self, label):
+        """
+        Returns:
+            bool: True when only the new rows of the partition are converted in this run, they are added to
+                the files of the earlier runs.
+        """
+        selected = self.selected.get(label)
+        return selected is not None and not selected[1]
+
+    def commit(self, written_parts):
+        """
+        Records the partitions converted in this run, removes the bundle files a rewritten partition no
+        longer has and saves the state file.
+
+        Args:
+            written_parts (dict): (resource name, label) -> parts saved, see main.ConversionContext.
+        """
+        for label, (digest, rewritten) in self.selected.items():
+            stored = self.partitions.get(label, {"parts": {}})
+            parts = {
+                resource_name: count
+                for (resource_name, partition_label), count in written_parts.items()
+                if partition_label == label
+            }
+            if rewritten:
+                for resource_name, old_count in stored["parts"].items():
+                    for part in range(parts.get(resource_name, 0) + 1, old_count + 1):
+                        path = bundle_file_path(self.output_folder, resource_name, label, part)
+                        for extension in COMPRESSION_EXTENSIONS.values():
+                            if os.path.exists(path + extension):
+                                os.remove(path + extension)
+            else:
+                parts = {**stored["parts"], **parts}
+            self.partitions[label] = {"digest": digest, "parts": parts}
+
+        if self.latest is not None and (self.watermark is None or self.latest > self.watermark):
+            self.watermark = self.latest
+        self.selected = {}
+        self.save()
+
+    def save(self):
+        data = {
+            "version": STATE_VERSION,
+            "fingerprint": self.fingerprint,
+            "output_folder": self.output_folder,
+            "watermark": self.watermark.isoformat() if self.watermark is not None else None,
+            "partitions": self.partitions,
+        }
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Write and rename, so an interrupted run never leaves a half written state
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,230 @@
+"""
+Timers, counters and profiles of a conversion run.
+
+Every stage of process_patient_data (parse, partition, the generation, bundling and serialization of every
+resource stream, the writing of the files) is timed in wall and CPU time, and the rows, resources, files and bytes
+are counted. With RUN_REPORT set, the figures are saved as a JSON report at the end of the run, PROGRESS_INTERVAL
+prints a progress line every N seconds and, with PROFILE_FOLDER set, every stage is profiled with cProfile into
+its own '<stage>.prof' file (read them with `python -m pstats` or snakeviz).
+
+The stages do not overlap: the time of a stage run inside another one (e.g. the serialization of the bundles while
+they are written) only counts for the inner stage, so the stage times add up to the time of the run.
+
+The CPU time is the one of the process, so it includes the background threads (bundle writer, uploads).
+With PARALLEL_WORKERS the stages run in the worker processes: their times are the sum over the workers and can
+be larger than the wall time of the run.
+"""
+import cProfile
+import glob
+import json
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class RunMetrics:
+    """
+    Stage timers and counters of a run, see the module documentation.
+
+    Args:
+        profile_folder (str): Folder of the per-stage profiles (empty = no profiling).
+        progress_interval (float): Seconds between two progress lines (0 = no progress lines).
+    """
+
+    def __init__(self, profile_folder="", progress_interval=0):
+        self.profile_folder = profile_folder
+        self.progress_interval = progress_interval
+        self.started = datetime.now()
+        # stage name -> [calls, wall seconds, CPU seconds]
+        self.stages = {}
+        self.counters = {}
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._last_progress = self._start_wall
+        # Stages being run: [profile, wall and CPU time of the inner stages], the innermost last
+        self._running = []
+        # stage name -> cProfile.Profile
+        self._profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the block as the stage name (the times of all the calls are added), without its inner stages.
+        """
+        running = [self._enter_profile(name) if self.profile_folder else None, 0.0, 0.0]
+        self._running.append(running)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            self._running.pop()
+            if running[0] is not None:
+                self._exit_profile(running[0])
+            if self._running:
+                self._running[-1][1] += wall
+                self._running[-1][2] += cpu
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += wall - running[1]
+            totals[2] += cpu - running[2]
+
+    def timed(self, name, function):
+        """
+        Returns:
+            callable: The function, every call timed as the stage name.
+        """
+        def timed_function(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    def _enter_profile(self, name):
+        # cProfile has one active profiler per thread: the outer stage pauses while an inner one runs
+        if self._running:
+            self._running[-1][0].disable()
+        profile = self._profiles.get(name)
+        if profile is None:
+            profile = self._profiles[name] = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _exit_profile(self, profile):
+        profile.disable()
+        if self._running:
+            self._running[-1][0].enable()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def progress(self, done, total=None, bytes_written=0):
+        """
+        Prints a progress line when PROGRESS_INTERVAL seconds passed since the last one.
+
+        Args:
+            done (int): Partitions converted.
+            total (int): Partitions to convert, None when unknown (streaming).
+            bytes_written (int): Bytes of output written so far.
+        """
+        now = time.perf_counter()
+        if not self.progress_interval or now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        partitions = f"{done}/{total}" if total is not None else f"{done}"
+        print(f"Progress: {partitions} partition(s), {self.counters.get('rows_converted', 0)} row(s), "
+              f"{self.counters.get('resources', 0)} resource(s), {bytes_written / 1e6:.1f} MB written "
+              f"in {now - self._start_wall:.1f}s")
+
+    def snapshot(self, reset=True):
+        """
+        Returns:
+            tuple: (stages, counters) to merge into the metrics of the main process (see merge),
+                by default the timers and counters start again from zero.
+        """
+        snapshot = (self.stages, self.counters)
+        if reset:
+            self.stages, self.counters = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Adds the stages and counters of a worker process (see snapshot).
+        """
+        stages, counters = snapshot
+        for name, (calls, wall, cpu) in stages.items():
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = [0, 0.0, 0.0]
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def report(self, **metadata):
+        """
+        Args:
+            **metadata: Description of the run (file, settings...), saved first in the report.
+
+        Returns:
+            dict: The run report: metadata, total wall and CPU time, stages, counters and rates per second.
+        """
+        wall = time.perf_counter() - self._start_wall
+        report = dict(metadata)
+        report.update({
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(time.process_time() - self._start_cpu, 6),
+            "stages": {
+                name: {"calls": calls, "wall_seconds": round(stage_wall, 6), "cpu_seconds": round(stage_cpu, 6)}
+                for name, (calls, stage_wall, stage_cpu) in self.stages.items()
+            },
+            "counters": dict(sorted(self.counters.items())),
+            "rows_per_second": round(self.counters.get("rows_converted", 0) / wall, 1) if wall else 0,
+            "resources_per_second": round(self.counters.get("resources", 0) / wall, 1) if wall else 0,
+        })
+        return report
+
+    def write_report(self, path, **metadata):
+        """
+        Saves the run report (see report) as a JSON file.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(**metadata), f, indent=1)
+        print(f"File '{path}' successfully created.")
+
+    @staticmethod
+    def profile_path(folder, stage, tag=""):
+        """
+        Returns:
+            str: Path of the profile of a stage, e.g. 'profiles/generate_glucose.prof'.
+        """
+        return os.path.join(folder, f"{stage.replace('/', '_')}{tag}.prof")
+
+    def dump_worker_profiles(self):
+        """
+        Saves the profiles of a worker process, tagged with its process id, for dump_profiles.
+        """
+        if not self._profiles:
+            return
+        os.makedirs(self.profile_folder, exist_ok=True)
+        for name, profile in self._profiles.items():
+            profile.dump_stats(self.profile_path(self.profile_folder, name, f".{os.getpid()}"))
+
+    def dump_profiles(self):
+        """
+        Saves the profile of every stage, combined with the profiles of the worker processes.
+
+        Returns:
+            list: Paths of the profiles saved.
+        """
+        if not self.profile_folder:
+            return []
+        os.makedirs(self.profile_folder, exist_ok=True)
+        worker_files = {}
+        for worker_file in glob.glob(os.path.join(self.profile_folder, "*.*.prof")):
+            stage = os.path.basename(worker_file).split(".", 1)[0]
+            worker_files.setdefault(stage, []).append(worker_file)
+
+        file_paths = []
+        stages = {self.profile_path("", name)[:-len(".prof")]: profile for name, profile in self._profiles.items()}
+        for stage in sorted(set(stages) | set(worker_files)):
+            sources = ([stages[stage]] if stage in stages else []) + sorted(worker_files.get(stage, []))
+            stats = pstats.Stats(sources[0])
+            for source in sources[1:]:
+                stats.add(source)
+            file_path = os.path.join(self.profile_folder, f"{stage}.prof")
+            stats.dump_stats(file_path)
+            for worker_file in worker_files.get(stage, []):
+                os.remove(worker_file)
+            file_paths.append(file_path)
+            print(f"File '{file_path}' successfully created.")
+        return file_paths
@@ -1,14 +1,26 @@
+import copy
 import os
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 
-from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 
 from conversion import generate_medtronic_glucose_observation, create_bundles, \
     generate_medtronic_carbohydrate_observation, generate_medtronic_insulin_medication_administration, \
-    generate_medtronic_carb_ratio
+    generate_medtronic_carb_ratio, generate_medtronic_glucose_summary
 
+from bundle_output import BundleWriter
+from carelink import read_medtronic_csv, iter_medtronic_csv, read_export_period
+from identifier_index import IdentifierIndex
+from incremental import IncrementalState, state_file_path
+from instrumentation import RunMetrics
+from ndjson_output import NdjsonSink
+from parse_cache import ParseCache
+from partitioning import iter_partitions, partition_key_columns, partition_positions
+from serialization import bundle_serializer
+from settings import get_settings, load_settings, OUTPUT_NDJSON
+from upload import FhirUploader, print_upload_summary
 from utils import save_bundles_to_files
 
 
@@ -25,86 +37,476 @@ def load_data_from_environment():
     return file, fhir_id
 
 
-def process_patient_data(csv_file, patient_id):
+class ConversionContext:
     """
-    Processes patient data from a CSV file based on date and time.
-    Generates FHIR bundles for glucose, carbohydrate, and insulin observations by week.
+    What the conversion of one patient file needs besides the rows: the patient, the configuration,
+    where to save the bundles and how many parts were already saved per resource and partition.
+
+    Args:
+        patient_id (str): FHIR id of the patient.
+        settings (Settings): Configuration of the conversion.
+        output_folder (str): Destination folder, FOLDER_BUNDLE_DESTINATION when not given.
+    """
+
+    def __init__(self, patient_id, settings, output_folder=None):
+        self.patient_id = patient_id
+        self.settings = settings
+        self.output_folder = output_folder or settings.folder_bundle_destination
+        self.written_parts = {}
+        # IncrementalState when INCREMENTAL_STATE_FOLDER is set
+        self.incremental = None
+        # IdentifierIndex when IDENTIFIER_INDEX_PATH is set
+        self.identifier_index = None
+        # FhirUploader when FHIR_BASE_URL is set
+        self.uploader = None
+        # NdjsonSink when OUTPUT_FORMAT is ndjson, bundle files otherwise
+        self.sink = None
+        # BundleWriter of the bundle files (compression, archive)
+        self.writer = None
+        # Timers and counters of the run (see instrumentation.py)
+        self.metrics = RunMetrics()
+
+
+def written_bytes(context):
+    """
+    Returns:
+        int: Bytes of output written so far by the conversion, worker processes included.
     """
+    written = context.metrics.counters.get("bytes_written", 0) + context.writer.bytes_written
+    if context.sink is not None:
+        written += context.sink.bytes_written
+    return written
 
-    # Read the uploaded file using pandas
-    df = pd.read_csv(csv_file, skiprows=6, sep=';', index_col=0)
 
-    # Convert 'Date' column to datetime objects with a specific format
-    df['Date'] = pd.to_datetime(df['Date'], format='%Y/%m/%d', errors='coerce')
+def load_incremental_state(csv_file, context):
+    """
+    Loads the incremental state of the patient into the context (see incremental.py).
+    """
+    settings = context.settings
+    export_start, _ = read_export_period(csv_file)
+    path = state_file_path(settings.incremental_state_folder, context.patient_id)
+    context.incremental = IncrementalState.load(path, settings.fingerprint(), context.output_folder, export_start)
 
-    # Drop rows with NaT (not a time) values in the 'Date' column
-    df.dropna(subset=['Date'], inplace=True)
-    df['Time'] = pd.to_timedelta(df['Time'])
 
-    # Merge 'Date' and 'Time' columns into a single datetime column 'Timestamp'
-    df['Timestamp'] = df['Date'] + df['Time']
+def select_changed_partitions(df, partitions, context):
+    """
+    Keeps the partitions, and the rows of them, that the incremental state says must be converted.
 
-    # Find the minimum date in the DataFrame to determine the starting point for iteration
-    year = df['Date'].min().year
-    end_year = df['Date'].max().year
+    Args:
+        df (pandas.DataFrame): Patient data.
+        partitions (list): (Partition, positions) pairs, see partitioning.partition_positions.
+        context (ConversionContext): The conversion, with its incremental state.
 
-    # Iterate through months and years starting from the minimum date up to the current year
-    while year <= end_year:
-        month = df['Date'].min().month
-        while month <= 12:  # Loop through all months (1 to 12)
+    Returns:
+        list: (Partition, positions) pairs to convert.
+    """
+    selected = []
+    for partition, positions in partitions:
+        mask = context.incremental.select(partition, df.iloc[positions], context.written_parts)
+        if mask is not None:
+            selected.append((partition, positions[mask]))
+    return selected
 
-            # Filter the DataFrame for the current year and month
-            filtered_df = df[
-                (df['Timestamp'].dt.year == year) &
-                (df['Timestamp'].dt.month == month)
-                ]
 
-            if not filtered_df.empty:
-                # Process data for each week in the month
-                current_date = datetime(year, month, 1)
-                end_date = current_date + relativedelta(day=31)
+def save_partition_bundles(bundles, resource_name, partition, context):
+    """
+    Saves the bundles of a partition, numbering the parts after the ones already written
+    (a partition can be saved in more than one go in streaming mode).
+
+    Args:
+        bundles (list): List of bundles to save.
+        resource_name (str): Name of the resource.
+        partition (Partition): The partition of the bundles.
+        context (ConversionContext): The conversion, its written_parts are updated.
 
-                week = 1
-                while current_date <= end_date:
-                    # Calculate the end of the current week
-                    end_of_week = current_date + relativedelta(days=7)
+    Returns:
+        list: Paths of the files saved.
+    """
+    key = (resource_name, partition.label)
+    first_part = context.written_parts.get(key, 0) + 1
+    context.written_parts[key] = first_part - 1 + len(bundles)
+    metrics = context.metrics
+    serialize = metrics.timed(f"serialize/{resource_name}", bundle_serializer(context.settings.bundle_serializer))
+    with metrics.stage("write"):
+        return save_bundles_to_files(bundles, resource_name, partition.label, first_part, context.output_folder,
+                                     context.writer, serialize)
 
-                    # get only the week data
-                    week_df = filtered_df[
-                        (filtered_df['Timestamp'] <= end_of_week) &
-                        (filtered_df['Timestamp'] >= current_date)]
 
-                    # Generate and save FHIR bundles for glucose observations
-                    glucose_observation = generate_medtronic_glucose_observation(week_df, patient_id)
-                    glucose_bundles = create_bundles(glucose_observation, "Observation")
-                    save_bundles_to_files(glucose_bundles, 'glucose', year, month, week)
+# Resources converted for every partition: name used in the bundle files, generator and FHIR resource type
+RESOURCE_STREAMS = {
+    'glucose': (generate_medtronic_glucose_observation, "Observation"),
+    'carbs': (generate_medtronic_carbohydrate_observation, "Observation"),
+    'insulin': (generate_medtronic_insulin_medication_administration, "MedicationAdministration"),
+}
+
+# Resources converted only when enabled: name, generator, FHIR resource type and the settings that enable them
+OPTIONAL_RESOURCE_STREAMS = {
+    'glucose_summary': (generate_medtronic_glucose_summary, "Observation", lambda s: s.glucose_summary.enabled),
+    'icr': (generate_medtronic_carb_ratio, "Observation", lambda s: s.icr_enabled),
+}
+
+# Streams that describe a whole partition: their generator also gets the partition label (the identifier of its
+# resources, which replace the ones of an earlier conversion of the partition), and rows appended to a partition
+# saved before do not replace them
+PARTITION_STREAMS = {'glucose_summary'}
+
+
+def resource_streams(settings):
+    """
+    Returns:
+        dict: RESOURCE_STREAMS and the OPTIONAL_RESOURCE_STREAMS enabled in the settings.
+    """
+    streams = dict(RESOURCE_STREAMS)
+    for resource_name, (generator, resource_type, enabled) in OPTIONAL_RESOURCE_STREAMS.items():
+        if enabled(settings):
+            streams[resource_name] = (generator, resource_type)
+    return streams
+
+
+def process_partition_resource(partition_df, partition, resource_name, context, appended=False):
+    """
+    Generates and saves the FHIR bundles of one resource stream (see resource_streams) of a time partition.
+
+    Args:
+        partition_df (pandas.DataFrame): Rows of the partition.
+        partition (Partition): The partition, used to name the bundle files.
+        resource_name (str): Key of resource_streams.
+        context (ConversionContext): The conversion.
+        appended (bool): The rows are added to the partition saved before in this run (streaming mode),
+            the incremental state tells the partitions added to the ones of an earlier run.
+
+    Returns:
+        list: Paths of the bundle files saved (none with the NDJSON output).
+    """
+    generator, resource_type = resource_streams(context.settings)[resource_name]
+    metrics = context.metrics
+    if resource_name in PARTITION_STREAMS:
+        if appended or (context.incremental and context.incremental.appends(partition.label)):
+            # Only part of the rows of the partition: its resources of the earlier rows are kept
+            return []
+        with metrics.stage(f"generate/{resource_name}"):
+            resources = generator(partition_df, context.patient_id, context.settings, partition.label)
+    else:
+        with metrics.stage(f"generate/{resource_name}"):
+            resources = generator(partition_df, context.patient_id, context.settings)
+    rewritten = context.sink is None and context.incremental and context.incremental.rewrites(partition.label)
+    if context.identifier_index is not None and not rewritten:
+        # Resources converted by an earlier run or file are not bundled again, except in the partitions
+        # the incremental mode rewrites: their bundle files are replaced, so they must hold all their resources
+        # (NDJSON files are never replaced, the index drops everything converted before)
+        with metrics.stage("identifier_index"):
+            resources = context.identifier_index.filter_new(resources)
+    metrics.count(f"resources/{resource_name}", len(resources))
+    metrics.count("resources", len(resources))
+    if context.sink is not None:
+        # The NDJSON lines are serialized while they are written
+        with metrics.stage(f"ndjson/{resource_name}"):
+            context.sink.write(resources, resource_type)
+        file_paths = []
+    else:
+        with metrics.stage(f"bundle/{resource_name}"):
+            bundles = create_bundles(resources, resource_type, context.settings)
+        file_paths = save_partition_bundles(bundles, resource_name, partition, context)
+        metrics.count("bundles", len(file_paths))
+    if context.identifier_index is not None:
+        with metrics.stage("identifier_index"):
+            context.identifier_index.add(resources)
+    return file_paths
+
+
+def process_partition(partition_df, partition, context, appended=False):
+    """
+    Generates and saves the FHIR bundles of one time partition: glucose and carbohydrate
+    observations and insulin medication administrations (and the enabled optional streams).
+
+    Args:
+        partition_df (pandas.DataFrame): Rows of the partition.
+        partition (Partition): The partition, used to name the bundle files.
+        context (ConversionContext): The conversion.
+        appended (bool): See process_partition_resource.
+    """
+    for resource_name in resource_streams(context.settings):
+        process_partition_resource(partition_df, partition, resource_name, context, appended)
+    context.metrics.count("partitions")
+    context.metrics.count("rows_converted", len(partition_df))
+
+
+# Frame and conversion shared with the worker processes of process_partitions_in_parallel
+_shared_frame = None
+_shared_context = None
+
+
+def _init_parallel_worker(df, context):
+    global _shared_frame, _shared_context
+    _shared_frame = df
+    _shared_context = context
+
+
+def _process_parallel_task(task):
+    partition, positions, resource_name = task
+    index = _shared_context.identifier_index
+    skipped = index.skipped if index is not None else 0
+    sink = _shared_context.sink
+    sink_files = len(sink.file_paths) if sink is not None else 0
+    written = written_bytes(_shared_context)
+    file_paths = process_partition_resource(_shared_frame.iloc[positions], partition, resource_name, _shared_context)
+    if sink is not None:
+        # The worker process has no end hook, its NDJSON files are complete after every task
+        sink.flush()
+        file_paths = sink.file_paths[sink_files:]
+    members = []
+    if _shared_context.writer.collected:
+        # Bundles of the archive, added to it by the main process
+        members, _shared_context.writer.collected = _shared_context.writer.collected, []
+        file_paths = []
+    # Timers and counters of the task, added to the ones of the main process
+    metrics = _shared_context.metrics
+    metrics.count("bytes_written", written_bytes(_shared_context) - written)
+    if metrics.profile_folder:
+        metrics.dump_worker_profiles()
+    key = (resource_name, partition.label)
+    # The identifiers of the task are committed to the index by the main process, at the end of the run
+    indexed = (index.skipped - skipped, index.take_pending()) if index is not None else (0, set())
+    return key, _shared_context.written_parts.get(key, 0), indexed, file_paths, members, metrics.snapshot()
+
+
+def process_partitions_in_parallel(df, partitions, context):
+    """
+    Converts every (partition, resource stream) pair in a pool of worker processes.
+
+    The frame is handed to each worker once, when the worker starts (inherited without copying
+    where processes are forked), and the tasks only carry the row positions of their partition.
+    Every task writes its own files, so the output is the same as in the serial path.
+    The files are uploaded (FHIR_BASE_URL) from this process, as the tasks finish.
+    With OUTPUT_ARCHIVE, the workers return their compressed bundles and this process archives them.
+
+    Args:
+        df (pandas.DataFrame): Patient data.
+        partitions (list): (Partition, positions) pairs, see partitioning.partition_positions.
+        context (ConversionContext): The conversion, settings.parallel_workers is the size of the pool.
+    """
+    streams = len(resource_streams(context.settings))
+    tasks = [
+        (partition, positions, resource_name)
+        for partition, positions in partitions
+        for resource_name in resource_streams(context.settings)
+    ]
+    worker_context = copy.copy(context)
+    worker_context.uploader = None
+    worker_context.writer = context.writer.for_worker()
+    worker_context.metrics = RunMetrics(context.metrics.profile_folder)
+    if context.sink is not None:
+        worker_context.sink = context.sink.for_worker()
+    with ProcessPoolExecutor(max_workers=context.settings.parallel_workers, initializer=_init_parallel_worker,
+                             initargs=(df, worker_context)) as executor:
+        # errors of the workers are raised here, the part counts are kept for the incremental state
+        results = executor.map(_process_parallel_task, tasks)
+        for done, (key, parts, indexed, file_paths, members, metrics) in enumerate(results, start=1):
+            context.metrics.merge(metrics)
+            if done % streams == 0:
+                # The tasks come back in order, all the streams of a partition are done
+                context.metrics.count("partitions")
+                context.metrics.count("rows_converted", len(tasks[done - 1][1]))
+                context.metrics.progress(done // streams, len(partitions), written_bytes(context))
+            context.written_parts[key] = parts
+            if members:
+                with context.metrics.stage("write"):
+                    for file_path, data in members:
+                        context.writer.add(file_path, data)
+            if context.identifier_index is not None:
+                context.identifier_index.skipped += indexed[0]
+                context.identifier_index.pending |= indexed[1]
+            if context.sink is not None:
+                context.sink.file_paths += file_paths
+            elif context.uploader is not None:
+                for file_path in file_paths:
+                    context.uploader.submit_file(file_path)
+
+
+def process_patient_data_in_chunks(csv_file, context):
+    """
+    Streaming version of process_patient_data: the CSV is read in chunks and every partition is
+    converted and saved as soon as a chunk no longer contains rows of it, so the memory used is
+    bounded by the chunk size instead of the file size.
+
+    CareLink exports are ordered by time, so a partition normally closes once. Rows that show up
+    after their partition was saved (e.g. a second device section) are saved as extra parts of it.
+    """
+    settings = context.settings
+    metrics = context.metrics
+    pending = {}
+    # Labels of the partitions saved, later rows of them are appended
+    saved = set()
+
+    def flush(key):
+        with metrics.stage("partition"):
+            partition_df = pd.concat(pending.pop(key))
+            partitions = list(iter_partitions(partition_df, settings.partition_granularity,
+                                              settings.partition_max_rows))
+        for partition, rows in partitions:
+            if context.incremental:
+                mask = context.incremental.select(partition, rows, context.written_parts)
+                metrics.count("rows_skipped", len(rows) - (int(mask.sum()) if mask is not None else 0))
+                if mask is None:
+                    continue
+                rows = rows[mask]
+            process_partition(rows, partition, context, partition.label in saved)
+            saved.add(partition.label)
+            metrics.progress(metrics.counters["partitions"], bytes_written=written_bytes(context))
+
+    chunks = iter_medtronic_csv(csv_file, settings.csv_chunk_size)
+    while True:
+        with metrics.stage("parse"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        metrics.count("rows_in", len(chunk))
+        keys_in_chunk = set()
+        with metrics.stage("partition"):
+            groups = list(chunk.groupby(partition_key_columns(chunk['Timestamp'], settings.partition_granularity),
+                                        sort=True))
+        # Rows without a time stamp are in no partition
+        metrics.count("rows_dropped", len(chunk) - sum(len(rows) for _, rows in groups))
+        for key, rows in groups:
+            pending.setdefault(key, []).append(rows)
+            keys_in_chunk.add(key)
+
+        # Partitions without rows in this chunk are complete
+        for key in sorted(set(pending) - keys_in_chunk):
+            flush(key)
+
+    for key in sorted(pending):
+        flush(key)
+
+
+# Settings saved in the run report, the ones that change the speed of a conversion
+RUN_REPORT_SETTINGS = (
+    "fhir_emitter", "bundle_serializer", "output_format", "output_compression", "partition_granularity",
+    "partition_max_rows", "csv_chunk_size", "parallel_workers", "max_bundle_size", "identifier_hash"
+)
+
+
+def process_patient_data(csv_file, patient_id, output_folder=None, settings=None):
+    """
+    Processes patient data from a CSV file based on date and time.
+    Generates FHIR bundles for glucose, carbohydrate, and insulin observations by
+    time partition (week by default, see PARTITION_GRANULARITY and PARTITION_MAX_ROWS).
+    With CSV_CHUNK_SIZE set, the file is streamed in chunks (see process_patient_data_in_chunks),
+    otherwise PARALLEL_WORKERS > 1 spreads the partitions over worker processes.
+    With INCREMENTAL_STATE_FOLDER set, only new and changed partitions are converted (see incremental.py),
+    with IDENTIFIER_INDEX_PATH set, resources converted before are dropped (see identifier_index.py)
+    and with FHIR_BASE_URL set, the bundles are also uploaded to the FHIR server (see upload.py).
+    With PARSE_CACHE_FOLDER set, the frame parsed from the CSV is cached for the next runs (see parse_cache.py).
+    With OUTPUT_FORMAT=ndjson, the resources are written as NDJSON files instead of bundles (see ndjson_output.py),
+    otherwise OUTPUT_COMPRESSION and OUTPUT_ARCHIVE compress and archive the bundle files (see bundle_output.py).
+    Every stage is timed and counted, RUN_REPORT, PROGRESS_INTERVAL and PROFILE_FOLDER report them
+    (see instrumentation.py).
+
+    Args:
+        csv_file (str): Path of the CareLink CSV export.
+        patient_id (str): FHIR id of the patient.
+        output_folder (str): Destination of the bundles, FOLDER_BUNDLE_DESTINATION when not given.
+        settings (Settings): Configuration, read from the environment when not given.
+
+    Returns:
+        RunMetrics: Timers and counters of the conversion.
+
+    Raises:
+        RuntimeError: If bundles could not be uploaded.
+    """
+    settings = settings or get_settings()
+    context = ConversionContext(patient_id, settings, output_folder)
+    if settings.profile_folder:
+        context.metrics.profile_folder = os.path.join(context.output_folder, settings.profile_folder)
+    context.metrics.progress_interval = settings.progress_interval
+    metrics = context.metrics
+    if settings.incremental_state_folder:
+        load_incremental_state(csv_file, context)
+    if settings.identifier_index_path:
+        context.identifier_index = IdentifierIndex(settings.identifier_index_path)
+    if settings.fhir_base_url:
+        context.uploader = FhirUploader.from_settings(settings)
+    if settings.output_format == OUTPUT_NDJSON:
+        context.sink = NdjsonSink(context.output_folder, settings.ndjson_max_bytes, settings.bundle_serializer,
+                                  settings.file_messages)
+    context.writer = BundleWriter(context.output_folder, settings.output_compression, settings.output_archive,
+                                  verbose=settings.file_messages)
+    if context.uploader is not None:
+        # Every bundle is uploaded in the background as soon as it is stored
+        context.writer.listener = context.uploader.submit
 
-                    # Generate and save FHIR bundles for carbohydrate observations
-                    carbohydrate_observation = generate_medtronic_carbohydrate_observation(week_df, patient_id)
-                    carbohydrate_bundles = create_bundles(carbohydrate_observation, "Observation")
-                    save_bundles_to_files(carbohydrate_bundles, 'carbs', year, month, week)
+    if settings.csv_chunk_size > 0:
+        process_patient_data_in_chunks(csv_file, context)
+    else:
+        # Read the uploaded file using pandas, or the frame parsed by an earlier run
+        parse_cache = None
+        if settings.parse_cache_folder:
+            parse_cache = ParseCache(settings.parse_cache_folder, settings.parse_cache_max_bytes)
+        with metrics.stage("parse"):
+            df = read_medtronic_csv(csv_file, parse_cache)
+        metrics.count("rows_in", len(df))
 
-                    # Generate and save FHIR bundles for insulin medication administrations
-                    insulin_medication_administration = generate_medtronic_insulin_medication_administration(week_df,
-                                                                                                             patient_id)
-                    insulin_bundles = create_bundles(insulin_medication_administration, "MedicationAdministration")
-                    save_bundles_to_files(insulin_bundles, 'insulin', year, month, week)
+        # Assign every row to exactly one partition in a single grouping pass
+        with metrics.stage("partition"):
+            partitions = partition_positions(df, settings.partition_granularity, settings.partition_max_rows)
+            partitioned = sum(len(positions) for _, positions in partitions)
+            # Rows without a time stamp are in no partition
+            metrics.count("rows_dropped", len(df) - partitioned)
+            if context.incremental:
+                partitions = select_changed_partitions(df, partitions, context)
+                metrics.count("rows_skipped", partitioned - sum(len(positions) for _, positions in partitions))
 
-                    # TODO: Uncomment if needed
-                    # Generate and save FHIR bundle for Insulin-Carb-Ratio
-                    # icr_observation = generate_medtronic_carb_ratio(week_df, patient_id)
-                    # icr_bundles = create_bundles(icr_observation, "Observation")
-                    # save_bundles_to_files(icr_bundles, 'icr', year, month, week)
+        if settings.parallel_workers > 1:
+            process_partitions_in_parallel(df, partitions, context)
+        else:
+            for done, (partition, positions) in enumerate(partitions, start=1):
+                process_partition(df.iloc[positions], partition, context)
+                metrics.progress(done, len(partitions), written_bytes(context))
 
-                    # Move to the next week
-                    current_date += relativedelta(weeks=1)
-                    week += 1
+    # Files still queued in the background writer
+    with metrics.stage("close"):
+        if context.sink is not None:
+            context.sink.close()
+        context.writer.close()
+    metrics.count("bytes_written", written_bytes(context) - metrics.counters.get("bytes_written", 0))
+    if context.sink is not None:
+        metrics.count("files", len(context.sink.file_paths))
+    failed = 0
+    if context.uploader is not None:
+        with metrics.stage("upload"):
+            results = context.uploader.wait()
+        context.uploader.close()
+        print_upload_summary(results)
+        failed = sum(1 for result in results if not result.success)
+        metrics.count("bundles_uploaded", len(results) - failed)
+        metrics.count("bundles_upload_failed", failed)
 
-            month += 1
+    # The run is only recorded once its bundles are uploaded: after a failed upload, the next run converts
+    # (and uploads) the same partitions and resources again
+    if failed:
+        print("The incremental state and the identifier index are not updated, "
+              "the bundles could not all be uploaded.")
+    elif context.incremental:
+        context.incremental.commit(context.written_parts)
+    if context.identifier_index is not None:
+        print(f"{context.identifier_index.skipped} resource(s) already in the identifier index were skipped.")
+        metrics.count("resources_skipped", context.identifier_index.skipped)
+        if not failed:
+            context.identifier_index.commit()
+        context.identifier_index.close()
 
-        # Reset month to 1 for the next year
-        month = 1
-        year += 1
+    # The report is also saved when the upload failed
+    if settings.run_report:
+        metrics.write_report(
+            os.path.join(context.output_folder, settings.run_report),
+            csv_file=csv_file,
+            patient_id=patient_id,
+            settings={name: getattr(settings, name) for name in RUN_REPORT_SETTINGS},
+        )
+    metrics.dump_profiles()
+    if failed:
+        raise RuntimeError(f"{failed} bundle(s) could not be uploaded to {settings.fhir_base_url}")
+    return metrics
 
 
 if __name__ == "__main__":
@@ -112,4 +514,4 @@ if __name__ == "__main__":
     # Presenting the output to the user
     print("Patient ID for FHIR resources:", patient_id_fhir)
     print("CSV File:", medtronic_file)
-    process_patient_data(medtronic_file, patient_id_fhir)
+    process_patient_data(medtronic_file, patient_id_fhir, settings=load_settings())
@@ -0,0 +1,109 @@
+"""
+FHIR Bulk Data (NDJSON) output: one resource per line, one file per resource type, without bundles.
+
+Selected with OUTPUT_FORMAT=ndjson. The files are named '<ResourceType>.<n>.ndjson' (e.g. 'Observation.1.ndjson'),
+a new file is started when NDJSON_MAX_BYTES would be exceeded. The worker processes of PARALLEL_WORKERS write
+their own files ('Observation.<worker>-<n>.ndjson'), so no file is shared between processes.
+
+The numbers of a run start after the files already in the folder, so a run never overwrites the files of an
+earlier one (e.g. the resources of the previous export in incremental mode).
+"""
+import os
+import re
+
+from serialization import resource_serializer, SERIALIZER_PYDANTIC
+
+# Write buffer of every open file
+NDJSON_BUFFER_SIZE = 1 << 20
+
+
+class NdjsonSink:
+    """
+    Streams resources into buffered NDJSON files.
+
+    Args:
+        folder (str): Destination folder.
+        max_bytes (int): Roll to a new file before this size is exceeded (0 = one file per resource type).
+        serializer (str): BUNDLE_SERIALIZER, see serialization.py.
+        verbose (bool): Print a message for every file created (FILE_MESSAGES).
+    """
+
+    def __init__(self, folder, max_bytes=0, serializer=SERIALIZER_PYDANTIC, verbose=True):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.serializer = serializer
+        self.verbose = verbose
+        self._serialize = resource_serializer(serializer)
+        # Prefix of the file numbers, set in the worker processes
+        self.tag = ""
+        self.file_paths = []
+        # Size of all the files in bytes (UTF-8)
+        self.bytes_written = 0
+        # resource type -> [open file, file number, bytes written]
+        self._files = {}
+
+    def for_worker(self):
+        """
+        Returns:
+            NdjsonSink: Sink for a worker process, its files are tagged with the process id.
+        """
+        sink = NdjsonSink(self.folder, self.max_bytes, self.serializer, self.verbose)
+        sink.tag = None
+        return sink
+
+    def _next_number(self, resource_type):
+        """
+        Returns:
+            int: Number after the highest one of the files of the resource type (and tag) in the folder.
+        """
+        pattern = re.compile(rf"{re.escape(resource_type)}\.{re.escape(self.tag)}(\d+)\.ndjson")
+        numbers = [int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(self.folder)) if match]
+        return max(numbers, default=0) + 1
+
+    def _open(self, resource_type, number=None):
+        if self.tag is None:
+            self.tag = f"{os.getpid()}-"
+        if number is None:
+            number = self._next_number(resource_type)
+        file_path = os.path.join(self.folder, f"{resource_type}.{self.tag}{number}.ndjson")
+        self.file_paths.append(file_path)
+        return [open(file_path, "wb", buffering=NDJSON_BUFFER_SIZE), number, 0]
+
+    def write(self, resources, resource_type):
+        """
+        Appends resources (models or dictionaries) to the file of their type.
+        """
+        if not resources:
+            return
+        current = self._files.get(resource_type)
+        if current is None:
+            current = self._files[resource_type] = self._open(resource_type)
+
+        for resource in resources:
+            # Encoded before it is counted: orjson does not escape the text that is not ASCII
+            line = (self._serialize(resource) + "\n").encode("utf-8")
+            if self.max_bytes and current[2] and current[2] + len(line) > self.max_bytes:
+                current[0].close()
+                current = self._files[resource_type] = self._open(resource_type, current[1] + 1)
+            current[0].write(line)
+            current[2] += len(line)
+            self.bytes_written += len(line)
+
+    def flush(self):
+        for current in self._files.values():
+            current[0].flush()
+
+    def close(self):
+        """
+        Closes the files.
+
+        Returns:
+            list: Paths of the files written.
+        """
+        for current in self._files.values():
+            current[0].close()
+        self._files = {}
+        if self.verbose:
+            for file_path in self.file_paths:
+                print(f"File '{file_path}' successfully created.")
+        return self.file_paths
@@ -0,0 +1,172 @@
+"""
+Cache of the parsed CareLink exports.
+
+With PARSE_CACHE_FOLDER set, the frame parsed from a CSV export (see carelink.read_medtronic_csv) is stored in the
+folder, keyed by the SHA-256 of the file content and carelink.PARSER_VERSION. Converting the same export again
+(e.g. with another MAX_BUNDLE_SIZE or other codes) loads the frame instead of parsing the CSV.
+
+Every entry is a folder ('<digest>-v<version>.frame') with one '.npy' file per number, date and duration column,
+memory-mapped when it is loaded (only the rows a conversion reads come from the disk), and a 'frame.json' sidecar
+with the column names, the index and the text columns (missing values as null, loaded as NaN). Nothing in an entry
+is executable: the arrays are loaded without pickle. When the folder grows above PARSE_CACHE_MAX_BYTES, the least
+recently used entries are removed.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from carelink import PARSER_VERSION
+
+CACHE_EXTENSION = ".frame"
+SIDECAR_NAME = "frame.json"
+
+# numpy kinds of the columns stored as '.npy' files: bool, integers, floats, complex, durations, dates
+ARRAY_KINDS = "biufcmM"
+
+
+def file_digest(path):
+    """
+    Returns:
+        str: SHA-256 of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def entry_size(path):
+    """
+    Returns:
+        int: Bytes of the files of a cache entry.
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def _text_values(values):
+    return [None if pd.isna(value) else value for value in values]
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = [np.nan if value is None else value for value in values]
+    return array
+
+
+class ParseCache:
+    """
+    Parsed frames stored in a folder, see the module documentation.
+
+    Args:
+        folder (str): Cache folder, created when missing.
+        max_bytes (int): Size above which the least recently used entries are removed (0 = no limit).
+    """
+
+    def __init__(self, folder, max_bytes=0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def entry_path(self, csv_file):
+        return os.path.join(self.folder, f"{file_digest(csv_file)}-v{PARSER_VERSION}{CACHE_EXTENSION}")
+
+    def load(self, csv_file):
+        """
+        Returns:
+            pandas.DataFrame: The frame parsed from the file, None when it is not in the cache.
+        """
+        path = self.entry_path(csv_file)
+        try:
+            with open(os.path.join(path, SIDECAR_NAME)) as f:
+                sidecar = json.load(f)
+            index = self._load_index(path, sidecar["index"])
+            columns = {
+                column["name"]: (np.load(os.path.join(path, column["file"]), mmap_mode="r") if "file" in column
+                                 else _object_array(column["values"]))
+                for column in sidecar["columns"]
+            }
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except (ValueError, KeyError, TypeError, OSError):
+            # Damaged, or written by another version: parsed again
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        # The modification time is the last use, for the eviction
+        os.utime(path)
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    @staticmethod
+    def _load_index(path, index):
+        if "range" in index:
+            return pd.RangeIndex(*index["range"], name=index["name"])
+        if "file" in index:
+            return pd.Index(np.load(os.path.join(path, index["file"])), name=index["name"])
+        return pd.Index(_object_array(index["values"]), dtype=object, name=index["name"])
+
+    def store(self, csv_file, df):
+        """
+        Adds the frame parsed from a file, then evicts entries above the size limit.
+        Frames with columns of other dtypes than the ones of the parser (see ARRAY_KINDS) are not stored.
+        """
+        sidecar = {"columns": []}
+        for position, (name, column) in enumerate(df.items()):
+            if column.dtype == object:
+                sidecar["columns"].append({"name": name, "values": _text_values(column)})
+            elif isinstance(column.dtype, np.dtype) and column.dtype.kind in ARRAY_KINDS:
+                sidecar["columns"].append({"name": name, "file": f"{position}.npy"})
+            else:
+                return
+        if isinstance(df.index, pd.RangeIndex):
+            sidecar["index"] = {"range": [df.index.start, df.index.stop, df.index.step]}
+        elif df.index.dtype == object:
+            sidecar["index"] = {"values": _text_values(df.index)}
+        else:
+            sidecar["index"] = {"file": "index.npy"}
+        sidecar["index"]["name"] = df.index.name
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.entry_path(csv_file)
+        # Written in a folder of its own and renamed, so a concurrent run never reads a half written entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for column in sidecar["columns"]:
+            if "file" in column:
+                np.save(os.path.join(tmp_path, column["file"]), df[column["name"]].to_numpy(), allow_pickle=False)
+        if "file" in sidecar["index"]:
+            np.save(os.path.join(tmp_path, "index.npy"), df.index.to_numpy(), allow_pickle=False)
+        with open(os.path.join(tmp_path, SIDECAR_NAME), "w") as f:
+            json.dump(sidecar, f)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Stored by a concurrent run in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the folder fits in max_bytes.
+
+        Args:
+            keep (str): Entry that is never removed (the one just stored).
+        """
+        if not self.max_bytes:
+            return
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(CACHE_EXTENSION):
+                path = os.path.join(self.folder, name)
+                entries.append((os.stat(path).st_mtime, entry_size(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
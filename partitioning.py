@@ -0,0 +1,126 @@
+from collections import namedtuple
+from datetime import datetime
+
+GRANULARITY_DAY = "day"
+GRANULARITY_WEEK = "week"
+GRANULARITY_MONTH = "month"
+GRANULARITIES = (GRANULARITY_DAY, GRANULARITY_WEEK, GRANULARITY_MONTH)
+
+
+class Partition(namedtuple("Partition", ["granularity", "year", "month", "period", "chunk"])):
+    """
+    Time slice of the patient data that is converted and saved as one set of bundles.
+
+    period is the week of the month (1-5) for weekly partitions, the day of the month for daily
+    partitions and 0 for monthly partitions. chunk is 0 unless a row cap splits the partition.
+    """
+    __slots__ = ()
+
+    @property
+    def label(self):
+        """
+        Returns:
+            str: Name used in the bundle file names, e.g. 'year_2023_month_10_week_1'.
+        """
+        label = f"year_{self.year}_month_{self.month}"
+        if self.granularity == GRANULARITY_WEEK:
+            label += f"_week_{self.period}"
+        elif self.granularity == GRANULARITY_DAY:
+            label += f"_day_{self.period}"
+        if self.chunk:
+            label += f"_chunk_{self.chunk}"
+        return label
+
+    @property
+    def start(self):
+        """
+        Returns:
+            datetime: First instant of the partition period.
+        """
+        if self.granularity == GRANULARITY_WEEK:
+            return datetime(self.year, self.month, (self.period - 1) * 7 + 1)
+        if self.granularity == GRANULARITY_DAY:
+            return datetime(self.year, self.month, self.period)
+        return datetime(self.year, self.month, 1)
+
+
+def partition_of(timestamp, granularity=GRANULARITY_WEEK):
+    """
+    Returns:
+        Partition: The partition of a timestamp (without row cap chunk), see partition_key_columns.
+    """
+    if granularity == GRANULARITY_WEEK:
+        period = (timestamp.day - 1) // 7 + 1
+    elif granularity == GRANULARITY_DAY:
+        period = timestamp.day
+    else:
+        period = 0
+    return Partition(granularity, timestamp.year, timestamp.month, period, 0)
+
+
+def partition_key_columns(timestamps, granularity=GRANULARITY_WEEK):
+    """
+    Computes the partition key of every row in one vectorized pass.
+
+    Weeks are counted inside the month: days 1-7 are week 1, days 8-14 week 2, and so on,
+    so every row belongs to exactly one partition.
+
+    Args:
+        timestamps (pandas.Series): Timestamps of the rows.
+        granularity (str): 'day', 'week' or 'month'.
+
+    Returns:
+        list: Year, month and period key columns.
+    """
+    year = timestamps.dt.year.rename("year")
+    month = timestamps.dt.month.rename("month")
+    if granularity == GRANULARITY_WEEK:
+        period = ((timestamps.dt.day - 1) // 7 + 1).rename("period")
+    elif granularity == GRANULARITY_DAY:
+        period = timestamps.dt.day.rename("period")
+    else:
+        period = (timestamps.dt.day * 0).rename("period")
+    return [year, month, period]
+
+
+def partition_positions(df, granularity=GRANULARITY_WEEK, max_rows=0):
+    """
+    Splits the data into non-overlapping time partitions with a single grouping pass.
+
+    Partitions come out in chronological order and keep the CSV row order inside them,
+    so the generated bundles are deterministic.
+
+    Args:
+        df (pandas.DataFrame): Patient data with a 'Timestamp' column.
+        granularity (str): 'day', 'week' or 'month'.
+        max_rows (int): Split partitions larger than this number of rows into chunks (0 means no cap). Every resource
+            comes from one row, so it also caps the resources of each kind in a chunk.
+
+    Returns:
+        list: (Partition, positions) pairs, positions being the row positions (numpy array) of the partition.
+    """
+    if df.empty:
+        return []
+
+    partitions = []
+    groups = df.groupby(partition_key_columns(df['Timestamp'], granularity), sort=True).indices
+    for (year, month, period), positions in sorted(groups.items()):
+        if not max_rows:
+            partitions.append((Partition(granularity, int(year), int(month), int(period), 0), positions))
+            continue
+
+        for chunk, start in enumerate(range(0, len(positions), max_rows), start=1):
+            partitions.append((Partition(granularity, int(year), int(month), int(period), chunk),
+                               positions[start:start + max_rows]))
+    return partitions
+
+
+def iter_partitions(df, granularity=GRANULARITY_WEEK, max_rows=0):
+    """
+    Same as partition_positions, but yields the rows of every partition.
+
+    Yields:
+        tuple: The Partition and the rows that belong to it.
+    """
+    for partition, positions in partition_positions(df, granularity, max_rows):
+        yield partition, df.iloc[positions]
@@ -0,0 +1,141 @@
+"""
+JSON serialization of the bundles and resources.
+
+BUNDLE_SERIALIZER selects how they are turned into JSON:
+  "pydantic": model.json() of fhir.resources (the default), it walks the model through pydantic's dict()
+  "json":     the models are read into plain dictionaries directly (see model_to_dict) and encoded with the json module
+  "orjson":   the same dictionaries, encoded with orjson (C), needs the optional orjson package
+  "auto":     "orjson" when orjson is installed, "json" otherwise
+
+All of them give the same JSON document (orjson gives the very same bytes as "pydantic", which uses orjson itself when
+it is installed). In fast mode (FHIR_EMITTER=fast) the resources already are dictionaries, only the encoder changes.
+"""
+import json
+
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:  # optional, only needed for BUNDLE_SERIALIZER=orjson
+    orjson = None
+
+SERIALIZER_PYDANTIC = "pydantic"
+SERIALIZER_JSON = "json"
+SERIALIZER_ORJSON = "orjson"
+SERIALIZER_AUTO = "auto"
+SERIALIZERS = (SERIALIZER_PYDANTIC, SERIALIZER_JSON, SERIALIZER_ORJSON, SERIALIZER_AUTO)
+
+# Model class -> (field name -> JSON name, True when the JSON has a resourceType)
+_model_fields = {}
+
+
+def resolve_serializer(serializer):
+    """
+    Args:
+        serializer (str): One of SERIALIZERS.
+
+    Returns:
+        str: The serializer used, "auto" resolved.
+
+    Raises:
+        ValueError: If the serializer is unknown or its package is not installed.
+    """
+    if serializer == SERIALIZER_AUTO:
+        return SERIALIZER_ORJSON if orjson is not None else SERIALIZER_JSON
+    if serializer == SERIALIZER_ORJSON and orjson is None:
+        raise ValueError("BUNDLE_SERIALIZER 'orjson' needs the orjson package (pip install orjson)")
+    if serializer not in SERIALIZERS:
+        raise ValueError(f"Unknown bundle serializer '{serializer}', expected one of {SERIALIZERS}")
+    return serializer
+
+
+def model_to_dict(model):
+    """
+    Plain dictionary of a fhir.resources model, equal to model.dict() but read from the fields directly.
+
+    Args:
+        model (FHIRAbstractModel): Resource or element.
+
+    Returns:
+        dict: The fields that are set under their JSON names, with "resourceType" for resources.
+    """
+    model_class = type(model)
+    fields = _model_fields.get(model_class)
+    if fields is None:
+        fields = _model_fields[model_class] = (
+            {name: field.alias for name, field in model_class.__fields__.items()},
+            model_class.has_resource_base()
+        )
+    aliases, has_resource_type = fields
+
+    result = {}
+    for name, value in model.__dict__.items():
+        if value is None or name == "resource_type":
+            continue
+        if isinstance(value, BaseModel):
+            value = model_to_dict(value)
+        elif isinstance(value, list):
+            value = [model_to_dict(item) if isinstance(item, BaseModel) else item for item in value]
+        result[aliases.get(name, name)] = value
+    if has_resource_type:
+        result["resourceType"] = model.resource_type
+    return result
+
+
+def _orjson_dumps(value):
+    return orjson.dumps(value, default=pydantic_encoder).decode()
+
+
+def json_dumps_function(serializer):
+    """
+    Returns:
+        callable: Encoder of plain values to compact JSON text for the serializer, None for "pydantic"
+            (the resource dictionaries of the fast mode keep the json module, see emitter.render_resource).
+    """
+    serializer = resolve_serializer(serializer)
+    if serializer == SERIALIZER_ORJSON:
+        return _orjson_dumps
+    if serializer == SERIALIZER_JSON:
+        # One encoder for all the calls, json.dumps with arguments builds a new one every time
+        return json.JSONEncoder(separators=(",", ":"), default=pydantic_encoder).encode
+    return None
+
+
+def bundle_serializer(serializer):
+    """
+    Args:
+        serializer (str): One of SERIALIZERS.
+
+    Returns:
+        callable: Function giving the JSON of a bundle (fhir.resources Bundle or emitter.FastBundle).
+    """
+    dumps = json_dumps_function(serializer)
+
+    def serialize(bundle):
+        if dumps is None:
+            return bundle.json()
+        if isinstance(bundle, BaseModel):
+            return dumps(model_to_dict(bundle))
+        return bundle.json(dumps)
+
+    return serialize
+
+
+def resource_serializer(serializer):
+    """
+    Args:
+        serializer (str): One of SERIALIZERS.
+
+    Returns:
+        callable: Function giving the compact JSON of a resource (model or dictionary).
+    """
+    dumps = json_dumps_function(serializer)
+    default_dumps = json.JSONEncoder(separators=(",", ":")).encode
+
+    def serialize(resource):
+        if isinstance(resource, BaseModel):
+            return resource.json() if dumps is None else dumps(model_to_dict(resource))
+        return (dumps or default_dumps)(resource)
+
+    return serialize
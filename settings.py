@@ -0,0 +1,505 @@
+import hashlib
+import os
+from bisect import bisect_left
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from dotenv import dotenv_values, load_dotenv
+
+from bundle_output import COMPRESSIONS, compression_codec
+from partitioning import GRANULARITIES
+from serialization import SERIALIZERS, resolve_serializer
+from utils import IDENTIFIER_HASHES, identifier_hash_function
+
+EMITTERS = ("model", "fast")
+
+# OUTPUT_FORMAT: transaction bundle files, or FHIR Bulk Data NDJSON files (see ndjson_output.py)
+OUTPUT_BUNDLES = "bundles"
+OUTPUT_NDJSON = "ndjson"
+OUTPUT_FORMATS = (OUTPUT_BUNDLES, OUTPUT_NDJSON)
+
+# CGM_RESAMPLE_AGGREGATION: value of a resampled sensor reading (see conversion.resample_cgm_readings)
+CGM_RESAMPLE_AGGREGATIONS = ("mean", "min", "max", "last")
+
+# Settings that change how a conversion runs, not the bundles it produces
+RUNTIME_FIELDS = (
+    "folder_bundle_destination", "csv_chunk_size", "parallel_workers", "batch_workers", "incremental_state_folder",
+    "identifier_index_path", "fhir_base_url", "fhir_upload_workers", "fhir_upload_max_retries", "fhir_upload_backoff",
+    "fhir_upload_timeout", "fhir_auth_token", "fhir_emitter", "validation_sample_every", "validation_sample_fraction",
+    "validation_sample_seed", "bundle_serializer", "parse_cache_folder", "parse_cache_max_bytes", "run_report",
+    "progress_interval", "profile_folder", "file_messages"
+)
+
+
+@dataclass(frozen=True)
+class Coding:
+    system: str
+    code: str
+    display: str
+
+    def dict(self):
+        return {"system": self.system, "code": self.code, "display": self.display}
+
+
+@dataclass(frozen=True)
+class GlucoseInterpretation:
+    """
+    Glucose interpretation codes with their thresholds, precompiled as sorted upper bounds.
+
+    A value gets the code of the first bound it does not exceed (codes[i] for value <= bounds[i]),
+    values above the last bound get the last code. The glucose Observations carry the code when enabled.
+    """
+    enabled: bool
+    codes: Tuple[Coding, ...]
+    bounds_mmol: Tuple[float, ...]
+    bounds_mg: Tuple[float, ...]
+
+    def bounds(self, unit):
+        """
+        Args:
+            unit (str): 'mmol' or 'mg'.
+        """
+        return self.bounds_mmol if unit == "mmol" else self.bounds_mg
+
+    def interpret(self, value, unit):
+        """
+        Returns:
+            Coding: The interpretation code of a glucose value.
+        """
+        return self.codes[bisect_left(self.bounds(unit), value)]
+
+    def interpret_values(self, values, unit):
+        """
+        Args:
+            values (numpy.ndarray): Glucose values.
+            unit (str): 'mmol' or 'mg'.
+
+        Returns:
+            numpy.ndarray: Index in codes of the interpretation of every value, the same as interpret() gives.
+        """
+        return np.searchsorted(np.asarray(self.bounds(unit)), values, side="left")
+
+
+@dataclass(frozen=True)
+class GlucoseSummary:
+    """
+    Codes of the CGM summary Observations, one per partition when enabled (see conversion.py).
+
+    ranges holds the codes of the time in every glucose range, in the order of the interpretation codes
+    (LU, L, N, H, HU), the ranges are the ones of GlucoseInterpretation.
+    """
+    enabled: bool
+    coding: Coding
+    mean_mmol: Coding
+    mean_mg: Coding
+    ranges: Tuple[Coding, ...]
+    gmi: Coding
+    cv: Coding
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Configuration of the conversion, read and validated once from the environment (.env).
+    """
+    timestamp_format: str
+    id_system: str
+    identifier_hash: str
+    max_bundle_size: int
+    max_bundle_bytes: int
+    output_format: str
+    ndjson_max_bytes: int
+    output_compression: str
+    output_archive: str
+    bundle_serializer: str
+    parse_cache_folder: str
+    parse_cache_max_bytes: int
+    insulin_threshold: float
+    folder_bundle_destination: str
+
+    # Partitions and execution
+    partition_granularity: str
+    partition_max_rows: int
+    csv_chunk_size: int
+    parallel_workers: int
+    batch_workers: int
+    incremental_state_folder: str
+    identifier_index_path: str
+
+    # Instrumentation (see instrumentation.py)
+    run_report: str
+    progress_interval: float
+    profile_folder: str
+    file_messages: bool
+
+    # Upload to a FHIR server
+    fhir_base_url: str
+    fhir_upload_workers: int
+    fhir_upload_max_retries: int
+    fhir_upload_backoff: float
+    fhir_upload_timeout: float
+    fhir_auth_token: str
+
+    # Resource emitter
+    fhir_emitter: str
+    validation_sample_every: int
+    validation_sample_fraction: float
+    validation_sample_seed: Optional[int]
+
+    # Medtronic specific codes in the CSV
+    bg_readin_received: str
+    closed_loop_auto_basal: str
+    closed_loop_auto_insulin: str
+    closed_loop_bg_correction_and_food_bolus: str
+    closed_loop_auto_bolus: str
+    closed_loop_bg_correction: str
+
+    # Glucose
+    glucose_scale_mmol: str
+    glucose_scale_mmol_display: str
+    glucose_scale_mg: str
+    glucose_scale_mg_display: str
+    cgm_glucose_code: str
+    bg_glucose_code: str
+    glucose_interpretation: GlucoseInterpretation
+    glucose_summary: GlucoseSummary
+    cgm_resample_interval: str
+    cgm_resample_aggregation: str
+
+    # Insulin
+    basal_coding: Coding
+    basal_unit: str
+    basal_unit_system: str
+    bolus_coding: Coding
+    bolus_unit: str
+    bolus_unit_system: str
+    correction_coding: Coding
+    correction_unit: str
+    correction_unit_system: str
+
+    # Carbohydrates and insulin-carb ratio
+    carbohydrates_coding: Coding
+    carbohydrates_unit: str
+    carbohydrates_unit_system: str
+    carbohydrates_unit_code: str
+    icr_coding: Coding
+    icr_unit: str
+    icr_enabled: bool
+
+    # Consecutive basal rates and insulin-carb ratios with the same value as one resource with an effectivePeriod
+    compress_setting_changes: bool
+
+    @property
+    def basal_sources(self):
+        return self.closed_loop_auto_basal, self.closed_loop_auto_insulin
+
+    @property
+    def correction_sources(self):
+        return self.closed_loop_auto_bolus, self.closed_loop_bg_correction
+
+    @property
+    def bolus_source(self):
+        return self.closed_loop_bg_correction_and_food_bolus
+
+    def fingerprint(self):
+        """
+        Returns:
+            str: Digest of the settings that affect the content of the bundles (all but RUNTIME_FIELDS).
+        """
+        values = [(f.name, getattr(self, f.name)) for f in fields(self) if f.name not in RUNTIME_FIELDS]
+        return hashlib.sha256(repr(values).encode()).hexdigest()
+
+    def replace(self, **changes):
+        """
+        Returns:
+            Settings: A copy of the settings with some values changed.
+        """
+        values = {f.name: getattr(self, f.name) for f in fields(self)}
+        values.update(changes)
+        return Settings(**values)
+
+
+class _Environment:
+    def __init__(self, environ):
+        self.environ = environ
+
+    def str(self, name, default):
+        value = self.environ.get(name)
+        return default if value is None else value
+
+    def int(self, name, default, minimum=0):
+        value = self.str(name, default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be an integer, got '{value}'")
+        if value < minimum:
+            raise ValueError(f"{name} must be at least {minimum}, got {value}")
+        return value
+
+    def float(self, name, default):
+        value = self.str(name, default)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number, got '{value}'")
+
+    def bool(self, name, default):
+        value = self.str(name, default)
+        if isinstance(value, bool):
+            return value
+        value = value.strip().lower()
+        if value in ("1", "true", "yes", "on"):
+            return True
+        if value in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError(f"{name} must be true or false, got '{value}'")
+
+    def choice(self, name, default, choices):
+        value = self.str(name, default).strip().lower()
+        if value not in choices:
+            raise ValueError(f"Unknown {name} '{value}', expected one of {choices}")
+        return value
+
+    def coding(self, prefix, system, code, display):
+        return Coding(
+            self.str(f"{prefix}_SYSTEM", system),
+            self.str(f"{prefix}_CODE", code),
+            self.str(f"{prefix}_DISPLAY", display)
+        )
+
+
+def _load_glucose_interpretation(env):
+    codes = tuple(
+        Coding(
+            env.str("GLUCOSE_INTERPRETATION_SYSTEM", "http://loinc.org"),
+            env.str(f"GLUCOSE_INTERPRETATION_{code}_CODE", code),
+            env.str(f"GLUCOSE_INTERPRETATION_{code}_DISPLAY", code)
+        )
+        for code in ("LU", "L", "N", "H", "HU")
+    )
+    # Upper bounds of LU, L, N and H; anything above the H bound is HU
+    bounds_mmol = (
+        env.float("GLUCOSE_INTERPRETATION_LU_MMOL", 3),
+        env.float("GLUCOSE_INTERPRETATION_L_MMOL", 3.9),
+        env.float("GLUCOSE_INTERPRETATION_H_MMOL", 10),
+        env.float("GLUCOSE_INTERPRETATION_HU_MMOL", 13.9)
+    )
+    bounds_mg = (
+        env.float("GLUCOSE_INTERPRETATION_LU_MG", 54),
+        env.float("GLUCOSE_INTERPRETATION_L_MG", 70),
+        env.float("GLUCOSE_INTERPRETATION_H_MG", 180),
+        env.float("GLUCOSE_INTERPRETATION_HU_MG", 250)
+    )
+    for unit, bounds in (("MMOL", bounds_mmol), ("MG", bounds_mg)):
+        if list(bounds) != sorted(bounds):
+            raise ValueError(f"GLUCOSE_INTERPRETATION_*_{unit} thresholds must increase from LU to HU")
+
+    return GlucoseInterpretation(
+        enabled=env.bool("GLUCOSE_INTERPRETATION_ENABLED", False),
+        codes=codes,
+        bounds_mmol=bounds_mmol,
+        bounds_mg=bounds_mg
+    )
+
+
+def _load_glucose_summary(env):
+    system = env.str("GLUCOSE_SUMMARY_SYSTEM", "http://hl7.org/uv/cgm/CodeSystem/cgm-summary-codes-temporary")
+
+    def coding(name, code, display):
+        return Coding(
+            system,
+            env.str(f"GLUCOSE_SUMMARY_{name}_CODE", code),
+            env.str(f"GLUCOSE_SUMMARY_{name}_DISPLAY", display)
+        )
+
+    return GlucoseSummary(
+        enabled=env.bool("GLUCOSE_SUMMARY_ENABLED", False),
+        coding=Coding(system, env.str("GLUCOSE_SUMMARY_CODE", "cgm-summary"),
+                      env.str("GLUCOSE_SUMMARY_DISPLAY", "CGM summary")),
+        mean_mmol=coding("MEAN_MMOL", "mean-glucose-moles-per-volume", "Mean glucose"),
+        mean_mg=coding("MEAN_MG", "mean-glucose-mass-per-volume", "Mean glucose"),
+        ranges=(
+            coding("TIME_VERY_LOW", "time-in-very-low", "Time in very low range"),
+            coding("TIME_LOW", "time-in-low", "Time in low range"),
+            coding("TIME_TARGET", "time-in-target", "Time in target range"),
+            coding("TIME_HIGH", "time-in-high", "Time in high range"),
+            coding("TIME_VERY_HIGH", "time-in-very-high", "Time in very high range"),
+        ),
+        gmi=coding("GMI", "gmi", "Glucose management indicator"),
+        cv=coding("CV", "cv", "Coefficient of variation"),
+    )
+
+
+def load_settings(environ=None):
+    """
+    Reads and validates the configuration.
+
+    Args:
+        environ (Mapping): Variables to read, the process environment (plus the .env file) when not given.
+
+    Returns:
+        Settings: The validated configuration.
+
+    Raises:
+        ValueError: If a value does not have a valid format.
+    """
+    if environ is None:
+        load_dotenv()
+        environ = os.environ
+    env = _Environment(environ)
+
+    timestamp_format = env.str("TIMESTAMP_FORMAT", "%Y-%m-%dT%H:%M:%S+00:00")
+    datetime(2000, 1, 1).strftime(timestamp_format)
+
+    identifier_hash = env.choice("IDENTIFIER_HASH", "sha256", IDENTIFIER_HASHES)
+    identifier_hash_function(identifier_hash)
+
+    output_format = env.choice("OUTPUT_FORMAT", OUTPUT_BUNDLES, OUTPUT_FORMATS)
+    if output_format == OUTPUT_NDJSON and env.str("FHIR_BASE_URL", ""):
+        raise ValueError("FHIR_BASE_URL uploads transaction bundles, it cannot be used with OUTPUT_FORMAT=ndjson")
+    if (output_format == OUTPUT_NDJSON and env.str("INCREMENTAL_STATE_FOLDER", "")
+            and not env.str("IDENTIFIER_INDEX_PATH", "")):
+        # A changed partition is converted again, the NDJSON files of the previous run would repeat its resources
+        raise ValueError("INCREMENTAL_STATE_FOLDER with OUTPUT_FORMAT=ndjson needs IDENTIFIER_INDEX_PATH, "
+                         "so the resources of a converted partition are not written again")
+    output_compression = env.choice("OUTPUT_COMPRESSION", "none", COMPRESSIONS)
+    compression_codec(output_compression)
+    bundle_serializer = resolve_serializer(env.choice("BUNDLE_SERIALIZER", "pydantic", SERIALIZERS))
+
+    cgm_resample_interval = env.str("CGM_RESAMPLE_INTERVAL", "").strip()
+    if cgm_resample_interval:
+        try:
+            offset = pd.tseries.frequencies.to_offset(cgm_resample_interval)
+        except ValueError:
+            offset = None
+        if not isinstance(offset, pd.tseries.offsets.Tick):
+            raise ValueError(f"CGM_RESAMPLE_INTERVAL must be a fixed interval like '15min' or '1h', "
+                             f"got '{cgm_resample_interval}'")
+
+    progress_interval = env.float("PROGRESS_INTERVAL", 0)
+    if progress_interval < 0:
+        raise ValueError(f"PROGRESS_INTERVAL must be at least 0, got {progress_interval}")
+
+    seed = env.str("FHIR_VALIDATION_SAMPLE_SEED", "")
+    fraction = env.float("FHIR_VALIDATION_SAMPLE_FRACTION", 0)
+    if not 0 <= fraction <= 1:
+        raise ValueError(f"FHIR_VALIDATION_SAMPLE_FRACTION must be between 0 and 1, got {fraction}")
+
+    return Settings(
+        timestamp_format=timestamp_format,
+        id_system=env.str("ID_SYSTEM", ""),
+        identifier_hash=identifier_hash,
+        max_bundle_size=env.int("MAX_BUNDLE_SIZE", 500, minimum=1),
+        max_bundle_bytes=env.int("MAX_BUNDLE_BYTES", 0),
+        output_format=output_format,
+        ndjson_max_bytes=env.int("NDJSON_MAX_BYTES", 0),
+        output_compression=output_compression,
+        output_archive=env.str("OUTPUT_ARCHIVE", ""),
+        bundle_serializer=bundle_serializer,
+        parse_cache_folder=env.str("PARSE_CACHE_FOLDER", ""),
+        parse_cache_max_bytes=env.int("PARSE_CACHE_MAX_BYTES", 1 << 30),
+        insulin_threshold=env.float("INSULIN_THRESHOLD", "0"),
+        folder_bundle_destination=env.str("FOLDER_BUNDLE_DESTINATION", "Bundles"),
+
+        partition_granularity=env.choice("PARTITION_GRANULARITY", "week", GRANULARITIES),
+        partition_max_rows=env.int("PARTITION_MAX_ROWS", 0),
+        csv_chunk_size=env.int("CSV_CHUNK_SIZE", 0),
+        parallel_workers=env.int("PARALLEL_WORKERS", 0),
+        batch_workers=env.int("BATCH_WORKERS", 0),
+        incremental_state_folder=env.str("INCREMENTAL_STATE_FOLDER", ""),
+        identifier_index_path=env.str("IDENTIFIER_INDEX_PATH", ""),
+
+        run_report=env.str("RUN_REPORT", ""),
+        progress_interval=progress_interval,
+        profile_folder=env.str("PROFILE_FOLDER", ""),
+        file_messages=env.bool("FILE_MESSAGES", True),
+
+        fhir_base_url=env.str("FHIR_BASE_URL", ""),
+        fhir_upload_workers=env.int("FHIR_UPLOAD_WORKERS", 4, minimum=1),
+        fhir_upload_max_retries=env.int("FHIR_UPLOAD_MAX_RETRIES", 5),
+        fhir_upload_backoff=env.float("FHIR_UPLOAD_BACKOFF", 0.5),
+        fhir_upload_timeout=env.float("FHIR_UPLOAD_TIMEOUT", 60),
+        fhir_auth_token=env.str("FHIR_AUTH_TOKEN", ""),
+
+        fhir_emitter=env.choice("FHIR_EMITTER", "model", EMITTERS),
+        validation_sample_every=env.int("FHIR_VALIDATION_SAMPLE_EVERY", 0),
+        validation_sample_fraction=fraction,
+        validation_sample_seed=int(seed) if seed else None,
+
+        bg_readin_received=env.str("MEDTRONIC_BG_READIN_RECEIVED", "BG_READIN_RECEIVED"),
+        closed_loop_auto_basal=env.str("MEDTRONIC_CLOSED_LOOP_AUTO_BASAL", "CLOSED_LOOP_AUTO_BASAL"),
+        closed_loop_auto_insulin=env.str("MEDTRONIC_CLOSED_LOOP_AUTO_INSULIN", "CLOSED_LOOP_AUTO_INSULIN"),
+        closed_loop_bg_correction_and_food_bolus=env.str("MEDTRONIC_CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS",
+                                                         "CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS"),
+        closed_loop_auto_bolus=env.str("MEDTRONIC_CLOSED_LOOP_AUTO_BOLUS", "CLOSED_LOOP_AUTO_BOLUS"),
+        closed_loop_bg_correction=env.str("MEDTRONIC_CLOSED_LOOP_BG_CORRECTION", "CLOSED_LOOP_BG_CORRECTION"),
+
+        glucose_scale_mmol=env.str("GLUCOSE_SCALE_MMOL", "mmol/L"),
+        glucose_scale_mmol_display=env.str("GLUCOSE_SCALE_MMOL_DISPLAY", "[Moles/volume]"),
+        glucose_scale_mg=env.str("GLUCOSE_SCALE_MG", "mg/dL"),
+        glucose_scale_mg_display=env.str("GLUCOSE_SCALE_MG_DISPLAY", "[Milligrams per deciliter]"),
+        cgm_glucose_code=env.str("CGM_GLUCOSE_CODE", "14745-4"),
+        bg_glucose_code=env.str("BG_GLUCOSE_CODE", "41653-7"),
+        glucose_interpretation=_load_glucose_interpretation(env),
+        glucose_summary=_load_glucose_summary(env),
+        cgm_resample_interval=cgm_resample_interval,
+        cgm_resample_aggregation=env.choice("CGM_RESAMPLE_AGGREGATION", "mean", CGM_RESAMPLE_AGGREGATIONS),
+
+        basal_coding=env.coding("MEDICATION_ADMINISTRATION_BASAL", "http://snomed.info/sct", "25305005", "25305005"),
+        basal_unit=env.str("MEDICATION_ADMINISTRATION_BASAL_UNIT_CODE", "U/h"),
+        basal_unit_system=env.str("MEDICATION_ADMINISTRATION_BASAL_UNIT_SYSTEM", "http://unitsofmeasure.org"),
+        bolus_coding=env.coding("MEDICATION_ADMINISTRATION_BOLUS", "http://snomed.info/sct", "A10AB",
+                                "Background Insulin"),
+        bolus_unit=env.str("MEDICATION_ADMINISTRATION_BOLUS_UNIT_CODE", "U"),
+        bolus_unit_system=env.str("MEDICATION_ADMINISTRATION_BOLUS_UNIT_SYSTEM", "http://unitsofmeasure.org"),
+        correction_coding=env.coding("MEDICATION_ADMINISTRATION_CORRECTION", "http://snomed.info/sct", "CORRECTION",
+                                     "Corretion Insulin"),
+        correction_unit=env.str("MEDICATION_ADMINISTRATION_CORRECTION_UNIT_CODE", "U"),
+        correction_unit_system=env.str("MEDICATION_ADMINISTRATION_CORRECTION_UNIT_SYSTEM",
+                                       "http://unitsofmeasure.org"),
+
+        carbohydrates_coding=env.coding("CARBOHYDRATES_EST", "http://loinc.org", "9059-7",
+                                        "Carbohydrate intake estimated"),
+        carbohydrates_unit=env.str("CARBOHYDRATES_EST_UNIT", "g"),
+        carbohydrates_unit_system=env.str("CARBOHYDRATES_EST_UNIT_SYSTEM", "http://unitsofmeasure.org"),
+        carbohydrates_unit_code=env.str("CARBOHYDRATES_EST_UNIT_CODE", "g"),
+        icr_coding=env.coding("ICR", "http://loinc.org", "Insulin-carb-ratio", "Insulin-Carb Ratio"),
+        icr_unit=env.str("ICR_UNIT", "units/g"),
+        icr_enabled=env.bool("ICR_ENABLED", False),
+
+        compress_setting_changes=env.bool("COMPRESS_SETTING_CHANGES", False),
+    )
+
+
+def load_settings_file(env_file, environ=None):
+    """
+    Reads the configuration from an .env file, on top of the process environment.
+
+    Args:
+        env_file (str): Path of the .env file.
+        environ (Mapping): Base variables, the process environment when not given.
+
+    Returns:
+        Settings: The validated configuration.
+    """
+    values = dict(os.environ if environ is None else environ)
+    values.update({key: value for key, value in dotenv_values(env_file).items() if value is not None})
+    return load_settings(values)
+
+
+_settings = None
+
+
+def get_settings():
+    """
+    Returns:
+        Settings: The configuration of the process environment, loaded on the first call.
+    """
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
@@ -0,0 +1,351 @@
+"""
+Synthetic CareLink CSV exports, to measure and test the conversion on any amount of data.
+
+Usage:
+    python synthetic.py <CSV file | folder> [--days N] [--patients N] [--start YYYY-MM-DD] [--seed N]
+                        [--unit mmol|mg] [--sensor-section]
+
+The exports have the layout of the CareLink exports of a MiniMed 780G (see DEMO/data.csv): metadata header, device
+section line, the column header, then one row per event, newest first, separated by semicolons with decimal commas.
+Every day has sensor glucose every 5 minutes (with the gaps of the sensor changes), closed loop auto basal deliveries,
+meals with their Bolus Wizard estimate and bolus, automatic corrections, manual BG readings, basal profile changes and
+pump rewinds. With --sensor-section, the sensor glucose is written in its own device section, with its own header.
+
+With --patients N, N exports are written in the folder (patient_001.csv, ...), ready for batch.py.
+The same seed always gives the same files.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Columns of the pump section of a MiniMed 780G export, in mmol/L ('mmol/L' becomes 'mg/dL' for mg/dL exports)
+CARELINK_COLUMNS = [
+    'Index', 'Date', 'Time', 'New Device Time', 'BG Source', 'BG Reading (mmol/L)', 'Linked BG Meter ID',
+    'Basal Rate (U/h)', 'Temp Basal Amount', 'Temp Basal Type', 'Temp Basal Duration (h:mm:ss)', 'Bolus Type',
+    'Bolus Volume Selected (U)', 'Bolus Volume Delivered (U)', 'Bolus Duration (h:mm:ss)', 'Prime Type',
+    'Prime Volume Delivered (U)', 'Alarm', 'Suspend', 'Rewind', 'BWZ Estimate (U)', 'BWZ Target High BG (mmol/L)',
+    'BWZ Target Low BG (mmol/L)', 'BWZ Carb Ratio (g/U)', 'BWZ Insulin Sensitivity (mmol/L/U)',
+    'BWZ Carb Input (grams)', 'BWZ BG/SG Input (mmol/L)', 'BWZ Correction Estimate (U)', 'BWZ Food Estimate (U)',
+    'BWZ Active Insulin (U)', 'BWZ Status', 'Sensor Calibration BG (mmol/L)', 'Sensor Glucose (mmol/L)',
+    'ISIG Value', 'Event Marker', 'Bolus Number', 'Bolus Cancellation Reason', 'BWZ Unabsorbed Insulin Total (U)',
+    'Final Bolus Estimate', 'Scroll Step Size', 'Insulin Action Curve Time', 'Sensor Calibration Rejected Reason',
+    'Preset Bolus', 'Bolus Source', 'BLE Network Device', 'Device Update Event', 'Network Device Associated Reason',
+    'Network Device Disassociated Reason', 'Network Device Disconnected Reason', 'Sensor Exception',
+    'Preset Temp Basal Name'
+]
+SENSOR_COLUMNS = ['Index', 'Date', 'Time', 'Sensor Glucose (mmol/L)', 'ISIG Value', 'Sensor Exception']
+
+DEVICE = "MiniMed 780G MMT-1885"
+UNITS = ("mmol", "mg")
+MG_PER_MMOL = 18.016
+
+CGM_INTERVAL_MINUTES = 5
+SENSOR_DAYS = 7
+# Mean time (minutes from midnight) and spread of the meals
+MEALS = ((7 * 60 + 30, 40), (12 * 60 + 45, 45), (19 * 60 + 15, 60))
+# Basal profile: start hour and rate (U/h) of every segment
+BASAL_PROFILE = ((0, 0.65), (6, 0.9), (12, 0.75), (20, 0.7))
+# Insulin-carb ratio (g/U) by time of day: start hour and ratio
+CARB_RATIO_PROFILE = ((0, 8.0), (11, 9.0), (17, 7.0))
+
+
+def format_decimal(values, decimals=None):
+    """
+    Args:
+        values (numpy.ndarray): Numbers.
+        decimals (int): Fixed decimals, None to write the shortest form (e.g. 0,025 or 2,2).
+
+    Returns:
+        numpy.ndarray: The numbers as CareLink text, with decimal commas.
+    """
+    values = np.asarray(values, dtype=float)
+    if decimals is None:
+        text = np.char.mod('%g', np.round(values, 3))
+    else:
+        text = np.char.mod(f'%.{decimals}f', values)
+    return np.char.replace(text, '.', ',')
+
+
+def _profile_values(minutes, profile):
+    """
+    Returns:
+        numpy.ndarray: Value of a time of day profile (start hour, value) at the given minutes from midnight.
+    """
+    starts = np.array([hour * 60 for hour, _ in profile])
+    values = np.array([value for _, value in profile])
+    return values[np.searchsorted(starts, minutes % (24 * 60), side='right') - 1]
+
+
+def _glucose_curve(rng, days, meal_minutes, meal_carbs):
+    """
+    Returns:
+        numpy.ndarray: Sensor glucose (mmol/L) every 5 minutes: daily rhythm, meal responses and sensor noise.
+    """
+    count = days * 24 * 60 // CGM_INTERVAL_MINUTES
+    hours = np.arange(count) * CGM_INTERVAL_MINUTES / 60
+    glucose = 7.8 + 1.2 * np.sin(2 * np.pi * (hours - 4) / 24)
+
+    # Every meal raises the glucose, peaking after one hour, and its bolus lowers it, peaking after two and a half
+    # hours: a bolus that does not match the meal gives the highs and lows
+    kernel_minutes = np.arange(0, 6 * 60, CGM_INTERVAL_MINUTES)
+    carbs_kernel = (kernel_minutes / 60) * np.exp(1 - kernel_minutes / 60)
+    insulin_kernel = (kernel_minutes / 150) * np.exp(1 - kernel_minutes / 150)
+    mismatch = rng.lognormal(0, 0.45, len(meal_minutes))
+    positions = (meal_minutes // CGM_INTERVAL_MINUTES)[:, None] + np.arange(len(kernel_minutes))
+    responses = meal_carbs[:, None] * (0.09 * carbs_kernel - 0.05 * mismatch[:, None] * insulin_kernel)
+    inside = positions < count
+    np.add.at(glucose, positions[inside], responses[inside])
+
+    # Slow drift plus measurement noise
+    drift = np.convolve(rng.normal(0, 1.1, count), np.ones(24) / np.sqrt(24), mode='same')
+    glucose += drift + rng.normal(0, 0.15, count)
+    return np.clip(glucose, 2.2, 22.2)
+
+
+def _events(rows, timestamps, **columns):
+    """
+    Returns:
+        pandas.DataFrame: Rows of one kind of event, with their 'Timestamp' and text columns.
+    """
+    frame = pd.DataFrame({name: np.broadcast_to(np.asarray(value, dtype=object), rows) for name, value in
+                          columns.items()})
+    frame.insert(0, 'Timestamp', timestamps)
+    return frame
+
+
+def synthetic_events(days, start, seed=0, unit="mmol"):
+    """
+    Generates the events of a synthetic patient.
+
+    Args:
+        days (int): Number of days.
+        start (datetime): First day.
+        seed (int): Seed of the random generator.
+        unit (str): 'mmol' or 'mg'.
+
+    Returns:
+        tuple: (pump events, sensor events) as frames with a 'Timestamp' column and the CareLink columns in mmol/L
+            names, the values already written as CareLink text.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    scale = MG_PER_MMOL if unit == "mg" else 1.0
+    glucose_decimals = 0 if unit == "mg" else 1
+    bg_decimals = 0 if unit == "mg" else 2
+    pump = []
+
+    # Meals: three a day around the usual times
+    day_starts = np.arange(days) * 24 * 60
+    meal_minutes = np.concatenate([
+        day_starts + np.clip(rng.normal(mean, spread, days), 0, 24 * 60 - 1) for mean, spread in MEALS
+    ]).astype(int)
+    meal_minutes.sort()
+    meal_carbs = rng.integers(4, 19, len(meal_minutes)) * 5.0
+
+    glucose = _glucose_curve(rng, days, meal_minutes, meal_carbs)
+    count = len(glucose)
+    cgm_times = start + pd.to_timedelta(np.arange(count) * CGM_INTERVAL_MINUTES * 60
+                                        + rng.integers(0, 60, count), unit='s')
+
+    # Sensor glucose, without the 2 hours of warm-up after every sensor change and a few lost readings
+    minutes = np.arange(count) * CGM_INTERVAL_MINUTES
+    warm_up = (minutes % (SENSOR_DAYS * 24 * 60)) < 120
+    sensor = ~warm_up & (rng.random(count) > 0.02)
+    sensor_values = glucose[sensor] * scale
+    sensor_events = _events(
+        int(sensor.sum()), cgm_times[sensor],
+        **{'Sensor Glucose (mmol/L)': format_decimal(sensor_values, glucose_decimals),
+           'ISIG Value': format_decimal(glucose[sensor] * rng.normal(3.1, 0.1, int(sensor.sum())), 2)}
+    )
+
+    # Closed loop auto basal: a micro bolus with every reading, larger when the glucose is high
+    amounts = np.clip(np.round((glucose - 5.5) * 0.03 / 0.025) * 0.025 + 0.05, 0, 0.25)
+    delivered = amounts > 0
+    basal_times = cgm_times[delivered] + pd.to_timedelta(rng.integers(20, 90, int(delivered.sum())), unit='s')
+    amount_text = format_decimal(amounts[delivered])
+    pump.append(_events(
+        int(delivered.sum()), basal_times,
+        **{'Bolus Type': 'Normal', 'Bolus Volume Selected (U)': amount_text,
+           'Bolus Volume Delivered (U)': amount_text, 'Bolus Source': 'CLOSED_LOOP_AUTO_BASAL'}
+    ))
+
+    # Meals: Bolus Wizard estimate, the bolus selected, then delivered a minute later
+    meal_times = start + pd.to_timedelta(meal_minutes * 60 + rng.integers(0, 60, len(meal_minutes)), unit='s')
+    # The carb ratio profile is adjusted now and then
+    ratio_shift = np.cumsum(rng.random(days) < 0.03) * 0.5
+    carb_ratios = _profile_values(meal_minutes, CARB_RATIO_PROFILE) + ratio_shift[meal_minutes // (24 * 60)]
+    food = np.round(meal_carbs / carb_ratios, 1)
+    meal_glucose = glucose[np.minimum(meal_minutes // CGM_INTERVAL_MINUTES, count - 1)]
+    correction = np.round(np.clip((meal_glucose - 7) / 3, 0, None), 1)
+    bolus = format_decimal(food + correction)
+    meals = len(meal_minutes)
+    pump.append(_events(
+        meals, meal_times,
+        **{'BWZ Estimate (U)': bolus, 'BWZ Carb Ratio (g/U)': format_decimal(carb_ratios, 2),
+           'BWZ Carb Input (grams)': format_decimal(meal_carbs, 2),
+           'BWZ BG/SG Input (mmol/L)': format_decimal(meal_glucose * scale, bg_decimals),
+           'BWZ Correction Estimate (U)': format_decimal(correction), 'BWZ Food Estimate (U)': format_decimal(food),
+           'BWZ Status': 'Delivered'}
+    ))
+    pump.append(_events(
+        meals, meal_times,
+        **{'Bolus Type': 'Normal', 'Bolus Volume Selected (U)': bolus,
+           'Bolus Source': 'CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS'}
+    ))
+    pump.append(_events(
+        meals, meal_times + pd.to_timedelta(rng.integers(60, 120, meals), unit='s'),
+        **{'Bolus Type': 'Normal', 'Bolus Volume Selected (U)': bolus, 'Bolus Volume Delivered (U)': bolus,
+           'Bolus Source': 'CLOSED_LOOP_BG_CORRECTION_AND_FOOD_BOLUS'}
+    ))
+
+    # Automatic corrections when the glucose stays high
+    high = np.flatnonzero((glucose > 11) & (rng.random(count) < 0.04))
+    correction_text = format_decimal(np.round(rng.uniform(0.3, 1.5, len(high)), 1))
+    pump.append(_events(
+        len(high), cgm_times[high] + pd.to_timedelta(150, unit='s'),
+        **{'Bolus Type': 'Normal', 'Bolus Volume Selected (U)': correction_text,
+           'Bolus Volume Delivered (U)': correction_text, 'Bolus Source': 'CLOSED_LOOP_AUTO_BOLUS'}
+    ))
+
+    # Manual BG: two readings a day, received from the meter and accepted on the pump, some for calibration
+    readings = rng.choice(count, size=2 * days, replace=False)
+    readings.sort()
+    bg_text = format_decimal(glucose[readings] * scale + rng.normal(0, 0.3 * scale, len(readings)), bg_decimals)
+    bg_times = cgm_times[readings] + pd.to_timedelta(100, unit='s')
+    meter = '11400070586'
+    pump.append(_events(len(readings), bg_times, **{'BG Source': 'BG_READIN_RECEIVED', 'BG Reading (mmol/L)': bg_text,
+                                                    'Linked BG Meter ID': meter}))
+    pump.append(_events(len(readings), bg_times + pd.to_timedelta(5, unit='s'),
+                        **{'BG Source': 'USER_ACCEPTED_REMOTE_BG', 'BG Reading (mmol/L)': bg_text,
+                           'Linked BG Meter ID': meter}))
+    calibration = rng.random(len(readings)) < 0.3
+    pump.append(_events(int(calibration.sum()), bg_times[calibration] + pd.to_timedelta(30, unit='s'),
+                        **{'BG Source': 'BG_SENT_FOR_CALIB', 'BG Reading (mmol/L)': bg_text[calibration],
+                           'Linked BG Meter ID': meter}))
+
+    # Basal profile segments every day
+    segment_days = np.repeat(np.arange(days), len(BASAL_PROFILE))
+    segment_hours = np.tile([hour for hour, _ in BASAL_PROFILE], days)
+    segment_times = start + pd.to_timedelta(segment_days * 24 * 60 + segment_hours * 60, unit='m')
+    pump.append(_events(len(segment_days), segment_times,
+                        **{'Basal Rate (U/h)': format_decimal(np.tile([rate for _, rate in BASAL_PROFILE], days))}))
+
+    # Reservoir change every 3 days: rewind with the basal stopped
+    rewind_days = np.arange(1, days, 3)
+    rewind_times = start + pd.to_timedelta(rewind_days * 24 * 60 + 10 * 60 + rng.integers(0, 120, len(rewind_days)),
+                                           unit='m')
+    pump.append(_events(len(rewind_days), rewind_times, **{'Basal Rate (U/h)': '0', 'Rewind': 'Rewind'}))
+
+    return pd.concat(pump, ignore_index=True), sensor_events
+
+
+def _section_rows(events, columns, unit):
+    """
+    Returns:
+        pandas.DataFrame: The events as the rows of a section, newest first, with their Index, Date and Time.
+    """
+    events = events.sort_values('Timestamp', ascending=False, kind='stable').reset_index(drop=True)
+    events['Index'] = [f"{i},00000" for i in range(len(events))]
+    # 'YYYY-MM-DDTHH:MM:SS' split in place, much faster than strftime on years of rows
+    text = np.datetime_as_string(events['Timestamp'].to_numpy(), unit='s').astype('U19')
+    characters = text.view('U1').reshape(-1, 19)
+    events['Date'] = np.char.replace(characters[:, :10].copy().view('U10').ravel(), '-', '/')
+    events['Time'] = characters[:, 11:].copy().view('U8').ravel()
+    rows = events.reindex(columns=columns)
+    if unit == "mg":
+        rows.columns = [column.replace('mmol/L', 'mg/dL') for column in columns]
+    return rows
+
+
+def write_carelink_export(path, days=14, start=datetime(2023, 1, 1), seed=0, unit="mmol", sensor_section=False,
+                          patient_name="Patient"):
+    """
+    Writes a synthetic CareLink CSV export (see the module documentation).
+
+    Args:
+        path (str): CSV file to write.
+        days (int): Number of days of data.
+        start (datetime): First day.
+        seed (int): Seed of the random generator.
+        unit (str): 'mmol' or 'mg'.
+        sensor_section (bool): Write the sensor glucose in its own device section.
+        patient_name (str): First name in the metadata header.
+
+    Returns:
+        int: Number of data rows written.
+    """
+    if unit not in UNITS:
+        raise ValueError(f"Unknown glucose unit '{unit}', expected one of {UNITS}")
+    pump, sensor = synthetic_events(days, start, seed, unit)
+    serial = f"NG{seed % 10000000:07d}H"
+    end = start + timedelta(days=days)
+
+    sections = []
+    if sensor_section:
+        sections.append(("Pump", CARELINK_COLUMNS, _section_rows(pump, CARELINK_COLUMNS, unit)))
+        sections.append(("Sensor", SENSOR_COLUMNS, _section_rows(sensor, SENSOR_COLUMNS, unit)))
+    else:
+        events = pd.concat([pump, sensor], ignore_index=True)
+        sections.append(("Pump", CARELINK_COLUMNS, _section_rows(events, CARELINK_COLUMNS, unit)))
+
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(f"Last Name;First Name;Patient ID;System ID;Start Date;End Date;Device;{DEVICE};"
+                f"Hardware Version;A1.01;Firmware Version;3.12.9\r\n")
+        f.write(f'"Synthetic";"{patient_name}";"";"";"{start:%d.%m.%Y} 00:00:00";"{end:%d.%m.%Y} 00:00:00";'
+                f'"Serial Number";{serial};Software Version;\r\n')
+        f.write("\r\nDevice data shown may exceed selected date range.\r\n\r\n")
+        for kind, columns, rows in sections:
+            f.write(f"-------;{DEVICE};{kind};{serial};------- \r\n")
+            f.write(";".join(rows.columns) + "\r\n")
+            # Every value already is CareLink text
+            lines = [";".join(row) for row in rows.fillna("").to_numpy(dtype=object).tolist()]
+            f.write("\r\n".join(lines) + "\r\n")
+    return sum(len(rows) for _, _, rows in sections)
+
+
+def write_patient_exports(folder, patients, days=14, start=datetime(2023, 1, 1), seed=0, unit="mmol",
+                          sensor_section=False):
+    """
+    Writes the exports of many synthetic patients, named patient_001.csv, patient_002.csv, ... (see batch.py).
+
+    Returns:
+        list: Paths of the files written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for number in range(1, patients + 1):
+        path = os.path.join(folder, f"patient_{number:03d}.csv")
+        write_carelink_export(path, days, start, seed + number, unit, sensor_section, f"Patient {number}")
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes synthetic CareLink CSV exports.")
+    parser.add_argument("output", help="CSV file, or folder with --patients")
+    parser.add_argument("--days", type=int, default=14, help="Days of data per patient (default: 14)")
+    parser.add_argument("--patients", type=int, default=0, help="Write N exports in the output folder")
+    parser.add_argument("--start", default="2023-01-01", help="First day, YYYY-MM-DD (default: 2023-01-01)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator (default: 0)")
+    parser.add_argument("--unit", choices=UNITS, default="mmol", help="Glucose unit (default: mmol)")
+    parser.add_argument("--sensor-section", action="store_true", help="Sensor glucose in its own device section")
+    args = parser.parse_args(argv)
+
+    start = datetime.strptime(args.start, "%Y-%m-%d")
+    if args.patients:
+        paths = write_patient_exports(args.output, args.patients, args.days, start, args.seed, args.unit,
+                                      args.sensor_section)
+    else:
+        write_carelink_export(args.output, args.days, start, args.seed, args.unit, args.sensor_section)
+        paths = [args.output]
+    for path in paths:
+        print(f"File '{path}' successfully created.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+# The modules of the project are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import load_settings  # noqa: E402
+from synthetic import write_carelink_export  # noqa: E402
+
+
+@pytest.fixture
+def make_settings(tmp_path):
+    """
+    Settings of the defaults, without the .env file of the repository, with some variables set.
+    """
+    def make(**variables):
+        environ = {"FOLDER_BUNDLE_DESTINATION": str(tmp_path / "Bundles"), "ID_SYSTEM": "https://example.org/ids",
+                   "FHIR_EMITTER": "fast", "BUNDLE_SERIALIZER": "json", "FILE_MESSAGES": "false"}
+        environ.update({name: str(value) for name, value in variables.items()})
+        return load_settings(environ)
+
+    return make
+
+
+def write_export_window(source, path, start, end):
+    """
+    Writes the rows of a CareLink export between two days as another export with that period,
+    like two exports of the same pump downloaded at different dates.
+
+    Args:
+        source (str): Complete export.
+        path (str): Export to write.
+        start (datetime): First day (included).
+        end (datetime): Last day (excluded).
+    """
+    with open(source, encoding="utf-8", newline="") as f:
+        lines = f.read().split("\r\n")
+    first, last = f"{start:%Y/%m/%d}", f"{end:%Y/%m/%d}"
+    header = lines[1].split(";")
+    header[4], header[5] = f'"{start:%d.%m.%Y} 00:00:00"', f'"{end:%d.%m.%Y} 00:00:00"'
+    kept = lines[:1] + [";".join(header)]
+    for line in lines[2:]:
+        fields = line.split(";")
+        # Rows have a date 'YYYY/MM/DD' in their second field, the other lines are kept
+        if len(fields) > 2 and fields[1][:4].isdigit() and "/" in fields[1]:
+            if not first <= fields[1] < last:
+                continue
+        kept.append(line)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("\r\n".join(kept))
+
+
+@pytest.fixture(scope="session")
+def synthetic_export(tmp_path_factory):
+    """
+    21 days of synthetic CareLink data, from 2023-01-02 (a Monday).
+    """
+    path = tmp_path_factory.mktemp("exports") / "synthetic.csv"
+    write_carelink_export(str(path), days=21, start=datetime(2023, 1, 2), seed=1)
+    return str(path)
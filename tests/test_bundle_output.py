@@ -0,0 +1,55 @@
+import json
+import tarfile
+
+import pytest
+
+from bundle_output import BundleWriter, compression_codec
+from main import process_patient_data
+
+
+def read_indexed_members(archive_path):
+    """
+    Returns:
+        dict: Member name -> JSON of the bundle, read at the offset and size of the archive index.
+    """
+    with open(archive_path + ".index.json") as f:
+        index = json.load(f)
+    decompress = compression_codec(index["compression"])[1]
+    members = {}
+    with open(archive_path, "rb") as f:
+        for name, member in index["members"].items():
+            f.seek(member["offset"])
+            members[name] = decompress(f.read(member["size"]))
+    return members
+
+
+def read_tar_members(archive_path, compression):
+    decompress = compression_codec(compression)[1]
+    with tarfile.open(archive_path) as archive:
+        return {member.name: decompress(archive.extractfile(member).read()) for member in archive.getmembers()}
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+@pytest.mark.parametrize("background", [True, False])
+def test_archive_index_offsets(tmp_path, compression, background):
+    # Sizes below, at and above the 512 byte blocks of the tar format
+    bundles = {f"bundle_{size}.json": json.dumps({"text": "x" * size}) for size in (0, 498, 499, 500, 1000, 5000)}
+    writer = BundleWriter(str(tmp_path), compression, "bundles.tar", background=background, verbose=False)
+    for name, bundle_json in bundles.items():
+        writer.write(str(tmp_path / name), bundle_json)
+    writer.close()
+
+    archive_path = str(tmp_path / "bundles.tar")
+    expected = {name + writer.extension: bundle_json.encode() for name, bundle_json in bundles.items()}
+    assert read_indexed_members(archive_path) == expected
+    assert read_tar_members(archive_path, compression) == expected
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_archive_of_a_conversion(synthetic_export, tmp_path, make_settings, workers):
+    settings = make_settings(OUTPUT_COMPRESSION="gzip", OUTPUT_ARCHIVE="bundles.tar", PARALLEL_WORKERS=workers)
+    process_patient_data(synthetic_export, "patient", str(tmp_path), settings)
+
+    members = read_indexed_members(str(tmp_path / "bundles.tar"))
+    assert members and members == read_tar_members(str(tmp_path / "bundles.tar"), "gzip")
+    assert all(json.loads(bundle)["resourceType"] == "Bundle" for bundle in members.values())
@@ -0,0 +1,82 @@
+import pytest
+
+from carelink import read_medtronic_csv
+from conversion import (create_bundles, generate_medtronic_carb_ratio, generate_medtronic_glucose_observation,
+                        generate_medtronic_glucose_summary, generate_medtronic_insulin_medication_administration,
+                        pack_bundle_ranges)
+from emitter import BUNDLE_OVERHEAD, estimate_entry_size
+
+# Estimate of the bundle id and timestamp in BUNDLE_OVERHEAD, above their real size
+OVERHEAD_MARGIN = 32
+
+GENERATORS = [
+    (generate_medtronic_glucose_observation, "Observation"),
+    (generate_medtronic_insulin_medication_administration, "MedicationAdministration"),
+    # Periods and summaries have a logical id: PUT entries
+    (generate_medtronic_carb_ratio, "Observation"),
+    (generate_medtronic_glucose_summary, "Observation"),
+]
+
+
+def test_entries_are_packed_up_to_max_bytes():
+    max_bytes = BUNDLE_OVERHEAD + 300
+    assert pack_bundle_ranges([100] * 7, 10, max_bytes) == [(0, 3), (3, 6), (6, 7)]
+
+
+def test_entry_larger_than_max_bytes_gets_its_own_bundle():
+    max_bytes = BUNDLE_OVERHEAD + 300
+    assert pack_bundle_ranges([100, 1000, 100, 100], 10, max_bytes) == [(0, 1), (1, 2), (2, 4)]
+    assert pack_bundle_ranges([1000, 1000], 10, max_bytes) == [(0, 1), (1, 2)]
+    assert pack_bundle_ranges([1000], 10, max_bytes) == [(0, 1)]
+
+
+def test_max_entries_and_max_bytes_together():
+    max_bytes = BUNDLE_OVERHEAD + 300
+    # Small entries: MAX_BUNDLE_SIZE is reached first
+    assert pack_bundle_ranges([10] * 5, 2, max_bytes) == [(0, 2), (2, 4), (4, 5)]
+    # Large entries: MAX_BUNDLE_BYTES is reached first
+    assert pack_bundle_ranges([200] * 3, 2, max_bytes) == [(0, 1), (1, 2), (2, 3)]
+    # Both, in the same list
+    assert pack_bundle_ranges([10, 10, 10, 200, 200, 10], 3, max_bytes) == [(0, 3), (3, 4), (4, 6)]
+
+
+def test_no_entries_no_bundles():
+    assert pack_bundle_ranges([], 10, 1000) == []
+
+
+def bundle_resources(bundle):
+    return [entry["resource"] if isinstance(entry, dict) else entry.resource for entry in bundle.entry]
+
+
+@pytest.mark.parametrize("emitter", ["fast", "model"])
+@pytest.mark.parametrize("generator, resource_type", GENERATORS)
+def test_estimate_of_the_bundle_size(synthetic_export, make_settings, emitter, generator, resource_type):
+    settings = make_settings(FHIR_EMITTER=emitter, MAX_BUNDLE_BYTES="20000", MAX_BUNDLE_SIZE="100",
+                             ICR_ENABLED="true", COMPRESS_SETTING_CHANGES="true", GLUCOSE_SUMMARY_ENABLED="true")
+    resources = generator(read_medtronic_csv(synthetic_export), "patient", settings)
+    bundles = create_bundles(resources, resource_type, settings)
+
+    assert resources and sum(len(bundle.entry) for bundle in bundles) == len(resources)
+    for bundle in bundles:
+        size = len(bundle.json())
+        estimate = BUNDLE_OVERHEAD + sum(estimate_entry_size(resource, resource_type)
+                                         for resource in bundle_resources(bundle))
+        # Never below the real size, so a bundle never exceeds MAX_BUNDLE_BYTES
+        assert size <= estimate <= size + OVERHEAD_MARGIN
+        assert len(bundle.entry) <= 100
+        assert size <= 20000 or len(bundle.entry) == 1
+
+
+@pytest.mark.parametrize("emitter", ["fast", "model"])
+def test_resource_larger_than_max_bytes_is_bundled_alone(synthetic_export, make_settings, emitter):
+    settings = make_settings(FHIR_EMITTER=emitter, MAX_BUNDLE_BYTES="1000", GLUCOSE_SUMMARY_ENABLED="true")
+    df = read_medtronic_csv(synthetic_export)
+    # A summary is larger than 1000 bytes, a glucose observation is not
+    resources = (generate_medtronic_glucose_observation(df.iloc[:3], "patient", settings)
+                 + generate_medtronic_glucose_summary(df, "patient", settings)
+                 + generate_medtronic_glucose_observation(df.iloc[3:6], "patient", settings))
+    bundles = create_bundles(resources, "Observation", settings)
+
+    summary_bundles = [bundle for bundle in bundles if len(bundle.json()) > 1000]
+    assert len(summary_bundles) == 1 and len(summary_bundles[0].entry) == 1
+    assert [resource for bundle in bundles for resource in bundle_resources(bundle)] == resources
@@ -0,0 +1,117 @@
+import json
+import os
+import re
+from datetime import datetime
+
+import pytest
+
+from conftest import write_export_window
+from main import process_patient_data
+
+SUMMARY_CODE = "cgm-summary"
+
+
+def is_summary(resource):
+    return resource["code"]["coding"][0]["code"] == SUMMARY_CODE
+
+
+def bundle_summaries(folder):
+    """
+    Returns:
+        dict: Partition label -> summaries (entry request and resource) of the bundle files of a folder.
+    """
+    summaries = {}
+    for name in sorted(os.listdir(folder)):
+        match = re.fullmatch(r"glucose_summary_bundle_(.+)_part_\d+\.json", name)
+        if match:
+            with open(os.path.join(folder, name)) as f:
+                entries = json.load(f)["entry"]
+            summaries.setdefault(match.group(1), []).extend(entries)
+    return summaries
+
+
+def ndjson_summaries(folder):
+    """
+    Returns:
+        dict: Logical id -> last version of the summaries of the NDJSON files, read in the order of their numbers
+            like a bulk import.
+    """
+    names = [name for name in os.listdir(folder) if re.fullmatch(r"Observation\.\d+\.ndjson", name)]
+    summaries = {}
+    for name in sorted(names, key=lambda name: int(name.split(".")[1])):
+        with open(os.path.join(folder, name)) as f:
+            for resource in map(json.loads, f):
+                if is_summary(resource):
+                    summaries[resource["id"]] = resource
+    return summaries
+
+
+def convert(csv_file, folder, settings):
+    os.makedirs(folder, exist_ok=True)
+    return process_patient_data(str(csv_file), "patient", str(folder), settings)
+
+
+def convert_growing_exports(synthetic_export, tmp_path, settings):
+    # An export of 10 days, then the export of 21 days it came from: the second week gets more readings
+    first = tmp_path / "first.csv"
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 12))
+    output = tmp_path / "incremental"
+    convert(first, output, settings)
+    convert(synthetic_export, output, settings)
+    return output
+
+
+@pytest.mark.parametrize("index", [False, True])
+def test_one_summary_per_partition_in_bundles(synthetic_export, tmp_path, make_settings, index):
+    variables = dict(GLUCOSE_SUMMARY_ENABLED="true", INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    if index:
+        variables["IDENTIFIER_INDEX_PATH"] = tmp_path / "index.sqlite"
+    convert(synthetic_export, tmp_path / "full", make_settings(GLUCOSE_SUMMARY_ENABLED="true"))
+    expected = bundle_summaries(tmp_path / "full")
+
+    summaries = bundle_summaries(convert_growing_exports(synthetic_export, tmp_path, make_settings(**variables)))
+
+    assert summaries == expected
+    assert all(len(entries) == 1 for entries in summaries.values())
+    for entries in summaries.values():
+        # Updated, so the summary uploaded with the first export is replaced
+        assert entries[0]["request"] == {"method": "PUT", "url": f"Observation/{entries[0]['resource']['id']}"}
+
+
+def test_one_summary_per_partition_in_ndjson(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(GLUCOSE_SUMMARY_ENABLED="true", OUTPUT_FORMAT="ndjson",
+                             INCREMENTAL_STATE_FOLDER=tmp_path / "state",
+                             IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    convert(synthetic_export, tmp_path / "full", make_settings(GLUCOSE_SUMMARY_ENABLED="true", OUTPUT_FORMAT="ndjson"))
+    expected = ndjson_summaries(tmp_path / "full")
+
+    summaries = ndjson_summaries(convert_growing_exports(synthetic_export, tmp_path, settings))
+
+    # Four weeks (January 2-7, 8-14, 15-21 and 22), the summary of the second one written again with the same id
+    assert len(expected) == 4
+    assert summaries == expected
+
+
+def test_unchanged_summary_is_not_written_again(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(GLUCOSE_SUMMARY_ENABLED="true", IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    convert(synthetic_export, tmp_path / "first", settings)
+    metrics = convert(synthetic_export, tmp_path / "second", settings)
+
+    assert metrics.counters.get("resources", 0) == 0
+    assert bundle_summaries(tmp_path / "second") == {}
+
+
+def test_rows_appended_to_a_partition_keep_its_summary(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(GLUCOSE_SUMMARY_ENABLED="true", INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    # The second export starts inside the week of January 8-14: only its rows after the first export are converted
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 12))
+    write_export_window(synthetic_export, second, datetime(2023, 1, 10), datetime(2023, 1, 23))
+    convert(first, tmp_path / "output", settings)
+    before = bundle_summaries(tmp_path / "output")
+    convert(second, tmp_path / "output", settings)
+
+    summaries = bundle_summaries(tmp_path / "output")
+    assert all(len(entries) == 1 for entries in summaries.values())
+    assert summaries["year_2023_month_1_week_2"] == before["year_2023_month_1_week_2"]
+    assert "year_2023_month_1_week_3" in summaries
@@ -0,0 +1,85 @@
+import json
+import os
+from datetime import datetime
+
+from conftest import write_export_window
+from main import process_patient_data
+
+
+def convert(csv_file, folder, settings):
+    os.makedirs(folder, exist_ok=True)
+    return process_patient_data(str(csv_file), "patient", str(folder), settings)
+
+
+def saved_identifiers(folder):
+    """
+    Returns:
+        list: Identifier values of the resources in the bundle files of a folder.
+    """
+    identifiers = []
+    for name in os.listdir(folder):
+        if name.endswith(".json"):
+            with open(os.path.join(folder, name)) as f:
+                bundle = json.load(f)
+            identifiers += [entry["resource"]["identifier"][0]["value"] for entry in bundle.get("entry", [])]
+    return identifiers
+
+
+def convert_overlapping_exports(synthetic_export, tmp_path, settings):
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    # The exports overlap: the first one ends in the partition of January 15-21, which the second one rewrites,
+    # the partition of January 8-14 is the same in both
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 18))
+    write_export_window(synthetic_export, second, datetime(2023, 1, 8), datetime(2023, 1, 23))
+    output = tmp_path / "incremental"
+    convert(first, output, settings)
+    convert(second, output, settings)
+    return saved_identifiers(output)
+
+
+def test_overlapping_exports_give_the_full_conversion(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    convert(synthetic_export, tmp_path / "full", settings)
+    expected = saved_identifiers(tmp_path / "full")
+
+    identifiers = convert_overlapping_exports(synthetic_export, tmp_path, settings)
+
+    assert len(identifiers) == len(set(identifiers))
+    assert sorted(identifiers) == sorted(expected)
+
+
+def test_identifier_index_keeps_the_rewritten_partitions(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(INCREMENTAL_STATE_FOLDER=tmp_path / "state",
+                             IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    convert(synthetic_export, tmp_path / "full", make_settings())
+    expected = saved_identifiers(tmp_path / "full")
+
+    identifiers = convert_overlapping_exports(synthetic_export, tmp_path, settings)
+
+    assert len(identifiers) == len(set(identifiers))
+    assert sorted(identifiers) == sorted(expected)
+
+
+def test_unchanged_export_is_skipped(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    convert(synthetic_export, tmp_path / "output", settings)
+    metrics = convert(synthetic_export, tmp_path / "output", settings)
+
+    assert metrics.counters.get("partitions", 0) == 0
+    assert metrics.counters.get("resources", 0) == 0
+    assert metrics.counters["rows_skipped"] == metrics.counters["rows_in"]
+    assert metrics.counters["rows_dropped"] == 0
+
+
+def test_rows_of_a_rewritten_partition_are_not_skipped(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 18))
+    write_export_window(synthetic_export, second, datetime(2023, 1, 8), datetime(2023, 1, 23))
+    convert(first, tmp_path / "output", settings)
+    metrics = convert(second, tmp_path / "output", settings)
+
+    counters = metrics.counters
+    assert counters["rows_skipped"] > 0 and counters["rows_converted"] > 0
+    assert counters["rows_converted"] + counters["rows_skipped"] == counters["rows_in"]
+    assert counters["rows_dropped"] == 0
@@ -0,0 +1,92 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from conftest import write_export_window
+from main import process_patient_data
+from ndjson_output import NdjsonSink
+
+
+def read_lines(folder):
+    """
+    Returns:
+        dict: File name -> resources of the NDJSON files of a folder.
+    """
+    return {
+        name: [json.loads(line) for line in open(os.path.join(folder, name))]
+        for name in sorted(os.listdir(folder)) if name.endswith(".ndjson")
+    }
+
+
+def observation(number):
+    return {"resourceType": "Observation", "status": "final", "identifier": [{"value": str(number)}]}
+
+
+def test_files_roll_before_max_bytes(tmp_path):
+    line_size = len(json.dumps(observation(10), separators=(",", ":"))) + 1
+    sink = NdjsonSink(str(tmp_path), max_bytes=3 * line_size, verbose=False)
+    sink.write([observation(number) for number in range(10, 17)], "Observation")
+    sink.close()
+
+    files = read_lines(tmp_path)
+    assert list(files) == ["Observation.1.ndjson", "Observation.2.ndjson", "Observation.3.ndjson"]
+    assert [len(resources) for resources in files.values()] == [3, 3, 1]
+    assert all(os.path.getsize(tmp_path / name) <= 3 * line_size for name in files)
+    assert sink.bytes_written == 7 * line_size
+
+
+def test_max_bytes_counts_utf8_bytes(tmp_path):
+    # orjson writes 'é' as two bytes, not escaped: a line is 149 characters but 199 bytes,
+    # two lines would fit in 300 characters but not in 300 bytes
+    resources = [{**observation(number), "note": [{"text": "é" * 50}]} for number in range(10, 16)]
+    sink = NdjsonSink(str(tmp_path), max_bytes=300, serializer="orjson", verbose=False)
+    sink.write(resources, "Observation")
+    sink.close()
+
+    files = read_lines(tmp_path)
+    assert [len(resources) for resources in files.values()] == [1] * 6
+    assert all(os.path.getsize(tmp_path / name) <= 300 for name in files)
+    assert sink.bytes_written == sum(os.path.getsize(tmp_path / name) for name in files)
+
+
+def test_runs_do_not_overwrite_earlier_files(tmp_path):
+    for run in range(2):
+        sink = NdjsonSink(str(tmp_path), max_bytes=0, verbose=False)
+        sink.write([observation(run)], "Observation")
+        sink.close()
+    worker = NdjsonSink(str(tmp_path), verbose=False).for_worker()
+    worker.write([observation(2)], "Observation")
+    worker.close()
+
+    files = {name: [resource["identifier"][0]["value"] for resource in resources]
+             for name, resources in read_lines(tmp_path).items()}
+    assert files == {"Observation.1.ndjson": ["0"], "Observation.2.ndjson": ["1"],
+                     f"Observation.{os.getpid()}-1.ndjson": ["2"]}
+
+
+def test_incremental_runs_keep_every_resource(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(OUTPUT_FORMAT="ndjson", INCREMENTAL_STATE_FOLDER=tmp_path / "state",
+                             IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 18))
+    write_export_window(synthetic_export, second, datetime(2023, 1, 8), datetime(2023, 1, 23))
+    for folder in ("full", "incremental"):
+        (tmp_path / folder).mkdir()
+    process_patient_data(synthetic_export, "patient", str(tmp_path / "full"), make_settings(OUTPUT_FORMAT="ndjson"))
+    process_patient_data(str(first), "patient", str(tmp_path / "incremental"), settings)
+    process_patient_data(str(second), "patient", str(tmp_path / "incremental"), settings)
+
+    def identifiers(folder):
+        return sorted(resource["identifier"][0]["value"]
+                      for resources in read_lines(folder).values() for resource in resources)
+
+    incremental = identifiers(tmp_path / "incremental")
+    assert len(incremental) == len(set(incremental))
+    assert incremental == identifiers(tmp_path / "full")
+
+
+def test_incremental_ndjson_needs_the_identifier_index(tmp_path, make_settings):
+    with pytest.raises(ValueError, match="IDENTIFIER_INDEX_PATH"):
+        make_settings(OUTPUT_FORMAT="ndjson", INCREMENTAL_STATE_FOLDER=tmp_path / "state")
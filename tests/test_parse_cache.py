@@ -0,0 +1,91 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from carelink import read_medtronic_csv
+from conftest import write_export_window
+from parse_cache import SIDECAR_NAME, ParseCache, entry_size
+
+
+def write_exports(synthetic_export, tmp_path, count):
+    """
+    Returns:
+        list: Paths of exports of different weeks, so of different cache entries.
+    """
+    paths = []
+    for week in range(count):
+        path = tmp_path / f"export_{week}.csv"
+        write_export_window(synthetic_export, path, datetime(2023, 1, 2 + 7 * week), datetime(2023, 1, 8 + 7 * week))
+        paths.append(str(path))
+    return paths
+
+
+def is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def test_cached_frame_is_the_parsed_one(synthetic_export, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    parsed = read_medtronic_csv(synthetic_export, cache)
+
+    assert os.path.exists(cache.entry_path(synthetic_export))
+    pd.testing.assert_frame_equal(cache.load(synthetic_export), parsed)
+    pd.testing.assert_frame_equal(read_medtronic_csv(synthetic_export, cache), read_medtronic_csv(synthetic_export))
+
+
+def test_typed_columns_are_memory_mapped(synthetic_export, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    parsed = read_medtronic_csv(synthetic_export, cache)
+    loaded = cache.load(synthetic_export)
+
+    typed = [name for name, dtype in parsed.dtypes.items() if dtype != object]
+    assert "Timestamp" in typed and "Sensor Glucose (mmol/L)" in typed
+    for name in typed:
+        assert is_memory_mapped(np.asarray(loaded[name])), name
+    # The text columns come from the JSON sidecar, missing values as NaN
+    assert loaded["Bolus Type"].isna().equals(parsed["Bolus Type"].isna())
+    assert not any(name.endswith(".pkl") for name in os.listdir(cache.entry_path(synthetic_export)))
+
+
+def test_least_recently_used_entries_are_evicted(synthetic_export, tmp_path):
+    first, second, third = write_exports(synthetic_export, tmp_path, 3)
+    cache = ParseCache(str(tmp_path / "cache"))
+    for age, path in ((30, first), (20, second)):
+        cache.store(path, read_medtronic_csv(path))
+        os.utime(cache.entry_path(path), (1e9 - age, 1e9 - age))
+    size = max(entry_size(cache.entry_path(path)) for path in (first, second))
+
+    # Loading the first entry makes the second one the least recently used
+    assert cache.load(first) is not None
+    cache.max_bytes = 2 * size + size // 2
+    cache.store(third, read_medtronic_csv(third))
+
+    assert os.path.exists(cache.entry_path(first))
+    assert not os.path.exists(cache.entry_path(second))
+    assert os.path.exists(cache.entry_path(third))
+
+
+def test_entry_just_stored_is_kept(synthetic_export, tmp_path):
+    first, second = write_exports(synthetic_export, tmp_path, 2)
+    cache = ParseCache(str(tmp_path / "cache"), max_bytes=1)
+    cache.store(first, read_medtronic_csv(first))
+    cache.store(second, read_medtronic_csv(second))
+
+    assert os.listdir(cache.folder) == [os.path.basename(cache.entry_path(second))]
+
+
+def test_damaged_entry_is_parsed_again(synthetic_export, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    read_medtronic_csv(synthetic_export, cache)
+    with open(os.path.join(cache.entry_path(synthetic_export), SIDECAR_NAME), "w") as f:
+        f.write("{not json")
+
+    assert cache.load(synthetic_export) is None
+    assert not os.path.exists(cache.entry_path(synthetic_export))
+    pd.testing.assert_frame_equal(read_medtronic_csv(synthetic_export, cache), read_medtronic_csv(synthetic_export))
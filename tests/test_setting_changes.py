@@ -0,0 +1,173 @@
+import json
+import os
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from carelink import read_medtronic_csv
+from conftest import write_export_window
+from conversion import (generate_medtronic_carb_ratio, generate_medtronic_insulin_medication_administration,
+                        setting_change_runs)
+from main import process_patient_data
+from partitioning import iter_partitions
+
+
+def runs_of(values, minutes):
+    """
+    Returns:
+        list: (value, start minute, end minute) of the runs of setting_change_runs.
+    """
+    frame = pd.DataFrame({"value": values})
+    times = pd.Series([datetime(2023, 1, 2) + timedelta(minutes=minute) for minute in minutes])
+    starts, ends = setting_change_runs(frame, times)
+    return [(values[start], minutes[start], minutes[end]) for start, end in zip(starts, ends)]
+
+
+def test_runs_follow_the_timestamps():
+    # Newest rows first, as in the exports
+    assert runs_of([8, 8, 9, 9, 8], [40, 30, 20, 10, 0]) == [(8, 0, 10), (9, 10, 30), (8, 30, 40)]
+
+
+def test_run_lasts_until_the_next_change():
+    assert runs_of([8, 9, 9, 10], [0, 10, 20, 30]) == [(8, 0, 10), (9, 10, 30), (10, 30, 30)]
+    assert runs_of([8, 8, 8], [0, 10, 20]) == [(8, 0, 20)]
+
+
+def test_every_column_of_the_setting_counts():
+    frame = pd.DataFrame({"rate": [1.0, 1.0, 1.0], "type": ["basal", "temp", "temp"]})
+    times = pd.Series(pd.date_range("2023-01-02", periods=3, freq="h"))
+    starts, ends = setting_change_runs(frame, times)
+    assert starts.tolist() == [0, 1] and ends.tolist() == [1, 2]
+
+
+def test_no_rows_no_runs():
+    starts, ends = setting_change_runs(pd.DataFrame({"value": []}), pd.Series([], dtype="datetime64[ns]"))
+    assert len(starts) == len(ends) == 0
+
+
+def changes(resources, value_of):
+    """
+    Returns:
+        list: (start, end, value) periods of the values of uncompressed resources, in time order: a value lasts
+            until the resource where it changes, the last one until the last resource.
+    """
+    points = sorted(((resource["effectiveDateTime"], value_of(resource)) for resource in resources),
+                    key=lambda point: point[0])
+    starts = [i for i, (_, value) in enumerate(points) if i == 0 or value != points[i - 1][1]]
+    ends = starts[1:] + [len(points) - 1]
+    return sorted((points[start][0], points[end][0], points[start][1]) for start, end in zip(starts, ends))
+
+
+def periods(resources, value_of):
+    return sorted((resource["effectivePeriod"]["start"], resource["effectivePeriod"]["end"], value_of(resource))
+                  for resource in resources)
+
+
+def ratio(resource):
+    return resource["valueQuantity"]["value"]
+
+
+def basal_rate(resource):
+    return resource["dosage"]["rateQuantity"]["value"], resource["medicationCodeableConcept"]["text"]
+
+
+def basal_rates(rows, settings):
+    # The basal insulin of the exports is delivered by the closed loop ('Total Insulin Daily (Basal)')
+    return [resource for resource in generate_medtronic_insulin_medication_administration(rows, "patient", settings)
+            if resource["medicationCodeableConcept"]["text"].startswith("Total Insulin Daily (Basal)")]
+
+
+def test_periods_of_every_partition(synthetic_export, make_settings):
+    settings = make_settings(ICR_ENABLED="true")
+    compressed = make_settings(ICR_ENABLED="true", COMPRESS_SETTING_CHANGES="true")
+    df = read_medtronic_csv(synthetic_export)
+
+    for _, rows in iter_partitions(df, settings.partition_granularity):
+        expected = changes(generate_medtronic_carb_ratio(rows, "patient", settings), ratio)
+        assert expected and periods(generate_medtronic_carb_ratio(rows, "patient", compressed), ratio) == expected
+
+        expected = changes(basal_rates(rows, settings), basal_rate)
+        assert expected and periods(basal_rates(rows, compressed), basal_rate) == expected
+
+
+def saved_periods(folder):
+    """
+    Returns:
+        list: (start, end, kind) of the resources over a period in the bundle files of a folder.
+    """
+    found = []
+    for name in os.listdir(folder):
+        if name.startswith(("insulin_bundle_", "icr_bundle_")):
+            with open(os.path.join(folder, name)) as f:
+                for entry in json.load(f)["entry"]:
+                    resource = entry["resource"]
+                    if "effectivePeriod" in resource:
+                        assert entry["request"] == {"method": "PUT",
+                                                    "url": f"{resource['resourceType']}/{resource['id']}"}
+                        period = resource["effectivePeriod"]
+                        found.append((period["start"], period["end"], resource["resourceType"]))
+    return sorted(found)
+
+
+def ndjson_periods(folder):
+    """
+    Returns:
+        dict: Logical id -> last version of the resources over a period of the NDJSON files, read in the order
+            of their numbers like a bulk import.
+    """
+    names = [name for name in os.listdir(folder) if re.fullmatch(r"\w+\.\d+\.ndjson", name)]
+    found = {}
+    for name in sorted(names, key=lambda name: int(name.split(".")[1])):
+        with open(os.path.join(folder, name)) as f:
+            for resource in map(json.loads, f):
+                if "effectivePeriod" in resource:
+                    found[resource["id"]] = resource
+    return found
+
+
+def convert_exports(exports, folder, settings):
+    os.makedirs(folder, exist_ok=True)
+    for export in exports:
+        process_patient_data(str(export), "patient", str(folder), settings)
+
+
+def growing_exports(synthetic_export, tmp_path):
+    # An export of 10 days, then the export of 21 days it came from: the last periods of the week of
+    # January 8-14 are extended
+    first = tmp_path / "first.csv"
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 12))
+    return [first, synthetic_export]
+
+
+def test_extended_periods_replace_the_earlier_ones(synthetic_export, tmp_path, make_settings):
+    variables = dict(ICR_ENABLED="true", COMPRESS_SETTING_CHANGES="true")
+    convert_exports([synthetic_export], tmp_path / "full", make_settings(**variables))
+    settings = make_settings(**variables, INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    convert_exports(growing_exports(synthetic_export, tmp_path), tmp_path / "incremental", settings)
+
+    assert saved_periods(tmp_path / "incremental") == saved_periods(tmp_path / "full")
+
+
+def test_extended_periods_replace_the_earlier_ones_in_ndjson(synthetic_export, tmp_path, make_settings):
+    variables = dict(ICR_ENABLED="true", COMPRESS_SETTING_CHANGES="true", OUTPUT_FORMAT="ndjson")
+    convert_exports([synthetic_export], tmp_path / "full", make_settings(**variables))
+    settings = make_settings(**variables, INCREMENTAL_STATE_FOLDER=tmp_path / "state",
+                             IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    convert_exports(growing_exports(synthetic_export, tmp_path), tmp_path / "incremental", settings)
+
+    assert ndjson_periods(tmp_path / "incremental") == ndjson_periods(tmp_path / "full")
+
+
+def test_appended_rows_do_not_repeat_a_period(synthetic_export, tmp_path, make_settings):
+    settings = make_settings(ICR_ENABLED="true", COMPRESS_SETTING_CHANGES="true",
+                             INCREMENTAL_STATE_FOLDER=tmp_path / "state")
+    first, second = tmp_path / "first.csv", tmp_path / "second.csv"
+    # The second export starts inside the week of January 8-14: only its rows after the first export are converted
+    write_export_window(synthetic_export, first, datetime(2023, 1, 2), datetime(2023, 1, 12))
+    write_export_window(synthetic_export, second, datetime(2023, 1, 10), datetime(2023, 1, 23))
+    convert_exports([first, second], tmp_path / "output", settings)
+
+    starts = Counter((start, kind) for start, _, kind in saved_periods(tmp_path / "output"))
+    assert starts and max(starts.values()) == 1
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from identifier_index import IdentifierIndex
+from main import process_patient_data
+from upload import FhirUploader
+
+
+class StandInServer:
+    """
+    Local stand-in for a FHIR server: answers the POSTs with the queued (status, headers) responses,
+    then 200. With hold set, the requests wait until it is cleared.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = 0
+        self.hold = threading.Event()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server.lock:
+                    server.requests += 1
+                    status, headers = server.responses.pop(0) if server.responses else (200, {})
+                while server.hold.is_set():
+                    time.sleep(0.01)
+                body = b'{"resourceType":"Bundle","type":"transaction-response"}'
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/fhir+json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/fhir"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.hold.clear()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+def test_retries_429_and_5xx(server):
+    server.responses = [(429, {}), (503, {}), (500, {})]
+    uploader = FhirUploader(server.url, workers=1, max_retries=5, backoff=0.01)
+    result = uploader.post_bundle("bundle", "{}")
+    uploader.close()
+
+    assert result.success
+    assert result.attempts == 4
+    assert server.requests == 4
+
+
+def test_retry_after_is_honored(server):
+    # Without Retry-After the retry would wait the backoff of 30 seconds
+    server.responses = [(429, {"Retry-After": "0.2"})]
+    uploader = FhirUploader(server.url, workers=1, max_retries=1, backoff=30)
+    start = time.perf_counter()
+    result = uploader.post_bundle("bundle", "{}")
+    seconds = time.perf_counter() - start
+    uploader.close()
+
+    assert result.success and result.attempts == 2
+    assert 0.2 <= seconds < 5
+
+
+def test_client_errors_and_exhausted_retries_fail(server):
+    server.responses = [(400, {}), (503, {}), (503, {})]
+    uploader = FhirUploader(server.url, workers=1, max_retries=1, backoff=0.01)
+    rejected = uploader.post_bundle("rejected", "{}")
+    unavailable = uploader.post_bundle("unavailable", "{}")
+    uploader.close()
+
+    assert not rejected.success and rejected.status == 400 and rejected.attempts == 1
+    assert not unavailable.success and unavailable.status == 503 and unavailable.attempts == 2
+
+
+def test_submissions_in_flight_are_bounded(server):
+    server.hold.set()
+    uploader = FhirUploader(server.url, workers=1, backoff=0.01)
+    submitter = threading.Thread(target=lambda: [uploader.submit(f"bundle {i}", "{}") for i in range(5)])
+    submitter.start()
+    time.sleep(0.5)
+    # One bundle is being sent, one waits in the queue, the third submission blocks
+    assert len(uploader._futures) == 2
+    assert submitter.is_alive()
+
+    server.hold.clear()
+    submitter.join(10)
+    results = uploader.wait()
+    uploader.close()
+    assert [result.name for result in results] == [f"bundle {i}" for i in range(5)]
+    assert all(result.success for result in results)
+
+
+def test_failed_upload_does_not_record_the_run(server, synthetic_export, tmp_path, make_settings):
+    server.responses = [(400, {})] * 1000
+    settings = make_settings(FHIR_BASE_URL=server.url, FHIR_UPLOAD_MAX_RETRIES=0,
+                             INCREMENTAL_STATE_FOLDER=tmp_path / "state",
+                             IDENTIFIER_INDEX_PATH=tmp_path / "index.sqlite")
+    output = tmp_path / "output"
+    output.mkdir()
+
+    with pytest.raises(RuntimeError):
+        process_patient_data(synthetic_export, "patient", str(output), settings)
+
+    assert not os.path.exists(tmp_path / "state" / "patient.json")
+    index = IdentifierIndex(str(tmp_path / "index.sqlite"))
+    assert len(index) == 0
+    index.close()
+
+    # Once the server accepts them, the next run converts and uploads everything
+    server.responses = []
+    metrics = process_patient_data(synthetic_export, "patient", str(output), settings)
+    assert metrics.counters["bundles_upload_failed"] == 0
+    assert metrics.counters.get("resources_skipped", 0) == 0
+    assert os.path.exists(tmp_path / "state" / "patient.json")
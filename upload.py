@@ -0,0 +1,258 @@
+"""
+Upload of the transaction bundles to a FHIR server.
+
+Usage:
+    python upload.py [bundle files or folders ...] [--base-url URL] [--workers N]
+
+Without arguments, the bundles in FOLDER_BUNDLE_DESTINATION are uploaded to FHIR_BASE_URL.
+With FHIR_BASE_URL set, main.py and batch.py also upload every bundle as soon as it is saved.
+
+The bundles are POSTed to the base URL over a pool of keep-alive connections by FHIR_UPLOAD_WORKERS threads.
+Responses 429 and 5xx and connection errors are retried (FHIR_UPLOAD_MAX_RETRIES times) with exponential
+backoff, honoring the Retry-After header of the server. At most IN_FLIGHT_PER_WORKER bundles per worker are
+queued or being sent: when the server is slower than the conversion, submit() waits instead of keeping the
+whole output in memory.
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bundle_output import read_bundle_file
+from settings import load_settings
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Longest wait between two attempts, whatever the backoff or Retry-After say
+MAX_RETRY_WAIT = 120
+# Bundles submitted and not uploaded yet, per worker thread
+IN_FLIGHT_PER_WORKER = 2
+
+UploadResult = namedtuple("UploadResult", ["name", "status", "success", "attempts", "seconds", "error"])
+
+
+def retry_after_seconds(response):
+    """
+    Returns:
+        float: Seconds asked by the Retry-After header of the response (seconds or HTTP date), None without it.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class FhirUploader:
+    """
+    Posts transaction bundles to a FHIR server with bounded concurrency.
+
+    Bundles are submitted with submit() or submit_file() and uploaded in the background,
+    wait() returns the UploadResult of every bundle in the order they were submitted.
+    A submission blocks while IN_FLIGHT_PER_WORKER * workers bundles are waiting or being sent.
+
+    Args:
+        base_url (str): FHIR base URL, the bundles are POSTed to it.
+        workers (int): Concurrent requests (and size of the connection pool).
+        max_retries (int): Retries of a bundle after a 429/5xx response or a connection error.
+        backoff (float): Wait before the first retry in seconds, doubled for every retry.
+        timeout (float): Timeout of a request in seconds.
+        auth_token (str): Optional bearer token.
+    """
+
+    def __init__(self, base_url, workers=4, max_retries=5, backoff=0.5, timeout=60, auth_token=""):
+        self.base_url = base_url.rstrip("/")
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.auth_token = auth_token
+        self._session = None
+        self._executor = None
+        self._futures = []
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(IN_FLIGHT_PER_WORKER * workers)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.fhir_base_url,
+            workers=settings.fhir_upload_workers,
+            max_retries=settings.fhir_upload_max_retries,
+            backoff=settings.fhir_upload_backoff,
+            timeout=settings.fhir_upload_timeout,
+            auth_token=settings.fhir_auth_token
+        )
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            # Retries are done here (with Retry-After), the adapter only keeps the connections alive
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "Content-Type": "application/fhir+json",
+                "Accept": "application/fhir+json",
+            })
+            if self.auth_token:
+                session.headers["Authorization"] = f"Bearer {self.auth_token}"
+            self._session = session
+        return self._session
+
+    def post_bundle(self, name, body):
+        """
+        Posts one bundle, retrying as configured.
+
+        Args:
+            name (str): Name of the bundle in the results (e.g. its file).
+            body (str or bytes): JSON of the bundle.
+
+        Returns:
+            UploadResult: Outcome of the upload.
+        """
+        start = time.perf_counter()
+        status, error = None, None
+        for attempt in range(1, self.max_retries + 2):
+            wait = self.backoff * 2 ** (attempt - 1) * (1 + random.random() / 2)
+            try:
+                response = self.session.post(self.base_url, data=body, timeout=self.timeout)
+                status = response.status_code
+                if response.ok:
+                    return UploadResult(name, status, True, attempt, time.perf_counter() - start, None)
+                error = response.text[:200]
+                if status not in RETRY_STATUS_CODES:
+                    break
+                retry_after = retry_after_seconds(response)
+                if retry_after is not None:
+                    wait = retry_after
+            except (requests.ConnectionError, requests.Timeout) as e:
+                status, error = None, f"{type(e).__name__}: {e}"
+
+            if attempt <= self.max_retries:
+                time.sleep(min(wait, MAX_RETRY_WAIT))
+        return UploadResult(name, status, False, attempt, time.perf_counter() - start, error)
+
+    def _post_file(self, path):
+        return self.post_bundle(path, read_bundle_file(path))
+
+    def _submit(self, function, *args):
+        # Taken before the lock, so wait() is not blocked by a submission waiting for room
+        self._in_flight.acquire()
+        try:
+            with self._lock:
+                if self._executor is None:
+                    # The session is shared by the threads, create it before them
+                    self.session
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fhir-upload")
+                future = self._executor.submit(function, *args)
+                self._futures.append(future)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release())
+
+    def submit(self, name, body):
+        """
+        Queues a bundle (its JSON) for upload.
+        """
+        self._submit(self.post_bundle, name, body)
+
+    def submit_file(self, path):
+        """
+        Queues a saved bundle file (compressed or not, see bundle_output.py) for upload.
+        """
+        self._submit(self._post_file, path)
+
+    def wait(self):
+        """
+        Waits for the queued uploads.
+
+        Returns:
+            list: UploadResult of every bundle submitted since the last wait(), in order.
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def print_upload_summary(results):
+    """
+    Prints one line per bundle and the totals.
+    """
+    for result in results:
+        status = "OK    " if result.success else "FAILED"
+        line = f"{status} {result.name} (HTTP {result.status or '-'}, {result.attempts} attempt(s), {result.seconds:.1f}s)"
+        if not result.success and result.error:
+            line += f" - {result.error}"
+        print(line)
+    failed = sum(1 for result in results if not result.success)
+    print(f"{len(results) - failed} bundle(s) uploaded, {failed} failed.")
+
+
+def list_bundle_files(paths):
+    """
+    Args:
+        paths (list): Bundle files or folders with bundle files.
+
+    Returns:
+        list: The bundle files (compressed or not), in a stable order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*_bundle_*.json")) +
+                            glob.glob(os.path.join(path, "*_bundle_*.json.*")))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv=None):
+    settings = load_settings()
+    parser = argparse.ArgumentParser(description="Upload FHIR transaction bundles to a FHIR server.")
+    parser.add_argument("paths", nargs="*", default=[settings.folder_bundle_destination],
+                        help="Bundle files or folders (default: FOLDER_BUNDLE_DESTINATION)")
+    parser.add_argument("--base-url", default=settings.fhir_base_url,
+                        help="FHIR base URL (default: FHIR_BASE_URL)")
+    parser.add_argument("--workers", type=int, default=settings.fhir_upload_workers,
+                        help="Concurrent uploads (default: FHIR_UPLOAD_WORKERS)")
+    args = parser.parse_args(argv)
+    if not args.base_url:
+        parser.error("no FHIR base URL, set FHIR_BASE_URL or use --base-url")
+
+    uploader = FhirUploader.from_settings(settings.replace(fhir_base_url=args.base_url,
+                                                            fhir_upload_workers=args.workers))
+    for path in list_bundle_files(args.paths):
+        uploader.submit_file(path)
+    results = uploader.wait()
+    uploader.close()
+    print_upload_summary(results)
+    return 0 if all(result.success for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,21 @@
 import os
 
 import hashlib
+import pandas as pd
+
+try:
+    import xxhash
+except ImportError:  # optional, only needed for IDENTIFIER_HASH=xxhash
+    xxhash = None
+
+# IDENTIFIER_HASH selects the digest of the resource identifiers:
+#   "sha256":  the original identifiers, keep it when resources were already uploaded with them
+#   "blake2b": 256-bit BLAKE2b, different identifiers, faster than SHA-256 on most CPUs
+#   "xxhash":  128-bit XXH3 (non-cryptographic), the fastest, needs the optional xxhash package
+HASH_SHA256 = "sha256"
+HASH_BLAKE2B = "blake2b"
+HASH_XXHASH = "xxhash"
+IDENTIFIER_HASHES = (HASH_SHA256, HASH_BLAKE2B, HASH_XXHASH)
 
 
 def convert_datetime_to_iso(date_str, time_str, tz):
@@ -34,38 +49,126 @@ def replace_commas_with_periods(value):
     return value
 
 
-def save_bundles_to_files(bundles, resource_name, year, month, week):
+def column_to_float(column):
+    """
+    Column-wide equivalent of replace_commas_with_periods followed by float().
+
+    Args:
+        column (pandas.Series): Column with numbers, possibly written with decimal commas.
+
+    Returns:
+        pandas.Series: float64 column, values that cannot be parsed become NaN.
+    """
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype('float64')
+    cleaned = column.astype('string').str.replace(',', '.', regex=False).str.replace('"', '', regex=False)
+    return pd.to_numeric(cleaned, errors='coerce').astype('float64')
+
+
+def bundle_file_path(folder_name, resource_name, label, part):
+    """
+    Returns:
+        str: Path of a bundle file, e.g. 'Bundles/glucose_bundle_year_2023_month_10_week_1_part_1.json'.
+    """
+    return os.path.join(folder_name, f"{resource_name}_bundle_{label}_part_{part}.json")
+
+
+def save_bundles_to_files(bundles, resource_name, label, first_part=1, folder_name=None, writer=None, serialize=None):
     """
     Saves bundles to JSON files.
 
     Args:
         bundles (list): List of bundles to save.
         resource_name (str): Name of the resource.
-        year (int): Year for grouping bundles.
-        month (int): Month for grouping bundles.
-        week (int): Week for grouping bundles.
+        label (str): Label of the time partition of the bundles (e.g. 'year_2023_month_10_week_1').
+        first_part (int): Part number of the first bundle.
+        folder_name (str): Destination folder, FOLDER_BUNDLE_DESTINATION of the settings when not given.
+        writer (BundleWriter): Compresses, archives and writes the files in the background (see bundle_output.py),
+            the files are written directly when not given.
+        serialize (callable): JSON of a bundle (see serialization.bundle_serializer), bundle.json() when not given.
+
+    Returns:
+        list: Paths of the files created.
     """
-    folder_name = os.getenv('FOLDER_BUNDLE_DESTINATION', "Bundles")
-    for i, bundle in enumerate(bundles):
+    if folder_name is None:
+        # Imported here: settings imports this module
+        from settings import get_settings
+        folder_name = get_settings().folder_bundle_destination
+    file_paths = []
+    for i, bundle in enumerate(bundles, start=first_part):
         if not isinstance(bundle, int):
             try:
-                bundle_json = bundle.json()
-                file_path = os.path.join(
-                    folder_name, f"{resource_name}_bundle_year_{year}_month_{month}_week_{week}_part_{i+1}.json"
-                )
+                bundle_json = serialize(bundle) if serialize is not None else bundle.json()
+                file_path = bundle_file_path(folder_name, resource_name, label, i)
+                if writer is not None:
+                    file_paths.append(writer.write(file_path, bundle_json))
+                    continue
                 with open(file_path, "w") as f:
                     f.write(bundle_json)
                     print(f"File '{file_path}' successfully created.")
+                file_paths.append(file_path)
             except ValueError as e:
                 print(f"Error occurred: {e}")
+    return file_paths
+
+
+def identifier_hash_function(algorithm=HASH_SHA256):
+    """
+    Args:
+        algorithm (str): One of IDENTIFIER_HASHES.
 
+    Returns:
+        callable: Constructor of a hash object (hashlib style: update, copy and hexdigest).
 
-def generate_unique_identifier(data_elements):
+    Raises:
+        ValueError: If the algorithm is unknown or its package is not installed.
+    """
+    if algorithm == HASH_SHA256:
+        return hashlib.sha256
+    if algorithm == HASH_BLAKE2B:
+        return lambda data=b'': hashlib.blake2b(data, digest_size=32)
+    if algorithm == HASH_XXHASH:
+        if xxhash is None:
+            raise ValueError("IDENTIFIER_HASH 'xxhash' needs the xxhash package (pip install xxhash)")
+        return xxhash.xxh3_128
+    raise ValueError(f"Unknown identifier hash '{algorithm}', expected one of {IDENTIFIER_HASHES}")
+
+
+def generate_unique_identifier(data_elements, algorithm=HASH_SHA256):
     # Concatenate the data elements into a single string
     concatenated_data = '-'.join(map(str, data_elements))
 
-    # Generate a SHA-256 hash of this string
-    hash_object = hashlib.sha256(concatenated_data.encode())
+    # Generate a hash (SHA-256 by default) of this string
+    hash_object = identifier_hash_function(algorithm)(concatenated_data.encode())
     hash_hex = hash_object.hexdigest()
 
     return hash_hex
+
+
+def generate_unique_identifiers(prefix_elements, rows, algorithm=HASH_SHA256):
+    """
+    Batch version of generate_unique_identifier for many resources that share their first elements
+    (e.g. the resource kind and the patient).
+
+    The shared prefix is hashed once and the hash state is copied for every row, so only the
+    row elements are joined and hashed per resource. The result is the same as calling
+    generate_unique_identifier(prefix_elements + row) for every row.
+
+    Args:
+        prefix_elements (list): Elements shared by all the identifiers.
+        rows (iterable): Remaining elements (a tuple) of every identifier.
+        algorithm (str): One of IDENTIFIER_HASHES.
+
+    Returns:
+        list: Hex digest of every row.
+    """
+    new_hash = identifier_hash_function(algorithm)
+    prefix = '-'.join(map(str, prefix_elements))
+    prefix_hash = new_hash((prefix + '-').encode() if prefix_elements else b'')
+
+    identifiers = []
+    for row in rows:
+        hash_object = prefix_hash.copy()
+        hash_object.update('-'.join(map(str, row)).encode())
+        identifiers.append(hash_object.hexdigest())
+    return identifiers